@@ -0,0 +1,122 @@
+"""
+Measures how many requests per second a trivial ASGI app serves, bare and
+wrapped in profilomatic.asgi.ProfiledApp, over real sockets. The server is
+a minimal HTTP/1.1 keep-alive server built on asyncio streams (GET only,
+no request bodies), and the client keeps a few connections busy, one
+request at a time each. Everything is stdlib, and client and server share
+one event loop, so the numbers are only good for comparing the two.
+The profiler thread isn't running, so profiled requests queue messages
+that are drained (untimed) between runs.
+
+    python3 benchmarks/asgi_throughput.py
+"""
+import asyncio
+import time
+
+from profilomatic.asgi import ProfiledApp
+from profilomatic.profiler import Profiler
+
+CONNECTIONS = 10
+REQUESTS_PER_CONNECTION = 500
+
+REQUEST = (b'GET /hello?name=benchmark HTTP/1.1\r\n'
+           b'Host: localhost\r\n\r\n')
+
+
+async def hello_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'Hello, world!'})
+
+
+async def serve_connection(app, reader, writer):
+    server = writer.get_extra_info('sockname')[:2]
+    while True:
+        head = await reader.readuntil(b'\r\n\r\n')
+        if not head:
+            break
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ')
+        path, _, query = target.partition('?')
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers.append((name.strip().lower().encode('latin-1'),
+                                value.strip().encode('latin-1')))
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method,
+                 'path': path, 'root_path': '', 'query_string':
+                 query.encode('latin-1'), 'headers': headers,
+                 'server': server}
+        response = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response.append(b'HTTP/1.1 %d OK\r\n' % message['status'])
+                for name, value in message.get('headers', ()):
+                    response.append(name + b': ' + value + b'\r\n')
+            else:
+                body = message.get('body', b'')
+                response.append(b'Content-Length: %d\r\n\r\n' % len(body))
+                response.append(body)
+
+        await app(scope, receive, send)
+        writer.write(b''.join(response))
+
+
+async def client(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for _ in range(REQUESTS_PER_CONNECTION):
+        writer.write(REQUEST)
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        await reader.readexactly(length)
+    writer.close()
+
+
+async def requests_per_second(app):
+    async def handle(reader, writer):
+        try:
+            await serve_connection(app, reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port) for _ in range(CONNECTIONS)])
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return CONNECTIONS * REQUESTS_PER_CONNECTION / elapsed
+
+
+def best_of(app, drain=lambda: None):
+    results = []
+    for _ in range(5):
+        results.append(asyncio.run(requests_per_second(app)))
+        drain()
+    return max(results)
+
+
+if __name__ == '__main__':
+    instance = Profiler(simultaneous_tasks_profiled=0,
+                        message_queue_size=CONNECTIONS * REQUESTS_PER_CONNECTION * 2)
+    declining = Profiler(simultaneous_tasks_profiled=1)
+    declining.actions_next_run = 0  # As if the profiler were at capacity
+
+    def drain():
+        for profiler in (instance, declining):
+            profiler.message_queue.drain(lambda message: None, lambda unit: None)
+            profiler.latency.drain()
+
+    print('%-28s %12s' % ('case', 'requests/s'))
+    for name, app in [
+            ('bare', hello_app),
+            ('profiled', ProfiledApp(hello_app, instance)),
+            ('not profiled (at capacity)', ProfiledApp(hello_app, declining))]:
+        print('%-28s %12.0f' % (name, best_of(app, drain)))
@@ -0,0 +1,48 @@
+"""
+Measures the cost of CallGraphRoot.ingest as the number of children under a
+single dispatcher node grows. With the child index, the cost per sample
+should stay roughly flat.
+
+    python benchmarks/call_graph_fanout.py
+"""
+from __future__ import print_function
+import datetime
+import timeit
+
+from profilomatic.call_graph import CallGraphRoot as PureCallGraphRoot
+
+engines = [('pure', PureCallGraphRoot)]
+try:
+    from profilomatic._call_graph import CallGraphRoot as CCallGraphRoot
+    engines.append(('cython', CCallGraphRoot))
+except ImportError:
+    pass
+
+FAN_OUTS = [1, 4, 16, 64, 256, 1024, 4096]
+SAMPLES = 20000
+
+
+def ingest_cost(call_graph_class, fan_out):
+    stacks = [
+        ['server.py:serve', 'app.py:dispatch', 'views.py:view_%d' % i]
+        for i in range(fan_out)
+    ]
+    call_graph = call_graph_class(
+        1, 'benchmark', datetime.datetime.now(), 0)
+    for stack in stacks:  # Build the graph before timing
+        call_graph.ingest(stack, 10000000, 1000000000)
+
+    def run():
+        ingest = call_graph.ingest
+        for i in range(SAMPLES):
+            ingest(stacks[(i * 7919) % fan_out], 10000000, 1000000000)
+
+    return min(timeit.repeat(run, number=1, repeat=3)) / SAMPLES
+
+
+if __name__ == '__main__':
+    print('%-8s %8s %16s' % ('engine', 'fan-out', 'ns per ingest'))
+    for name, call_graph_class in engines:
+        for fan_out in FAN_OUTS:
+            print('%-8s %8d %16.0f' % (
+                name, fan_out, ingest_cost(call_graph_class, fan_out) * 1e9))
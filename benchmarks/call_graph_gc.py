@@ -0,0 +1,109 @@
+"""
+Compares the object and array call graph engines on a profiler-like
+workload: many tasks' call graphs built up sample by sample, emitted as
+JSON, then released. Reports the time per sample, the objects the garbage
+collector tracks while the call graphs are in flight, how many collections
+ran, and the memory allocated (with tracemalloc, where it's available).
+
+    python benchmarks/call_graph_gc.py
+"""
+from __future__ import print_function
+import datetime
+import gc
+import timeit
+
+from profilomatic.array_call_graph import ArrayCallGraphRoot, NodePool
+from profilomatic.call_graph import CallGraphRoot as PureCallGraphRoot
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+engines = [('object', PureCallGraphRoot)]
+try:
+    from profilomatic._call_graph import CallGraphRoot as CCallGraphRoot
+    engines.append(('cython', CCallGraphRoot))
+except ImportError:
+    pass
+engines.append(('array', None))
+
+TASKS_IN_FLIGHT = 50
+ROUNDS = 20
+SAMPLES_PER_TASK = 200
+
+
+def stacks(task):
+    # Each task spends its time in a handful of views, below a shared
+    # dispatcher, with some per-task helper functions
+    return [
+        ['server.py:serve', 'app.py:dispatch', 'views.py:view_%d' % (task % 7),
+         'helpers.py:helper_%d' % ((task * 31 + i) % 40), 'db.py:query']
+        for i in range(8)
+    ]
+
+
+def run_workload(engine):
+    """
+    Returns the most GC-tracked objects seen with call graphs in flight,
+    over the number of tracked objects before, and the collections run
+    """
+    call_graph_class = engine[1]
+    pool = NodePool()
+    start = datetime.datetime.now()
+    task_stacks = [stacks(task) for task in range(TASKS_IN_FLIGHT)]
+    gc.collect()
+    baseline = len(gc.get_objects())
+    collections = sum(stat['collections'] for stat in gc.get_stats()) \
+        if hasattr(gc, 'get_stats') else None
+    peak = 0
+    for round_number in range(ROUNDS):
+        if call_graph_class is None:
+            call_graphs = [ArrayCallGraphRoot(1, str(task), start, 0, pool=pool)
+                           for task in range(TASKS_IN_FLIGHT)]
+        else:
+            call_graphs = [call_graph_class(1, str(task), start, 0)
+                           for task in range(TASKS_IN_FLIGHT)]
+        for sample in range(SAMPLES_PER_TASK):
+            for task, call_graph in enumerate(call_graphs):
+                call_stack = task_stacks[task][sample % 8]
+                if sample % 50 == 0:
+                    call_graph.ingest(call_stack, 1000000, sample * 1000000,
+                                      {'action_status': 'started'})
+                else:
+                    call_graph.ingest(call_stack, 1000000, sample * 1000000)
+        peak = max(peak, len(gc.get_objects()) - baseline)
+        for call_graph in call_graphs:
+            call_graph.write_json(lambda text: None)
+            call_graph.release()
+        del call_graphs
+    if collections is not None:
+        collections = sum(
+            stat['collections'] for stat in gc.get_stats()) - collections
+    return peak, collections
+
+
+def allocated(engine):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    run_workload(engine)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == '__main__':
+    samples = TASKS_IN_FLIGHT * ROUNDS * SAMPLES_PER_TASK
+    print('%-8s %14s %16s %12s %16s' % (
+        'engine', 'ns per sample', 'tracked objects', 'collections',
+        'peak allocated'))
+    for engine in engines:
+        time_taken = min(timeit.repeat(
+            lambda: run_workload(engine), number=1, repeat=3))
+        tracked, collections = run_workload(engine)
+        peak = allocated(engine)
+        print('%-8s %14.0f %16d %12s %16s' % (
+            engine[0], time_taken / samples * 1e9, tracked,
+            '-' if collections is None else collections,
+            '-' if peak is None else '%d KiB' % (peak // 1024)))
@@ -0,0 +1,67 @@
+"""
+Measures how many call graphs per second each file destination can write,
+with the same small call graph written over and over. file_destination
+flushes after every call graph, so pays for a write syscall each time.
+
+    python benchmarks/file_destination_throughput.py
+"""
+from __future__ import print_function
+import datetime
+import os
+import shutil
+import tempfile
+import timeit
+
+from profilomatic.call_graph import CallGraphRoot
+from profilomatic.output import file_destination, no_flush_destination, \
+    RotatingFileDestination
+
+CALL_GRAPHS = 20000
+
+
+def make_call_graph():
+    call_graph = CallGraphRoot(1, 'benchmark', datetime.datetime.now(), 0)
+    for i in range(20):
+        call_graph.ingest(
+            ['server.py:serve', 'app.py:dispatch', 'views.py:view_%d' % (i % 5)],
+            10000000, 10000000 * i)
+    return call_graph
+
+
+def throughput(make_destination, directory):
+    call_graph = make_call_graph()
+    fields = {'source': 'benchmark'}
+
+    def run():
+        filename = os.path.join(directory, 'profile.jsonl')
+        destination = make_destination(filename)
+        write_call_graph = destination.write_call_graph
+        for _ in range(CALL_GRAPHS):
+            write_call_graph(call_graph, None, 'iso', fields)
+        if hasattr(destination, 'close'):
+            destination.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    return CALL_GRAPHS / min(timeit.repeat(run, number=1, repeat=3))
+
+
+DESTINATIONS = [
+    ('file_destination', lambda filename: file_destination(filename)),
+    ('no_flush_destination', lambda filename: no_flush_destination(filename)),
+    ('rotating', lambda filename: RotatingFileDestination(filename)),
+    ('rotating, 1MB segments', lambda filename: RotatingFileDestination(
+        filename, max_bytes=1024 * 1024)),
+    ('rotating, 1MB gzipped', lambda filename: RotatingFileDestination(
+        filename, max_bytes=1024 * 1024, compress='gzip')),
+]
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    try:
+        print('%-24s %16s' % ('destination', 'call graphs/sec'))
+        for name, make_destination in DESTINATIONS:
+            print('%-24s %16.0f' % (name, throughput(make_destination, directory)))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,59 @@
+"""
+Measures the cost of Profiler.handle_message on the application thread, per
+call, for an action made of a start message, some log messages, and an end
+message. The profiler thread isn't running, so the queued messages are
+drained (untimed) between runs.
+
+    python benchmarks/handle_message.py
+"""
+from __future__ import print_function
+import timeit
+
+from profilomatic.profiler import Profiler
+
+LOG_MESSAGES = 8
+ACTIONS = 1000
+
+
+def action_messages(task_uuid):
+    messages = [{'task_uuid': task_uuid, 'action_status': 'started',
+                 'action_type': 'benchmark:action'}]
+    messages.extend({'task_uuid': task_uuid, 'message_type': 'benchmark:log',
+                     'index': i} for i in range(LOG_MESSAGES))
+    messages.append({'task_uuid': task_uuid, 'action_status': 'succeeded'})
+    return messages
+
+
+def cost_per_message(profiled, store_all_logs):
+    instance = Profiler(
+        store_all_logs=store_all_logs,
+        simultaneous_tasks_profiled=0 if profiled else 1,
+        message_queue_size=ACTIONS * (LOG_MESSAGES + 2))
+    if not profiled:
+        instance.actions_next_run = 0  # As if the profiler were at capacity
+    actions = [action_messages(str(i)) for i in range(ACTIONS)]
+    handle_message = instance.handle_message
+
+    def run():
+        for messages in actions:
+            for message in messages:
+                handle_message(message)
+
+    def drain():
+        instance.message_queue.drain(lambda message: None, lambda thread: None)
+
+    timings = []
+    for _ in range(5):
+        timings.append(timeit.timeit(run, number=1))
+        drain()
+    return min(timings) / (ACTIONS * (LOG_MESSAGES + 2))
+
+
+if __name__ == '__main__':
+    print('%-34s %10s' % ('case', 'ns/call'))
+    for name, profiled, store_all_logs in [
+            ('profiled, all logs stored', True, True),
+            ('profiled, only start and end', True, False),
+            ('not profiled', False, True)]:
+        print('%-34s %10.0f' % (
+            name, cost_per_message(profiled, store_all_logs) * 1e9))
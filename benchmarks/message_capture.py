@@ -0,0 +1,88 @@
+"""
+Compares keeping a message's frame, and walking it later on the profiler
+thread, with capturing the stack when the message is logged. Reports the
+cost on the application thread, the cost on the profiler thread, and the
+memory still held by 1000 queued messages, logged from frames that each
+had a 10KB local variable.
+
+    python benchmarks/message_capture.py
+"""
+from __future__ import print_function
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from profilomatic import stack_trace
+
+engines = [('pure', stack_trace)]
+try:
+    from profilomatic import _stack_trace
+    engines.append(('cython', _stack_trace))
+except ImportError:
+    pass
+
+DEPTH = 30
+MESSAGES = 1000
+REPEATS = 10000
+
+
+def at_depth(depth, f):
+    if depth == 0:
+        return f()
+    return at_depth(depth - 1, f)
+
+
+def log_with_local(capture):
+    local = bytearray(10 * 1024)  # Stands in for an application's locals
+    return capture(sys._getframe())
+
+
+def costs(module):
+    frame = at_depth(DEPTH, sys._getframe)
+    generate_stack_trace = module.generate_stack_trace
+    capture_stack = module.capture_stack
+    resolve_stack = module.resolve_stack
+    stack = capture_stack(frame, 'line')
+    generate_stack_trace(frame, 'line', True)  # Warm the symbol cache
+
+    def time(f):
+        return min(timeit.repeat(f, number=REPEATS, repeat=3)) / REPEATS
+
+    return [
+        ('keep frame', time(sys._getframe),
+         time(lambda: generate_stack_trace(frame, 'line', True))),
+        ('capture stack', time(lambda: capture_stack(frame, 'line')),
+         time(lambda: resolve_stack(stack, 'line')))
+    ]
+
+
+def retained(capture):
+    if tracemalloc is None:
+        return float('nan')
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [at_depth(DEPTH, lambda: log_with_local(capture))
+                for _ in range(MESSAGES)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return after - before
+
+
+if __name__ == '__main__':
+    print('%-8s %-14s %14s %18s %14s' % (
+        'engine', 'approach', 'app ns/msg', 'profiler ns/msg', 'retained KB'))
+    for name, module in engines:
+        retained_by = {
+            'keep frame': retained(lambda frame: frame),
+            'capture stack': retained(
+                lambda frame: module.capture_stack(frame, 'line'))
+        }
+        for approach, app_cost, profiler_cost in costs(module):
+            print('%-8s %-14s %14.0f %18.0f %14.0f' % (
+                name, approach, app_cost * 1e9, profiler_cost * 1e9,
+                retained_by[approach] / 1024.0))
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 from .profiler import Profiler
-from .output import file_destination, no_flush_destination, RestDestination
+from .output import file_destination, no_flush_destination, RestDestination, \
+    RotatingFileDestination
 
 _instance = Profiler()
 configure = _instance.configure
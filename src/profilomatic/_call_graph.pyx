@@ -1,107 +1,468 @@
 cimport cpython.datetime as datetime
 
+import json
+from itertools import chain
+
+from .budget import coalesce_threshold
+from .clock import to_timedelta
+from .serialize import time_formatter, instruction_encoder, root_fields, \
+    state_seconds
+from .thread_state import STATE_COUNT
+
+# Nodes with more current children than this get a hash index on them
+DEF _CHILD_INDEX_THRESHOLD = 8
+CHILD_INDEX_THRESHOLD = _CHILD_INDEX_THRESHOLD
+
 cdef class _CallGraphNode(object):
-    cdef str instruction_pointer
-    cdef double time
-    cdef double self_time
-    cdef double min_monotonic
-    cdef double max_monotonic
+    cdef object instruction_pointer
+    cdef long long time
+    cdef long long self_time
+    cdef long long cpu_time
+    cdef long long self_cpu_time
+    cdef list state_times  # Time in each thread state, once there is some
+    cdef long long min_monotonic
+    cdef long long max_monotonic
     cdef list archived_children
     cdef list current_children
+    cdef dict child_index
     cdef object message
+    cdef Py_ssize_t coalesced  # Number of nodes folded into this "other" node
 
     def __init__(self,
-                 str instruction_pointer,
-                 double time,
-                 double self_time,
-                 double min_monotonic,
-                 double max_monotonic):
+                 instruction_pointer,
+                 long long time,
+                 long long cpu_time,
+                 long long min_monotonic,
+                 long long max_monotonic):
         self.instruction_pointer = instruction_pointer
         self.time = time
-        self.self_time = self_time
+        self.self_time = 0
+        self.cpu_time = cpu_time
+        self.self_cpu_time = 0
+        self.state_times = None
         self.min_monotonic = min_monotonic
         self.max_monotonic = max_monotonic
         self.archived_children = []
         self.current_children = []
+        self.child_index = None
         self.message = None
+        self.coalesced = 0
 
-    cdef add_time(self, float time, float monotime):
+    cdef void add_time(self, long long time, long long cpu_time, long long monotime):
         self.time += time
+        self.cpu_time += cpu_time
         if monotime < self.min_monotonic:
             self.min_monotonic = monotime
         if monotime > self.max_monotonic:
             self.max_monotonic = monotime
 
-    cdef dict _jsonize(self, datetime.datetime wall_clock_minus_monotonic):
+    cdef void _add_state_time(self, Py_ssize_t state, long long time):
+        if self.state_times is None:
+            self.state_times = [0] * STATE_COUNT
+        self.state_times[state] += time
+
+    cdef _CallGraphNode _current_child(self, instruction_pointer, long long time,
+                                       long long cpu_time, long long monotime):
+        cdef _CallGraphNode child
         cdef _CallGraphNode node
+        cdef object found
+        if self.child_index is not None:
+            found = self.child_index.get(instruction_pointer)
+            if found is not None:
+                child = <_CallGraphNode>found
+                child.add_time(time, cpu_time, monotime)
+                return child
+        else:
+            for child in self.current_children:
+                if child.instruction_pointer == instruction_pointer:
+                    child.add_time(time, cpu_time, monotime)
+                    return child
+        child = _CallGraphNode(instruction_pointer, time, cpu_time, monotime, monotime)
+        self.current_children.append(child)
+        if self.child_index is not None:
+            self.child_index[instruction_pointer] = child
+        elif len(self.current_children) > _CHILD_INDEX_THRESHOLD:
+            self.child_index = {}
+            for node in self.current_children:
+                self.child_index[node.instruction_pointer] = node
+        return child
+
+    cdef _archive_children(self):
+        self.archived_children.extend(self.current_children)
+        self.current_children = []
+        self.child_index = None
+
+    cdef str _json_head(self, format_time, encode_instruction):
+        # The node's JSON, up to where its children would go
+        cdef str text = '{"time": %r, "self_time": %r, "start_time": %s, "end_time": %s' % (
+            self.time / 1e9, self.self_time / 1e9,
+            format_time(self.min_monotonic), format_time(self.max_monotonic))
+        if self.instruction_pointer is not None:
+            text += ', "instruction": ' + encode_instruction(self.instruction_pointer)
+        if self.message is not None:
+            text += ', "message": ' + json.dumps(self.message)
+        if self.cpu_time:
+            text += ', "cpu_time": %r, "self_cpu_time": %r' % (
+                self.cpu_time / 1e9, self.self_cpu_time / 1e9)
+        if self.state_times is not None:
+            text += ', "states": ' + json.dumps(state_seconds(self.state_times))
+        if self.coalesced:
+            text += ', "coalesced": %d' % self.coalesced
+        return text
+
+    cdef dict _head(self, format_time, dict local_ids):
+        # Everything but the node's children
         msg = {
-            'time': self.time,
-            'self_time': self.self_time,
-            'start_time': (wall_clock_minus_monotonic + datetime.timedelta(
-                seconds=self.min_monotonic)).isoformat(),
-            'end_time': (wall_clock_minus_monotonic + datetime.timedelta(
-                seconds=self.max_monotonic)).isoformat()
+            'time': self.time / 1e9,
+            'self_time': self.self_time / 1e9,
+            'start_time': format_time(self.min_monotonic),
+            'end_time': format_time(self.max_monotonic)
         }
-        if self.archived_children or self.current_children:
-            msg['children'] = [
-                node._jsonize(wall_clock_minus_monotonic)
-                for node in self.archived_children + self.current_children
-            ]
         if self.instruction_pointer is not None:
-            msg['instruction'] = self.instruction_pointer
+            if local_ids is None:
+                msg['instruction'] = self.instruction_pointer
+            else:
+                local_id = local_ids.get(self.instruction_pointer)
+                if local_id is None:
+                    local_id = local_ids[self.instruction_pointer] = len(local_ids)
+                msg['instruction'] = local_id
         if self.message is not None:
             msg['message'] = self.message
+        if self.cpu_time:
+            msg['cpu_time'] = self.cpu_time / 1e9
+            msg['self_cpu_time'] = self.self_cpu_time / 1e9
+        if self.state_times is not None:
+            msg['states'] = state_seconds(self.state_times)
+        if self.coalesced:
+            msg['coalesced'] = self.coalesced
         return msg
 
+    cdef bint _has_children(self):
+        return len(self.archived_children) > 0 or len(self.current_children) > 0
+
 
 cdef class CallGraphRoot(_CallGraphNode):
-    cdef long thread
-    cdef basestring task_uuid
-    cdef datetime.datetime wall_clock_minus_monotonic
+    cdef readonly long thread
+    cdef readonly basestring task_uuid
+    cdef readonly datetime.datetime wall_clock_minus_monotonic
+    cdef list last_path
+    cdef readonly Py_ssize_t node_count
+
+    # Rough memory cost of a node, for enforcing byte budgets
+    bytes_per_node = 224
 
-    def __init__(self, long thread, basestring task_uuid, datetime.datetime start_time, float start_monotonic):
-        _CallGraphNode.__init__(self, None, 0.0, 0.0, start_monotonic, start_monotonic)
+    def __init__(self, long thread, basestring task_uuid, datetime.datetime start_time,
+                 long long start_monotonic):
+        _CallGraphNode.__init__(self, None, 0, 0, start_monotonic, start_monotonic)
         self.thread = thread
         self.task_uuid = task_uuid
-        self.wall_clock_minus_monotonic = (
-            start_time - datetime.timedelta(seconds=start_monotonic))
+        self.wall_clock_minus_monotonic = start_time - to_timedelta(start_monotonic)
+        self.last_path = []
+        self.node_count = 1
 
-    cpdef ingest(self, list call_stack, double time, double monotime, message=None):
-        cdef _CallGraphNode child
-        cdef str instruction_pointer
-        cdef str last_instruction = None
+    cpdef ingest(self, list call_stack, long long time, long long monotime, message=None,
+                 Py_ssize_t shared_prefix=0, long long cpu_time=0, state=None):
+        """
+        Add a sample to the call graph, taking `time` to record, at
+        monotonic time `monotime`, both in integer nanoseconds. If
+        `shared_prefix` is given, the first `shared_prefix` instructions of
+        `call_stack` must match the previous sample ingested, and their
+        nodes are reused without searching. `cpu_time` is the part of
+        `time` the thread spent on the CPU, if known, and `state` the thread
+        state it was in, from `thread_state`, if known.
+        """
+        cdef object last_instruction = None
         cdef _CallGraphNode node = self
+        cdef list path = self.last_path
+        cdef list children
+        cdef Py_ssize_t i
+        cdef Py_ssize_t child_count
+        cdef Py_ssize_t int_state = -1 if state is None else state
+        if not time:
+            int_state = -1
 
         if message is not None:
             if len(call_stack) > 0:
                 call_stack, last_instruction = call_stack[:-1], call_stack[-1]
+            shared_prefix = 0
 
-        self.add_time(time, monotime)
-        for instruction_pointer in call_stack:
-            for child in node.current_children:
-                if child.instruction_pointer == instruction_pointer:
-                    node = child
-                    node.add_time(time, monotime)
-                    break
-            else:
-                new_node = _CallGraphNode(instruction_pointer, time, 0.0, monotime, monotime)
-                node.current_children.append(new_node)
-                node = new_node
+        self.add_time(time, cpu_time, monotime)
+        if shared_prefix > len(path):
+            shared_prefix = len(path)
+        del path[shared_prefix:]
+        for node in path:
+            node.add_time(time, cpu_time, monotime)
+        if not path:
+            node = self
+
+        for i in range(shared_prefix, len(call_stack)):
+            children = node.current_children
+            child_count = len(children)
+            node = node._current_child(call_stack[i], time, cpu_time, monotime)
+            path.append(node)
+            if len(children) != child_count:
+                self.node_count += 1
+
+        if int_state >= 0:
+            self._add_state_time(int_state, time)
+            for node in path:
+                node._add_state_time(int_state, time)
 
         if message is not None:
-            node.archived_children.extend(node.current_children)
-            new_node = _CallGraphNode(last_instruction, time, 0.0, monotime, monotime)
+            # Archiving current children invalidates the remembered path
+            del path[:]
+            node._archive_children()
+            new_node = _CallGraphNode(last_instruction, time, cpu_time, monotime, monotime)
             new_node.message = message
+            if int_state >= 0:
+                new_node._add_state_time(int_state, time)
             node.archived_children.append(new_node)
-            node.current_children = []
             node = new_node
+            self.node_count += 1
 
         # Add self time to leaf node
         node.self_time += time
+        node.self_cpu_time += cpu_time
 
-    cpdef jsonize(self):
+    cpdef jsonize(self, symbol_table=None, time_format='iso'):
+        """
+        Convert the call graph to JSON-compatible dicts. If the call graph
+        holds symbol ids, pass the symbol table they came from, and the
+        output will contain a `symbols` list, with each node's instruction
+        being an index into it. With the 'offset' time format, times are
+        in seconds since the call graph's `base_time`.
+        """
         cdef dict result
-        result = self._jsonize(self.wall_clock_minus_monotonic)
-        result['task_uuid'] = self.task_uuid
-        result['thread'] = self.thread
+        cdef dict msg
+        cdef dict local_ids = None
+        cdef list stack = []
+        cdef tuple entry
+        cdef list output
+        cdef _CallGraphNode node
+        cdef object found
+        if symbol_table is not None:
+            local_ids = {}
+        format_time = time_formatter(
+            self.wall_clock_minus_monotonic, self.min_monotonic, time_format)
+        result = self._head(format_time, local_ids)
+        if self._has_children():
+            result['children'] = []
+            stack.append((chain(self.archived_children, self.current_children),
+                          result['children']))
+        while stack:
+            entry = stack[-1]
+            found = next(entry[0], None)
+            if found is None:
+                stack.pop()
+                continue
+            node = <_CallGraphNode>found
+            msg = node._head(format_time, local_ids)
+            output = entry[1]
+            output.append(msg)
+            if node._has_children():
+                msg['children'] = []
+                stack.append((chain(node.archived_children, node.current_children),
+                              msg['children']))
+        result.update(root_fields(
+            self.task_uuid, self.thread, self.wall_clock_minus_monotonic,
+            self.min_monotonic, symbol_table, local_ids, time_format))
         return result
+
+    def walk(self):
+        """
+        Yield every node in the call graph, parents before children, as
+        (depth, instruction, time, self_time, min_monotonic, max_monotonic,
+        message, coalesced, cpu_time, self_cpu_time, state_times) tuples,
+        starting with the root at depth 0. Times are in nanoseconds, and
+        state_times is a sequence of times indexed by thread state, or None.
+        """
+        cdef list stack = [iter((self,))]
+        cdef _CallGraphNode node
+        cdef object found
+        while stack:
+            found = next(stack[-1], None)
+            if found is None:
+                stack.pop()
+                continue
+            node = <_CallGraphNode>found
+            yield (len(stack) - 1, node.instruction_pointer, node.time,
+                   node.self_time, node.min_monotonic, node.max_monotonic,
+                   node.message, node.coalesced, node.cpu_time,
+                   node.self_cpu_time, node.state_times)
+            if node._has_children():
+                stack.append(chain(node.archived_children, node.current_children))
+
+    cpdef write_json(self, write, symbol_table=None, time_format='iso', extra=None):
+        """
+        Write the same JSON that `jsonize` would give, piece by piece, to
+        the `write` function, without building it as dicts first. `extra`
+        holds any more fields to add to the top level.
+        """
+        cdef dict local_ids = None
+        cdef dict fields
+        cdef list stack = []
+        cdef bint first = True
+        cdef _CallGraphNode node
+        cdef object found
+        cdef str head
+        if symbol_table is not None:
+            local_ids = {}
+        format_time = time_formatter(
+            self.wall_clock_minus_monotonic, self.min_monotonic, time_format, True)
+        encode_instruction = instruction_encoder(local_ids)
+        head = self._json_head(format_time, encode_instruction)
+        if self._has_children():
+            write(head + ', "children": [')
+            stack.append(chain(self.archived_children, self.current_children))
+        else:
+            write(head)
+        while stack:
+            found = next(stack[-1], None)
+            if found is None:
+                stack.pop()
+                # Close the children, and the node they belong to
+                write(']}' if stack else ']')
+                first = False
+                continue
+            node = <_CallGraphNode>found
+            head = node._json_head(format_time, encode_instruction)
+            if not first:
+                head = ', ' + head
+            if node._has_children():
+                write(head + ', "children": [')
+                stack.append(chain(node.archived_children, node.current_children))
+                first = True
+            else:
+                write(head + '}')
+                first = False
+        fields = root_fields(
+            self.task_uuid, self.thread, self.wall_clock_minus_monotonic,
+            self.min_monotonic, symbol_table, local_ids, time_format)
+        if extra:
+            fields.update(extra)
+        write(', ' + json.dumps(fields)[1:])
+
+    cpdef Py_ssize_t coalesce(self, Py_ssize_t max_nodes):
+        """
+        Fold the coldest subtrees of the call graph into a single "other"
+        node per parent, holding their combined time, until the call graph
+        has no more than `max_nodes` nodes. Messages, and the nodes leading
+        to them, are never folded. Returns the number of nodes removed.
+        """
+        cdef list nodes
+        cdef list parents
+        cdef list child_starts
+        cdef list pinned
+        cdef list sizes
+        cdef list kept
+        cdef list archived
+        cdef list current
+        cdef _CallGraphNode node
+        cdef _CallGraphNode child
+        cdef _CallGraphNode other
+        cdef Py_ssize_t i, j, start, end, archived_count, state
+        cdef Py_ssize_t node_count
+        cdef Py_ssize_t removed
+        if self.node_count <= max_nodes:
+            return 0
+        # List nodes breadth first, so each node's children are contiguous
+        nodes = [self]
+        parents = [0]
+        child_starts = []
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            child_starts.append(len(nodes))
+            for child in node.archived_children:
+                nodes.append(child)
+                parents.append(i)
+            for child in node.current_children:
+                nodes.append(child)
+                parents.append(i)
+            i += 1
+        child_starts.append(len(nodes))
+
+        pinned = [node.message is not None for node in nodes]
+        sizes = [node.coalesced or 1 for node in nodes]
+        for i in range(len(nodes) - 1, 0, -1):
+            if pinned[i]:
+                pinned[parents[i]] = True
+            sizes[parents[i]] += sizes[i]
+        kept = coalesce_threshold(
+            [node.time for node in nodes], parents, pinned, max_nodes)
+
+        node_count = 0
+        for i in range(len(nodes)):
+            if not kept[i]:
+                continue
+            node = nodes[i]
+            node_count += 1
+            start = child_starts[i]
+            end = child_starts[i + 1]
+            if all(kept[start:end]):
+                continue
+            # Existing "other" nodes get folded into the new one
+            archived_count = len(node.archived_children)
+            archived = []
+            current = []
+            other = None
+            for j in range(start, end):
+                child = nodes[j]
+                if kept[j] and not child.coalesced:
+                    if j - start < archived_count:
+                        archived.append(child)
+                    else:
+                        current.append(child)
+                    continue
+                kept[j] = False
+                if other is None:
+                    other = _CallGraphNode(
+                        None, 0, 0, child.min_monotonic, child.max_monotonic)
+                other.add_time(child.time, child.cpu_time, child.min_monotonic)
+                other.add_time(0, 0, child.max_monotonic)
+                if child.state_times is not None:
+                    for state in range(STATE_COUNT):
+                        other._add_state_time(state, child.state_times[state])
+                other.coalesced += sizes[j]
+            other.self_time = other.time
+            other.self_cpu_time = other.cpu_time
+            archived.append(other)
+            node_count += 1
+            node.archived_children = archived
+            node.current_children = current
+            if len(current) > _CHILD_INDEX_THRESHOLD:
+                node.child_index = {}
+                for child in current:
+                    node.child_index[child.instruction_pointer] = child
+            else:
+                node.child_index = None
+
+        removed = self.node_count - node_count
+        self.node_count = node_count
+        del self.last_path[:]
+        return removed
+
+    cpdef reset(self, long long monotime):
+        """
+        Drop all of the call graph's nodes, once they've been emitted as a
+        snapshot, so it only holds samples taken from `monotime` onwards.
+        """
+        self.time = 0
+        self.self_time = 0
+        self.cpu_time = 0
+        self.self_cpu_time = 0
+        self.state_times = None
+        self.min_monotonic = monotime
+        self.max_monotonic = monotime
+        self.release()
+        self.node_count = 1
+
+    cpdef release(self):
+        """
+        Drop this call graph's nodes. The call graph must not be used
+        afterwards.
+        """
+        self.archived_children = []
+        self.current_children = []
+        self.child_index = None
+        self.last_path = []
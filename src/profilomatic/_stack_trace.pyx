@@ -1,7 +1,10 @@
 from cpython.object cimport PyObject, PyTypeObject, PyObject_TypeCheck
+from cpython.list cimport PyList_New, PyList_SET_ITEM
+from cpython.ref cimport Py_INCREF
 
 cdef extern from "code.h":
     ctypedef struct PyCodeObject:
+        int co_flags
         PyObject* co_filename
         PyObject* co_name
 
@@ -18,6 +21,9 @@ cdef extern from "frameobject.h":
 DEF gran_file = 0
 DEF gran_method = 1
 DEF gran_line = 2
+
+DEFAULT_SYMBOL_CACHE_SIZE = 10000
+
 cdef int _lookup_granularity(str granularity):
     if granularity == 'file':
         return gran_file
@@ -29,32 +35,299 @@ cdef int _lookup_granularity(str granularity):
         raise ValueError('Granularity must be file, method, or line')
 
 
+cdef bint _is_profiler_module(str module_name):
+    return (module_name == 'eliot' or module_name.startswith('eliot.')
+            or module_name == 'profilomatic' or module_name.startswith('profilomatic.'))
+
+
+cdef class SymbolTable(object):
+    """
+    Assigns small integer ids to instruction strings, so call graphs can
+    hold ids and only resolve them to strings when they are output.
+    """
+    cdef readonly dict ids
+    cdef readonly list symbols
+
+    def __init__(self):
+        self.ids = {}
+        self.symbols = []
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __getitem__(self, Py_ssize_t symbol_id):
+        return self.symbols[symbol_id]
+
+    cpdef id_for(self, instruction):
+        symbol_id = self.ids.get(instruction)
+        if symbol_id is None:
+            symbol_id = self.ids[instruction] = len(self.symbols)
+            self.symbols.append(instruction)
+        return symbol_id
+
+
+cdef SymbolTable _symbol_table = SymbolTable()
+symbol_table = _symbol_table
+
+
+cdef class SymbolCache(object):
+    """
+    Bounded cache mapping (code object, line number, granularity) to an
+    interned instruction string, a flag saying whether the frame belongs
+    to Eliot or Profilomatic, and the instruction's id in the symbol table.
+
+    Entries live in two generations. When the current generation fills up,
+    it becomes the previous generation, and the old previous generation is
+    dropped. Hits in the previous generation are promoted, so hot code
+    survives eviction.
+    """
+    cdef public Py_ssize_t capacity
+    cdef readonly SymbolTable symbol_table
+    cdef readonly unsigned long long hits
+    cdef readonly unsigned long long misses
+    cdef dict _current
+    cdef dict _previous
 
-cpdef generate_stack_trace(frame_, str granularity, bint strip_eliot_frames):
+    def __init__(self, Py_ssize_t capacity=DEFAULT_SYMBOL_CACHE_SIZE,
+                 SymbolTable symbol_table=_symbol_table):
+        self.capacity = capacity
+        self.symbol_table = symbol_table
+        self.hits = 0
+        self.misses = 0
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    cdef tuple _lookup(self, PyFrameObject* frame, int int_granularity):
+        cdef int lineno = 0
+        if int_granularity >= gran_line:
+            lineno = PyFrame_GetLineNumber(frame)
+        return self._lookup_code(
+            <object>frame.f_code, lineno, <object>frame.f_globals, int_granularity)
+
+    cdef tuple _lookup_code(self, code, int lineno, f_globals, int int_granularity):
+        cdef tuple key
+        cdef tuple entry
+        cdef list items
+        cdef object module_name
+        cdef object instruction
+        if int_granularity < gran_line:
+            lineno = 0
+        key = (code, lineno, int_granularity)
+        entry = self._current.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        entry = self._previous.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            items = [code.co_filename]
+            if int_granularity >= gran_method:
+                items.append(code.co_name)
+            if int_granularity >= gran_line:
+                items.append(str(lineno))
+            module_name = f_globals.get('__name__') or ''
+            instruction = intern(':'.join(items))
+            entry = (instruction, _is_profiler_module(module_name),
+                     self.symbol_table.id_for(instruction))
+        if len(self._current) * 2 >= self.capacity:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = entry
+        return entry
+
+    def lookup(self, frame_, str granularity):
+        if not PyObject_TypeCheck(frame_, &PyFrame_Type):
+            raise TypeError('Argument must be stack frame')
+        return self._lookup(<PyFrameObject*>frame_, _lookup_granularity(granularity))
+
+
+cdef SymbolCache _symbol_cache = SymbolCache()
+symbol_cache = _symbol_cache
+
+
+cpdef generate_stack_trace(frame_, str granularity, bint strip_eliot_frames,
+                           bint symbol_ids=False):
     cdef PyFrameObject* frame
-    cdef str module_name
+    cdef tuple entry
+    cdef int field = 2 if symbol_ids else 0
     if not PyObject_TypeCheck(frame_, &PyFrame_Type):
         raise TypeError('Argument must be stack frame')
     int_granularity = _lookup_granularity(granularity)
     frame = <PyFrameObject*>frame_
     result = []
     while frame != NULL:
-        items = [<str>frame.f_code.co_filename]
-        if int_granularity >= gran_method:
-            items.append(<str>frame.f_code.co_name)
-        if int_granularity >= gran_line:
-            items.append(str(PyFrame_GetLineNumber(frame)))
-        instruction = ':'.join(items)
+        entry = _symbol_cache._lookup(frame, int_granularity)
         if strip_eliot_frames:
-            f_globals = <dict>frame.f_globals
-            module_name = f_globals['__name__']
-            if not (module_name == 'eliot' or module_name.startswith('eliot.')
-                    or module_name == 'profilomatic' or module_name.startswith('profilomatic.')):
-                result.append(instruction)
+            if not entry[1]:
+                result.append(entry[field])
                 strip_eliot_frames = False
         else:
-            result.append(instruction)
+            result.append(entry[field])
         frame = frame.f_back
 
     result.reverse()
     return result
+
+
+cpdef list capture_stack(frame_, str granularity='line', outermost=None):
+    """
+    Snapshot a stack, so it can be turned into a trace later without
+    keeping its frames (and their local variables) alive. Eliot and
+    Profilomatic frames at the top of the stack are skipped, as
+    `generate_stack_trace` would. The snapshot is a flat list, holding the
+    code object, line number (0 if granularity is coarser than line) and
+    module globals of each frame, innermost first. If `outermost` is on
+    the stack, the snapshot stops there.
+    """
+    cdef PyFrameObject* frame
+    cdef PyFrameObject* top
+    cdef PyFrameObject* stop = NULL
+    cdef bint lines
+    cdef Py_ssize_t count = 0
+    cdef Py_ssize_t i = 0
+    cdef list result
+    cdef object item
+    if not PyObject_TypeCheck(frame_, &PyFrame_Type):
+        raise TypeError('Argument must be stack frame')
+    if outermost is not None:
+        if not PyObject_TypeCheck(outermost, &PyFrame_Type):
+            raise TypeError('Outermost must be stack frame')
+        stop = <PyFrameObject*>outermost
+    lines = _lookup_granularity(granularity) >= gran_line
+    frame = <PyFrameObject*>frame_
+    while frame != NULL and _is_profiler_module(
+            (<dict>frame.f_globals).get('__name__') or ''):
+        frame = frame.f_back
+    top = frame
+    while frame != NULL:
+        count += 1
+        if frame == stop:
+            break
+        frame = frame.f_back
+    # Filling a presized list avoids repeatedly growing it
+    result = PyList_New(count * 3)
+    frame = top
+    while i < count * 3:
+        item = <object>frame.f_code
+        Py_INCREF(item)
+        PyList_SET_ITEM(result, i, item)
+        item = PyFrame_GetLineNumber(frame) if lines else 0
+        Py_INCREF(item)
+        PyList_SET_ITEM(result, i + 1, item)
+        item = <object>frame.f_globals
+        Py_INCREF(item)
+        PyList_SET_ITEM(result, i + 2, item)
+        i += 3
+        frame = frame.f_back
+    return result
+
+
+cpdef list resolve_stack(list stack, str granularity, bint symbol_ids=False):
+    """
+    Turn a snapshot from `capture_stack` into a trace, like the one
+    `generate_stack_trace` gives
+    """
+    cdef int int_granularity = _lookup_granularity(granularity)
+    cdef int field = 2 if symbol_ids else 0
+    cdef Py_ssize_t i = len(stack) - 3
+    cdef list result = []
+    while i >= 0:
+        result.append(_symbol_cache._lookup_code(
+            stack[i], stack[i + 1], stack[i + 2], int_granularity)[field])
+        i -= 3
+    return result
+
+
+DEF _GENERATOR_FLAGS = 0x20 | 0x80 | 0x100 | 0x200
+
+
+cdef class IncrementalStackTrace(object):
+    """
+    Remembers the frames and instructions from the last sample of a thread,
+    so that the next sample only needs to resolve the frames that have
+    changed. Once the walk reaches a frame that was present last time, every
+    frame above it must be unchanged, unless a generator in between has been
+    resumed from somewhere else.
+
+    After each update, `shared` holds the number of leading instructions
+    that are known to be unchanged since the previous update.
+    """
+    cdef readonly list frames
+    cdef readonly list trace
+    cdef dict frame_index
+    cdef list generators
+    cdef readonly Py_ssize_t shared
+
+    def __init__(self):
+        self.clear()
+
+    cpdef clear(self):
+        self.frames = []
+        self.trace = []
+        self.frame_index = {}
+        self.generators = []
+        self.shared = 0
+
+    cpdef list update(self, frame_, str granularity, bint symbol_ids=False):
+        cdef PyFrameObject* frame
+        cdef PyFrameObject* parent
+        cdef list new_frames = []
+        cdef list new_trace = []
+        cdef object index
+        cdef Py_ssize_t depth = -1
+        cdef Py_ssize_t i
+        cdef int int_granularity
+        cdef int field = 2 if symbol_ids else 0
+        if not PyObject_TypeCheck(frame_, &PyFrame_Type):
+            raise TypeError('Argument must be stack frame')
+        int_granularity = _lookup_granularity(granularity)
+        frame = <PyFrameObject*>frame_
+        while frame != NULL:
+            new_frames.append(<object>frame)
+            new_trace.append(_symbol_cache._lookup(frame, int_granularity)[field])
+            index = self.frame_index.get(<size_t>frame)
+            if index is not None:
+                depth = index
+                break
+            frame = frame.f_back
+
+        if depth < 0:
+            depth = 0
+        else:
+            # A generator's parent frame changes if it is resumed by someone
+            # else, in which case nothing above it can be trusted
+            for index in self.generators:
+                i = index
+                if i > depth:
+                    break
+                parent = <PyFrameObject*>self.frames[i - 1] if i > 0 else NULL
+                if (<PyFrameObject*>self.frames[i]).f_back != parent:
+                    self.clear()
+                    return self.update(new_frames[0], granularity, symbol_ids)
+
+        for i in range(depth, len(self.frames)):
+            del self.frame_index[<size_t><PyObject*>self.frames[i]]
+        while self.generators and self.generators[-1] >= depth:
+            self.generators.pop()
+        new_frames.reverse()
+        new_trace.reverse()
+        del self.frames[depth:]
+        del self.trace[depth:]
+        for i in range(len(new_frames)):
+            frame = <PyFrameObject*>new_frames[i]
+            self.frame_index[<size_t>frame] = depth + i
+            if frame.f_code.co_flags & _GENERATOR_FLAGS:
+                self.generators.append(depth + i)
+        self.frames.extend(new_frames)
+        self.trace.extend(new_trace)
+        self.shared = depth
+        return self.trace
@@ -0,0 +1,111 @@
+"""
+Deciding which tasks to profile. With first-come-first-served admission,
+a busy, cheap action type can take every slot the overhead controller
+allows, so rarer (and often slower) action types almost never get
+profiled. Stratified admission gives each action type (for WSGI apps,
+each PATH_INFO) a fair share of the slots, and a guaranteed minimum rate
+on top, so every action type gets profiled now and then, however busy
+the others are.
+
+Admission runs on application threads, without a lock. Like the
+profiler's own admission counts, the counts here are racy, but an odd
+extra or missing admission isn't a disaster.
+"""
+
+OTHER_TYPE = '<other>'  # Action types beyond `max_types`
+UNTYPED = '<untyped>'  # Actions that don't have an action_type
+
+
+class Stratum(object):
+    """
+    Admission state and counts for one action type. `tokens` is a bucket,
+    refilled at the admission's minimum rate, holding at most one
+    guaranteed admission.
+    """
+    __slots__ = ['action_type', 'in_flight', 'admitted', 'rejected',
+                 'tokens', 'last_refill']
+
+    def __init__(self, action_type, now):
+        self.action_type = action_type
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.tokens = 1.0
+        self.last_refill = now
+
+
+class Admission(object):
+    """
+    Admits tasks, given their action type, the number of tasks already
+    being profiled, and how many the overhead controller allows.
+
+    When `stratified`, a task is admitted if there's a free slot, and its
+    action type isn't already using more than its fair share of the slots
+    (split evenly between action types with tasks in flight) - or, failing
+    that, if its action type hasn't had `min_rate` admissions a second
+    lately. Otherwise, tasks are admitted first-come-first-served, but
+    still counted by action type. Either way, at most `max_types` action
+    types get their own counts, and any more share one.
+    """
+    __slots__ = ['stratified', 'min_rate', 'max_types', 'strata', 'active']
+
+    def __init__(self, stratified=True, min_rate=0.1, max_types=100):
+        self.stratified = stratified
+        self.min_rate = min_rate
+        self.max_types = max_types
+        self.strata = {}
+        self.active = 0  # Strata with tasks in flight
+
+    def stratum(self, action_type, now):
+        if action_type is None:
+            action_type = UNTYPED
+        stratum = self.strata.get(action_type)
+        if stratum is None:
+            if len(self.strata) >= self.max_types:
+                action_type = OTHER_TYPE
+                stratum = self.strata.get(action_type)
+            if stratum is None:
+                stratum = self.strata.setdefault(
+                    action_type, Stratum(action_type, now))
+        return stratum
+
+    def admit(self, action_type, in_flight, capacity, now):
+        """
+        The Stratum to count a new task against, if it's admitted, or None
+        if not. Capacity None means no limit. `now` is in nanoseconds.
+        """
+        stratum = self.stratum(action_type, now)
+        tokens = stratum.tokens
+        if tokens < 1.0:
+            tokens = min(
+                tokens + (now - stratum.last_refill) * self.min_rate / 1e9, 1.0)
+            stratum.tokens = tokens
+        stratum.last_refill = now
+        if capacity is None:
+            admitted = True
+        elif not self.stratified:
+            admitted = in_flight < capacity
+        else:
+            active = self.active
+            if stratum.in_flight == 0:
+                active += 1
+            admitted = (in_flight < capacity
+                        and stratum.in_flight < max(float(capacity) / active, 1))
+            admitted = admitted or tokens >= 1.0
+        if not admitted:
+            stratum.rejected += 1
+            return None
+        stratum.tokens = max(tokens - 1.0, 0.0)
+        stratum.admitted += 1
+        if stratum.in_flight == 0:
+            self.active += 1
+        stratum.in_flight += 1
+        return stratum
+
+    def release(self, stratum):
+        """
+        An admitted task has finished
+        """
+        stratum.in_flight -= 1
+        if stratum.in_flight == 0:
+            self.active -= 1
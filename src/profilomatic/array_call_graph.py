@@ -0,0 +1,608 @@
+"""
+An alternative call graph engine, that keeps nodes in typed arrays owned by
+a shared NodePool, rather than as individual objects. Nodes from finished
+call graphs are returned to the pool and recycled, so a busy profiler
+makes far fewer allocations, and the garbage collector has far fewer
+objects to traverse.
+"""
+import json
+from array import array
+
+from .budget import coalesce_threshold
+from .clock import to_timedelta
+from .serialize import time_formatter, instruction_encoder, root_fields, \
+    state_seconds
+from .thread_state import STATE_COUNT
+
+_NONE = -1
+
+# Nanosecond times need 64 bits - Python 2 has no 'q' arrays, but its 'l'
+# arrays are 64 bits on 64-bit Linux and macOS
+try:
+    array('q')
+    _NANOSECONDS = 'q'
+except ValueError:
+    _NANOSECONDS = 'l'
+
+_NO_STATE_TIMES = array(_NANOSECONDS, [0] * STATE_COUNT)
+
+# Child index keys are node * _KEY_STRIDE + instruction id + 1 - one int,
+# rather than a tuple to allocate (and for the GC to track) for every frame
+_KEY_STRIDE = 1 << 32
+
+
+class NodePool(object):
+    __slots__ = [
+        "instruction",
+        "parent",
+        "first_child",
+        "last_child",
+        "next_sibling",
+        "current_start",
+        "time",
+        "self_time",
+        "cpu_time",
+        "self_cpu_time",
+        "state_times",
+        "min_monotonic",
+        "max_monotonic",
+        "coalesced",
+        "messages",
+        "child_index",
+        "free",
+        "instructions",
+        "instruction_ids",
+        "instruction_refs",
+        "free_instructions"
+    ]
+
+    def __init__(self):
+        self.instruction = array('l')
+        self.parent = array('l')
+        self.first_child = array('l')
+        self.last_child = array('l')
+        self.next_sibling = array('l')
+        self.current_start = array('l')  # First child still being sampled
+        self.time = array(_NANOSECONDS)
+        self.self_time = array(_NANOSECONDS)
+        self.cpu_time = array(_NANOSECONDS)
+        self.self_cpu_time = array(_NANOSECONDS)
+        # Time in each thread state, STATE_COUNT entries per node
+        self.state_times = array(_NANOSECONDS)
+        self.min_monotonic = array(_NANOSECONDS)
+        self.max_monotonic = array(_NANOSECONDS)
+        self.coalesced = array('l')  # Nodes folded into an "other" node
+        self.messages = {}
+        self.child_index = {}  # Key from parent and instruction -> current child
+        self.free = array('l')
+        self.instructions = []
+        self.instruction_ids = {}
+        # Nodes using each instruction id - ids nothing uses get reused
+        self.instruction_refs = array('l')
+        self.free_instructions = array('l')
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def nodes_in_use(self):
+        return len(self.time) - len(self.free)
+
+    def instruction_id(self, instruction_pointer):
+        if instruction_pointer is None:
+            return _NONE
+        instruction_id = self.instruction_ids.get(instruction_pointer)
+        if instruction_id is None:
+            if self.free_instructions:
+                instruction_id = self.free_instructions.pop()
+                self.instructions[instruction_id] = instruction_pointer
+            else:
+                instruction_id = len(self.instructions)
+                self.instructions.append(instruction_pointer)
+                self.instruction_refs.append(0)
+            self.instruction_ids[instruction_pointer] = instruction_id
+        return instruction_id
+
+    def allocate(self, parent, instruction_id, time, cpu_time, monotime):
+        if self.free:
+            node = self.free.pop()
+            self.instruction[node] = instruction_id
+            self.parent[node] = parent
+            self.first_child[node] = _NONE
+            self.last_child[node] = _NONE
+            self.next_sibling[node] = _NONE
+            self.current_start[node] = _NONE
+            self.time[node] = time
+            self.self_time[node] = 0
+            self.cpu_time[node] = cpu_time
+            self.self_cpu_time[node] = 0
+            start = node * STATE_COUNT
+            self.state_times[start:start + STATE_COUNT] = _NO_STATE_TIMES
+            self.min_monotonic[node] = monotime
+            self.max_monotonic[node] = monotime
+            self.coalesced[node] = 0
+        else:
+            node = len(self.time)
+            self.instruction.append(instruction_id)
+            self.parent.append(parent)
+            self.first_child.append(_NONE)
+            self.last_child.append(_NONE)
+            self.next_sibling.append(_NONE)
+            self.current_start.append(_NONE)
+            self.time.append(time)
+            self.self_time.append(0)
+            self.cpu_time.append(cpu_time)
+            self.self_cpu_time.append(0)
+            self.state_times.extend(_NO_STATE_TIMES)
+            self.min_monotonic.append(monotime)
+            self.max_monotonic.append(monotime)
+            self.coalesced.append(0)
+        if instruction_id != _NONE:
+            self.instruction_refs[instruction_id] += 1
+        if parent != _NONE:
+            last_child = self.last_child[parent]
+            if last_child == _NONE:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[last_child] = node
+            self.last_child[parent] = node
+        return node
+
+    def add_time(self, node, time, cpu_time, monotime):
+        self.time[node] += time
+        self.cpu_time[node] += cpu_time
+        if monotime < self.min_monotonic[node]:
+            self.min_monotonic[node] = monotime
+        if monotime > self.max_monotonic[node]:
+            self.max_monotonic[node] = monotime
+
+    def node_state_times(self, node):
+        # The node's time in each thread state, or None if it has none
+        start = node * STATE_COUNT
+        state_times = self.state_times[start:start + STATE_COUNT]
+        return state_times if any(state_times) else None
+
+    def current_child(self, node, instruction_id, time, cpu_time, monotime):
+        key = node * _KEY_STRIDE + instruction_id + 1
+        child = self.child_index.get(key)
+        if child is not None:
+            self.add_time(child, time, cpu_time, monotime)
+            return child
+        child = self.allocate(node, instruction_id, time, cpu_time, monotime)
+        if self.current_start[node] == _NONE:
+            self.current_start[node] = child
+        self.child_index[key] = child
+        return child
+
+    def archive_children(self, node):
+        child = self.current_start[node]
+        while child != _NONE:
+            del self.child_index[
+                node * _KEY_STRIDE + self.instruction[child] + 1]
+            child = self.next_sibling[child]
+        self.current_start[node] = _NONE
+
+    def set_children(self, node, children, current_start):
+        """
+        Replace a node's list of children. `current_start` must be the first
+        of them still being sampled, or -1.
+        """
+        previous = _NONE
+        for child in children:
+            self.parent[child] = node
+            if previous == _NONE:
+                self.first_child[node] = child
+            else:
+                self.next_sibling[previous] = child
+            previous = child
+        if previous == _NONE:
+            self.first_child[node] = _NONE
+        else:
+            self.next_sibling[previous] = _NONE
+        self.last_child[node] = previous
+        self.current_start[node] = current_start
+
+    def release(self, root):
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if self.current_start[node] != _NONE:
+                self.archive_children(node)
+            self.messages.pop(node, None)
+            instruction_id = self.instruction[node]
+            if instruction_id != _NONE:
+                self._release_instruction(instruction_id)
+            child = self.first_child[node]
+            while child != _NONE:
+                stack.append(child)
+                child = self.next_sibling[child]
+            self.free.append(node)
+
+    def _release_instruction(self, instruction_id):
+        refs = self.instruction_refs[instruction_id] - 1
+        self.instruction_refs[instruction_id] = refs
+        if refs == 0:
+            # Don't keep every instruction ever seen for the life of the pool
+            del self.instruction_ids[self.instructions[instruction_id]]
+            self.instructions[instruction_id] = None
+            self.free_instructions.append(instruction_id)
+
+
+node_pool = NodePool()
+
+
+class ArrayCallGraphRoot(object):
+    __slots__ = [
+        "pool",
+        "root",
+        "thread",
+        "task_uuid",
+        "wall_clock_minus_monotonic",
+        "last_path",
+        "node_count"
+    ]
+
+    # Rough memory cost of a node, for enforcing byte budgets
+    bytes_per_node = 188
+
+    def __init__(self, thread, task_uuid, start_time, start_monotonic, pool=node_pool):
+        self.pool = pool
+        self.root = pool.allocate(_NONE, _NONE, 0, 0, start_monotonic)
+        self.thread = thread
+        self.task_uuid = task_uuid
+        self.wall_clock_minus_monotonic = start_time - to_timedelta(start_monotonic)
+        self.last_path = []
+        self.node_count = 1
+
+    def ingest(self, call_stack, time, monotime, message=None, shared_prefix=0,
+               cpu_time=0, state=None):
+        """
+        Add a sample to the call graph, taking `time` to record, at
+        monotonic time `monotime`, both in integer nanoseconds. If
+        `shared_prefix` is given, the first `shared_prefix` instructions of
+        `call_stack` must match the previous sample ingested, and their
+        nodes are reused without searching. `cpu_time` is the part of
+        `time` the thread spent on the CPU, if known, and `state` the thread
+        state it was in, from `thread_state`, if known.
+        """
+        pool = self.pool
+        last_instruction = None
+        path = self.last_path
+
+        if message is not None:
+            if len(call_stack) > 0:
+                call_stack, last_instruction = call_stack[:-1], call_stack[-1]
+            shared_prefix = 0
+
+        pool.add_time(self.root, time, cpu_time, monotime)
+        if shared_prefix > len(path):
+            shared_prefix = len(path)
+        del path[shared_prefix:]
+        node = self.root
+        for node in path:
+            pool.add_time(node, time, cpu_time, monotime)
+
+        instruction_id = pool.instruction_id
+        # Every new current child gets an entry in the child index
+        index_size = len(pool.child_index)
+        for i in range(shared_prefix, len(call_stack)):
+            node = pool.current_child(
+                node, instruction_id(call_stack[i]), time, cpu_time, monotime)
+            path.append(node)
+        self.node_count += len(pool.child_index) - index_size
+
+        if state is not None:
+            state_times = pool.state_times
+            state_times[self.root * STATE_COUNT + state] += time
+            for path_node in path:
+                state_times[path_node * STATE_COUNT + state] += time
+
+        if message is not None:
+            # Archiving current children invalidates the remembered path
+            del path[:]
+            pool.archive_children(node)
+            node = pool.allocate(
+                node, instruction_id(last_instruction), time, cpu_time, monotime)
+            pool.messages[node] = message
+            if state is not None:
+                pool.state_times[node * STATE_COUNT + state] += time
+            self.node_count += 1
+
+        # Add self time to leaf node
+        pool.self_time[node] += time
+        pool.self_cpu_time[node] += cpu_time
+
+    def _json_head(self, node, format_time, encode_instruction):
+        # The node's JSON, up to where its children would go
+        pool = self.pool
+        text = '{"time": %r, "self_time": %r, "start_time": %s, "end_time": %s' % (
+            pool.time[node] / 1e9, pool.self_time[node] / 1e9,
+            format_time(pool.min_monotonic[node]),
+            format_time(pool.max_monotonic[node]))
+        instruction_id = pool.instruction[node]
+        if instruction_id != _NONE:
+            text += ', "instruction": ' + encode_instruction(
+                pool.instructions[instruction_id])
+        message = pool.messages.get(node)
+        if message is not None:
+            text += ', "message": ' + json.dumps(message)
+        if pool.cpu_time[node]:
+            text += ', "cpu_time": %r, "self_cpu_time": %r' % (
+                pool.cpu_time[node] / 1e9, pool.self_cpu_time[node] / 1e9)
+        state_times = pool.node_state_times(node)
+        if state_times is not None:
+            text += ', "states": ' + json.dumps(state_seconds(state_times))
+        if pool.coalesced[node]:
+            text += ', "coalesced": %d' % pool.coalesced[node]
+        return text
+
+    def _head(self, node, format_time, local_ids):
+        # Everything but the node's children
+        pool = self.pool
+        msg = {
+            'time': pool.time[node] / 1e9,
+            'self_time': pool.self_time[node] / 1e9,
+            'start_time': format_time(pool.min_monotonic[node]),
+            'end_time': format_time(pool.max_monotonic[node])
+        }
+        instruction_id = pool.instruction[node]
+        if instruction_id != _NONE:
+            instruction_pointer = pool.instructions[instruction_id]
+            if local_ids is None:
+                msg['instruction'] = instruction_pointer
+            else:
+                local_id = local_ids.get(instruction_pointer)
+                if local_id is None:
+                    local_id = local_ids[instruction_pointer] = len(local_ids)
+                msg['instruction'] = local_id
+        message = pool.messages.get(node)
+        if message is not None:
+            msg['message'] = message
+        if pool.cpu_time[node]:
+            msg['cpu_time'] = pool.cpu_time[node] / 1e9
+            msg['self_cpu_time'] = pool.self_cpu_time[node] / 1e9
+        state_times = pool.node_state_times(node)
+        if state_times is not None:
+            msg['states'] = state_seconds(state_times)
+        if pool.coalesced[node]:
+            msg['coalesced'] = pool.coalesced[node]
+        return msg
+
+    def jsonize(self, symbol_table=None, time_format='iso'):
+        """
+        Convert the call graph to JSON-compatible dicts. If the call graph
+        holds symbol ids, pass the symbol table they came from, and the
+        output will contain a `symbols` list, with each node's instruction
+        being an index into it. With the 'offset' time format, times are
+        in seconds since the call graph's `base_time`.
+        """
+        pool = self.pool
+        first_child = pool.first_child
+        next_sibling = pool.next_sibling
+        root = self.root
+        base_monotonic = pool.min_monotonic[root]
+        local_ids = {} if symbol_table is not None else None
+        format_time = time_formatter(
+            self.wall_clock_minus_monotonic, base_monotonic, time_format)
+        result = self._head(root, format_time, local_ids)
+        # Each entry is the next child to output, and the list it goes in
+        stack = []
+        if first_child[root] != _NONE:
+            result['children'] = []
+            stack.append([first_child[root], result['children']])
+        while stack:
+            entry = stack[-1]
+            node = entry[0]
+            if node == _NONE:
+                stack.pop()
+                continue
+            entry[0] = next_sibling[node]
+            msg = self._head(node, format_time, local_ids)
+            entry[1].append(msg)
+            if first_child[node] != _NONE:
+                msg['children'] = []
+                stack.append([first_child[node], msg['children']])
+        result.update(root_fields(
+            self.task_uuid, self.thread, self.wall_clock_minus_monotonic,
+            base_monotonic, symbol_table, local_ids, time_format))
+        return result
+
+    def walk(self):
+        """
+        Yield every node in the call graph, parents before children, as
+        (depth, instruction, time, self_time, min_monotonic, max_monotonic,
+        message, coalesced, cpu_time, self_cpu_time, state_times) tuples,
+        starting with the root at depth 0. Times are in nanoseconds, and
+        state_times is a sequence of times indexed by thread state, or None.
+        """
+        pool = self.pool
+        instructions = pool.instructions
+        # Each entry is the next node to yield at that depth
+        stack = [self.root]
+        while stack:
+            node = stack[-1]
+            if node == _NONE:
+                stack.pop()
+                continue
+            stack[-1] = pool.next_sibling[node]
+            instruction_id = pool.instruction[node]
+            yield (len(stack) - 1,
+                   None if instruction_id == _NONE else instructions[instruction_id],
+                   pool.time[node], pool.self_time[node],
+                   pool.min_monotonic[node], pool.max_monotonic[node],
+                   pool.messages.get(node), pool.coalesced[node],
+                   pool.cpu_time[node], pool.self_cpu_time[node],
+                   pool.node_state_times(node))
+            if pool.first_child[node] != _NONE:
+                stack.append(pool.first_child[node])
+
+    def write_json(self, write, symbol_table=None, time_format='iso', extra=None):
+        """
+        Write the same JSON that `jsonize` would give, piece by piece, to
+        the `write` function, without building it as dicts first. `extra`
+        holds any more fields to add to the top level.
+        """
+        pool = self.pool
+        first_child = pool.first_child
+        next_sibling = pool.next_sibling
+        root = self.root
+        base_monotonic = pool.min_monotonic[root]
+        local_ids = {} if symbol_table is not None else None
+        format_time = time_formatter(
+            self.wall_clock_minus_monotonic, base_monotonic, time_format, True)
+        encode_instruction = instruction_encoder(local_ids)
+        head = self._json_head(root, format_time, encode_instruction)
+        # Each entry is the next child to output
+        stack = []
+        if first_child[root] != _NONE:
+            write(head + ', "children": [')
+            stack.append(first_child[root])
+        else:
+            write(head)
+        first = True
+        while stack:
+            node = stack[-1]
+            if node == _NONE:
+                stack.pop()
+                # Close the children, and the node they belong to
+                write(']}' if stack else ']')
+                first = False
+                continue
+            stack[-1] = next_sibling[node]
+            head = self._json_head(node, format_time, encode_instruction)
+            if not first:
+                head = ', ' + head
+            if first_child[node] != _NONE:
+                write(head + ', "children": [')
+                stack.append(first_child[node])
+                first = True
+            else:
+                write(head + '}')
+                first = False
+        fields = root_fields(
+            self.task_uuid, self.thread, self.wall_clock_minus_monotonic,
+            base_monotonic, symbol_table, local_ids, time_format)
+        if extra:
+            fields.update(extra)
+        write(', ' + json.dumps(fields)[1:])
+
+    def coalesce(self, max_nodes):
+        """
+        Fold the coldest subtrees of the call graph into a single "other"
+        node per parent, holding their combined time, until the call graph
+        has no more than `max_nodes` nodes. Messages, and the nodes leading
+        to them, are never folded. Returns the number of nodes removed.
+        """
+        if self.node_count <= max_nodes:
+            return 0
+        pool = self.pool
+        # List nodes breadth first, so each node's children are contiguous
+        nodes = [self.root]
+        parents = [0]
+        child_starts = []
+        i = 0
+        while i < len(nodes):
+            child_starts.append(len(nodes))
+            child = pool.first_child[nodes[i]]
+            while child != _NONE:
+                nodes.append(child)
+                parents.append(i)
+                child = pool.next_sibling[child]
+            i += 1
+        child_starts.append(len(nodes))
+
+        messages = pool.messages
+        pinned = [node in messages for node in nodes]
+        sizes = [pool.coalesced[node] or 1 for node in nodes]
+        for i in range(len(nodes) - 1, 0, -1):
+            if pinned[i]:
+                pinned[parents[i]] = True
+            sizes[parents[i]] += sizes[i]
+        kept = coalesce_threshold(
+            [pool.time[node] for node in nodes], parents, pinned, max_nodes)
+
+        node_count = 0
+        for i, node in enumerate(nodes):
+            if not kept[i]:
+                continue
+            node_count += 1
+            start, end = child_starts[i], child_starts[i + 1]
+            if all(kept[start:end]):
+                continue
+            # Existing "other" nodes get folded into the new one
+            archived = []
+            current = []
+            other = _NONE
+            is_current = False
+            for j in range(start, end):
+                child = nodes[j]
+                if child == pool.current_start[node]:
+                    is_current = True
+                if kept[j] and not pool.coalesced[child]:
+                    if is_current:
+                        current.append(child)
+                    else:
+                        archived.append(child)
+                    continue
+                kept[j] = False
+                if other == _NONE:
+                    other = pool.allocate(
+                        _NONE, _NONE, 0, 0, pool.min_monotonic[child])
+                pool.add_time(other, pool.time[child], pool.cpu_time[child],
+                              pool.min_monotonic[child])
+                pool.add_time(other, 0, 0, pool.max_monotonic[child])
+                for state in range(STATE_COUNT):
+                    pool.state_times[other * STATE_COUNT + state] += \
+                        pool.state_times[child * STATE_COUNT + state]
+                pool.coalesced[other] += sizes[j]
+                if is_current:
+                    del pool.child_index[
+                        node * _KEY_STRIDE + pool.instruction[child] + 1]
+                pool.release(child)
+            pool.self_time[other] = pool.time[other]
+            pool.self_cpu_time[other] = pool.cpu_time[other]
+            archived.append(other)
+            node_count += 1
+            pool.set_children(
+                node, archived + current, current[0] if current else _NONE)
+
+        removed = self.node_count - node_count
+        self.node_count = node_count
+        del self.last_path[:]
+        return removed
+
+    def reset(self, monotime):
+        """
+        Drop all of the call graph's nodes, once they've been emitted as a
+        snapshot, so it only holds samples taken from `monotime` onwards.
+        """
+        pool = self.pool
+        root = self.root
+        if pool.current_start[root] != _NONE:
+            pool.archive_children(root)
+        child = pool.first_child[root]
+        while child != _NONE:
+            next_sibling = pool.next_sibling[child]
+            pool.release(child)
+            child = next_sibling
+        pool.set_children(root, [], _NONE)
+        pool.time[root] = 0
+        pool.self_time[root] = 0
+        pool.cpu_time[root] = 0
+        pool.self_cpu_time[root] = 0
+        start = root * STATE_COUNT
+        pool.state_times[start:start + STATE_COUNT] = _NO_STATE_TIMES
+        pool.min_monotonic[root] = monotime
+        pool.max_monotonic[root] = monotime
+        self.last_path = []
+        self.node_count = 1
+
+    def release(self):
+        """
+        Return this call graph's nodes to the pool. The call graph must not
+        be used afterwards.
+        """
+        if self.root != _NONE:
+            self.pool.release(self.root)
+            self.root = _NONE
+            self.last_path = []
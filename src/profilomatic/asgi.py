@@ -0,0 +1,89 @@
+"""
+ASGI middleware that makes each HTTP request, or websocket connection, a
+profiled task, with the same messages as profilomatic.wsgi, taken from the
+ASGI scope. The task lasts as long as the app's coroutine, so streaming
+responses and websockets are timed until they're finished with. Nothing
+is awaited besides the app itself, and receive and send aren't wrapped.
+Python 3 only.
+"""
+from urllib.parse import parse_qs
+from uuid import uuid4
+
+from .profiler import \
+    TASK_UUID_FIELD, \
+    ACTION_TYPE_FIELD, \
+    ACTION_STATUS_FIELD, \
+    STARTED_STATUS, \
+    SUCCEEDED_STATUS, \
+    FAILED_STATUS
+from . import _instance
+
+TASK_UUID_HEADER = b'x-task-uuid'
+HOST_HEADER = b'host'
+HOST_FIELD = 'host'
+ASGI_TASK_TYPE = 'asgi_task'
+PROFILED_SCOPES = frozenset(['http', 'websocket'])
+
+
+class ProfiledApp(object):
+    def __init__(self, app, profiler=_instance):
+        self.__app = app
+        self.__profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in PROFILED_SCOPES:
+            return await self.__app(scope, receive, send)
+        task_uuid = None
+        host = None
+        for name, value in scope.get('headers', ()):
+            if name == TASK_UUID_HEADER:
+                task_uuid = value.decode('latin-1')
+            elif name == HOST_HEADER:
+                host = value.decode('latin-1')
+        if task_uuid is None:
+            task_uuid = str(uuid4())
+            # Let the app see the task it's part of, as with WSGI. Scopes
+            # are copied rather than changed, as the spec asks
+            scope = dict(scope)
+            scope['headers'] = list(scope.get('headers', ())) + [
+                (TASK_UUID_HEADER, task_uuid.encode('latin-1'))]
+        path = scope.get('path', '')
+        task_type = path or ASGI_TASK_TYPE
+        if host is None:
+            server = scope.get('server')
+            if not server:
+                host = ''
+            elif server[1] is None:  # A unix socket, with no port
+                host = server[0]
+            else:
+                host = '%s:%s' % tuple(server)
+
+        profiler = self.__profiler
+        profiler.handle_message({
+            TASK_UUID_FIELD: task_uuid,
+            ACTION_TYPE_FIELD: task_type,
+            ACTION_STATUS_FIELD: STARTED_STATUS,
+            'query_string': parse_qs(
+                scope.get('query_string', b'').decode('latin-1')),
+            HOST_FIELD: host,
+            'script_name': scope.get('root_path', ''),
+            'path_info': path
+        })
+        try:
+            await self.__app(scope, receive, send)
+        except BaseException:  # Including cancellation, when clients go away
+            profiler.handle_message({
+                TASK_UUID_FIELD: task_uuid,
+                ACTION_TYPE_FIELD: task_type,
+                ACTION_STATUS_FIELD: FAILED_STATUS
+            })
+            raise
+        profiler.handle_message({
+            TASK_UUID_FIELD: task_uuid,
+            ACTION_TYPE_FIELD: task_type,
+            ACTION_STATUS_FIELD: SUCCEEDED_STATUS
+        })
+
+
+def wrap(app):
+    return ProfiledApp(app)
@@ -0,0 +1,410 @@
+"""
+A compact binary format for profiler output, that's much smaller than
+JSON, and can be read back as raw columns without building nested dicts.
+
+A stream starts with MAGIC, followed by one length-prefixed record per call
+graph (MAGIC may appear again between records, if a stream is appended
+to). A record's length is a little-endian 32-bit integer. Its body is made
+of unsigned varints, with values that can be negative zigzag encoded, and
+length-prefixed UTF-8 strings. In order, it holds:
+
+- The string table: its size, then each string
+- The call graph's top-level fields, like task_uuid, thread and source, as
+  a JSON string
+- The call graph's start time: its UTC offset in seconds plus one (or 0
+  if it has no time zone), then microseconds since the epoch, zigzagged
+- The node count, then one column of values per node attribute, with
+  nodes ordered parents before children: depth, instruction (string table
+  index plus one, or 0 for none), time and self time in nanoseconds, start
+  in nanoseconds after the call graph's start (zigzagged), duration in
+  nanoseconds, and the number of nodes coalesced into the node
+- The message count, then each message's node index and JSON string
+- More columns, which records from older versions may not have: CPU time
+  and self CPU time, then the time spent in each thread state, in the
+  order of `thread_state.STATE_NAMES`, all in nanoseconds
+"""
+import datetime
+import json
+import struct
+
+import six
+
+from .clock import to_timedelta
+from .serialize import state_seconds
+from .thread_state import STATE_NAMES
+
+try:
+    utc = datetime.timezone.utc
+except AttributeError:
+    import pytz
+    utc = pytz.utc
+
+MAGIC = b'\xfePM1'
+
+_LENGTH = struct.Struct('<I')
+_EPOCH = datetime.datetime(1970, 1, 1)
+_COLUMNS = ['depth', 'instruction', 'time', 'self_time', 'start', 'duration',
+            'coalesced']
+_STATE_COLUMNS = ['%s_time' % name for name in STATE_NAMES]
+_TRAILING_COLUMNS = ['cpu_time', 'self_cpu_time'] + _STATE_COLUMNS
+_NO_STATE_TIMES = (0,) * len(STATE_NAMES)
+
+
+def _write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _write_string(buf, value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    _write_varint(buf, len(value))
+    buf.extend(value)
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return value >> 1 if not value & 1 else -(value >> 1) - 1
+
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode_call_graph(call_graph, symbol_table=None, fields=None):
+    """
+    Encode a call graph from any of the call graph engines as a binary
+    record, including its length prefix. If the call graph holds symbol
+    ids, pass the symbol table they came from. `fields` holds any more
+    top-level fields to include.
+    """
+    string_indexes = {}
+    strings = []
+    columns = [[] for _ in _COLUMNS]
+    depths, instructions, times, self_times, starts, durations, coalesced = columns
+    trailing_columns = [[] for _ in _TRAILING_COLUMNS]
+    cpu_times, self_cpu_times = trailing_columns[:2]
+    state_columns = trailing_columns[2:]
+    messages = []
+    base_monotonic = None
+    for index, (depth, instruction, time, self_time, min_monotonic,
+                max_monotonic, message, node_coalesced, cpu_time,
+                self_cpu_time, state_times) in enumerate(call_graph.walk()):
+        if base_monotonic is None:
+            base_monotonic = min_monotonic
+        if instruction is None:
+            instructions.append(0)
+        else:
+            if symbol_table is not None:
+                instruction = symbol_table[instruction]
+            string_index = string_indexes.get(instruction)
+            if string_index is None:
+                strings.append(instruction)
+                string_index = string_indexes[instruction] = len(strings)
+            instructions.append(string_index)
+        depths.append(depth)
+        times.append(time)
+        self_times.append(self_time)
+        starts.append(_zigzag(min_monotonic - base_monotonic))
+        durations.append(max_monotonic - min_monotonic)
+        coalesced.append(node_coalesced)
+        cpu_times.append(cpu_time)
+        self_cpu_times.append(self_cpu_time)
+        for column, state_time in zip(state_columns, state_times or _NO_STATE_TIMES):
+            column.append(state_time)
+        if message is not None:
+            messages.append((index, message))
+
+    top_level = {'task_uuid': call_graph.task_uuid, 'thread': call_graph.thread}
+    if fields:
+        top_level.update(fields)
+    start_time = call_graph.wall_clock_minus_monotonic + to_timedelta(base_monotonic)
+
+    buf = bytearray(_LENGTH.size)
+    _write_varint(buf, len(strings))
+    for string in strings:
+        _write_string(buf, string)
+    _write_string(buf, json.dumps(top_level))
+    offset = start_time.utcoffset()
+    if offset is None:
+        _write_varint(buf, 0)
+        _write_varint(buf, _zigzag(_microseconds(start_time - _EPOCH)))
+    else:
+        _write_varint(buf, _zigzag(_microseconds(offset) // 1000000) + 1)
+        _write_varint(buf, _zigzag(_microseconds(
+            start_time.replace(tzinfo=None) - offset - _EPOCH)))
+    _write_varint(buf, len(depths))
+    for column in columns:
+        for value in column:
+            _write_varint(buf, value)
+    _write_varint(buf, len(messages))
+    for index, message in messages:
+        _write_varint(buf, index)
+        _write_string(buf, json.dumps(message))
+    for column in trailing_columns:
+        for value in column:
+            _write_varint(buf, value)
+    _LENGTH.pack_into(buf, 0, len(buf) - _LENGTH.size)
+    return bytes(buf)
+
+
+class _RecordReader(object):
+    __slots__ = ['data', 'position']
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.position = 0
+
+    def varint(self):
+        data = self.data
+        position = self.position
+        result = 0
+        shift = 0
+        while True:
+            byte = data[position]
+            position += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                self.position = position
+                return result
+            shift += 7
+
+    def varints(self, count):
+        data = self.data
+        position = self.position
+        result = []
+        append = result.append
+        for _ in range(count):
+            byte = data[position]
+            position += 1
+            if byte < 0x80:
+                # Most values are small enough for one byte
+                append(byte)
+                continue
+            value = byte & 0x7f
+            shift = 7
+            while True:
+                byte = data[position]
+                position += 1
+                value |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            append(value)
+        self.position = position
+        return result
+
+    def string(self):
+        length = self.varint()
+        start = self.position
+        self.position += length
+        return bytes(self.data[start:self.position]).decode('utf-8')
+
+
+def _timezone(offset_seconds):
+    if offset_seconds == 0:
+        return utc
+    try:
+        return datetime.timezone(datetime.timedelta(seconds=offset_seconds))
+    except AttributeError:
+        return pytz.FixedOffset(offset_seconds // 60)
+
+
+def decode_record(body):
+    """
+    Decode a record's body into its raw parts: a dict holding its
+    `fields`, `start_time`, string table as `strings`, node attribute
+    columns as lists, and `messages` keyed by node index. Times in the
+    columns are integer nanoseconds, and starts are relative to
+    `start_time`.
+    """
+    reader = _RecordReader(body)
+    strings = [reader.string() for _ in range(reader.varint())]
+    result = {'strings': strings, 'fields': json.loads(reader.string())}
+    offset = reader.varint()
+    since_epoch = datetime.timedelta(microseconds=_unzigzag(reader.varint()))
+    if offset == 0:
+        result['start_time'] = _EPOCH + since_epoch
+    else:
+        offset = _unzigzag(offset - 1)
+        result['start_time'] = (
+            _EPOCH + since_epoch + datetime.timedelta(seconds=offset)
+        ).replace(tzinfo=_timezone(offset))
+    node_count = reader.varint()
+    for column in _COLUMNS:
+        result[column] = reader.varints(node_count)
+    result['start'] = [_unzigzag(start) for start in result['start']]
+    messages = result['messages'] = {}
+    for _ in range(reader.varint()):
+        index = reader.varint()
+        messages[index] = json.loads(reader.string())
+    for column in _TRAILING_COLUMNS:
+        if reader.position < len(reader.data):
+            result[column] = reader.varints(node_count)
+        else:
+            result[column] = [0] * node_count
+    return result
+
+
+def to_call_graph(record, time_format='iso'):
+    """
+    Turn a decoded record into the same dicts that the call graph's
+    `jsonize` would have given, with times accurate to the nanosecond (or
+    microsecond for ISO 8601 timestamps).
+    """
+    start_time = record['start_time']
+    strings = record['strings']
+    messages = record['messages']
+    if time_format == 'iso':
+        cache = {}
+
+        def format_time(nanoseconds):
+            formatted = cache.get(nanoseconds)
+            if formatted is None:
+                formatted = cache[nanoseconds] = (
+                    start_time + to_timedelta(nanoseconds)).isoformat()
+            return formatted
+    elif time_format == 'offset':
+        def format_time(nanoseconds):
+            return nanoseconds / 1e9
+    else:
+        raise ValueError('Time format must be iso or offset')
+
+    root = None
+    ancestors = []
+    for index, row in enumerate(six.moves.zip(
+            *[record[column] for column in _COLUMNS + _TRAILING_COLUMNS])):
+        (depth, instruction, time, self_time, start, duration, coalesced,
+         cpu_time, self_cpu_time) = row[:9]
+        state_times = row[9:]
+        node = {
+            'time': time / 1e9,
+            'self_time': self_time / 1e9,
+            'start_time': format_time(start),
+            'end_time': format_time(start + duration)
+        }
+        if instruction:
+            node['instruction'] = strings[instruction - 1]
+        message = messages.get(index)
+        if message is not None:
+            node['message'] = message
+        if cpu_time:
+            node['cpu_time'] = cpu_time / 1e9
+            node['self_cpu_time'] = self_cpu_time / 1e9
+        if any(state_times):
+            node['states'] = state_seconds(state_times)
+        if coalesced:
+            node['coalesced'] = coalesced
+        if depth == 0:
+            root = node
+        else:
+            ancestors[depth - 1].setdefault('children', []).append(node)
+        del ancestors[depth:]
+        ancestors.append(node)
+    if time_format == 'offset':
+        root['base_time'] = start_time.isoformat()
+    root.update(record['fields'])
+    return root
+
+
+class RecordCallGraph(object):
+    """
+    A decoded record, standing in for a call graph from one of the call
+    graph engines, so it can be written to destinations that take call
+    graphs (like BinaryDestination) as well as ones that take dicts.
+    Instructions are already strings, so it needs no symbol table.
+    """
+    def __init__(self, record):
+        self.record = record
+        fields = record['fields']
+        self.task_uuid = fields.get('task_uuid')
+        self.thread = fields.get('thread')
+        # Starts in the record are relative to its start time
+        self.wall_clock_minus_monotonic = record['start_time']
+
+    def walk(self):
+        record = self.record
+        strings = record['strings']
+        messages = record['messages']
+        for index, row in enumerate(six.moves.zip(
+                *[record[column] for column in _COLUMNS + _TRAILING_COLUMNS])):
+            (depth, instruction, time, self_time, start, duration, coalesced,
+             cpu_time, self_cpu_time) = row[:9]
+            yield (depth, strings[instruction - 1] if instruction else None,
+                   time, self_time, start, start + duration,
+                   messages.get(index), coalesced, cpu_time, self_cpu_time,
+                   row[9:])
+
+    def jsonize(self, symbol_table=None, time_format='iso'):
+        return to_call_graph(self.record, time_format)
+
+    def write_json(self, write, symbol_table=None, time_format='iso', extra=None):
+        result = self.jsonize(symbol_table, time_format)
+        if extra:
+            result.update(extra)
+        write(json.dumps(result))
+
+    def release(self):
+        pass
+
+
+def read_records(f):
+    """
+    Read the bodies of the records in a binary stream. Stops at the end of
+    the stream, or at a record cut short by the writer being killed.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a Profilomatic binary stream')
+    while True:
+        header = f.read(_LENGTH.size)
+        if header == MAGIC:
+            continue
+        if len(header) < _LENGTH.size:
+            return
+        length, = _LENGTH.unpack(header)
+        body = f.read(length)
+        if len(body) < length:
+            return
+        yield body
+
+
+def read_call_graphs(f, raw=False, time_format='iso'):
+    """
+    Read the call graphs from a binary stream, one at a time, as the same
+    dicts that `jsonize` would have given, or as the raw records from
+    `decode_record` if `raw` is set.
+    """
+    for body in read_records(f):
+        record = decode_record(body)
+        if raw:
+            yield record
+        else:
+            yield to_call_graph(record, time_format)
+
+
+class BinaryDestination(object):
+    """
+    Writes call graphs from the profiler to a file (or a filename), in the
+    binary format.
+    """
+    def __init__(self, f, flush=True):
+        if isinstance(f, six.string_types):
+            f = open(f, 'ab')
+        self._file = f
+        self._flush = flush
+        f.write(MAGIC)
+
+    def write_call_graph(self, call_graph, symbol_table, time_format, fields):
+        self.write_call_graphs([(call_graph, fields)], symbol_table, time_format)
+
+    def write_call_graphs(self, batch, symbol_table, time_format):
+        self._file.write(b''.join(
+            encode_call_graph(call_graph, symbol_table, fields)
+            for call_graph, fields in batch))
+        if self._flush:
+            self._file.flush()
@@ -0,0 +1,61 @@
+"""
+Helpers for keeping in-flight call graphs within their memory budgets.
+"""
+
+# A call graph over budget is shrunk to this fraction of its budget, so it
+# isn't coalesced again on the very next sample
+COALESCE_TARGET = 0.75
+
+
+def node_limit(max_nodes, max_bytes, bytes_per_node):
+    """
+    Combine a node budget and a byte budget into a single node limit. A
+    budget of 0 means unlimited, as does a return value of 0.
+    """
+    limit = max_nodes
+    if max_bytes:
+        byte_limit = max(1, max_bytes // bytes_per_node)
+        if not limit or byte_limit < limit:
+            limit = byte_limit
+    return limit
+
+
+def coalesce_threshold(times, parents, pinned, max_nodes):
+    """
+    Decide which nodes of a call graph to keep, when folding its coldest
+    subtrees into a single "other" node per parent.
+
+    The call graph is given as lists, in an order where every parent comes
+    before its children, with the root first. Pinned nodes are always kept.
+    Finds the lowest time threshold that brings the graph down to
+    `max_nodes` nodes (or as close as possible), and returns a list saying
+    whether each node is kept.
+    """
+    node_count = len(times)
+
+    def keep(threshold):
+        kept = [True] * node_count
+        for i in range(1, node_count):
+            kept[i] = kept[parents[i]] and (pinned[i] or times[i] >= threshold)
+        return kept
+
+    def count(kept):
+        with_other = set()
+        for i in range(1, node_count):
+            if not kept[i]:
+                parent = parents[i]
+                if kept[parent]:
+                    with_other.add(parent)
+        return sum(kept) + len(with_other)
+
+    thresholds = sorted(set(
+        times[i] for i in range(1, node_count) if not pinned[i]))
+    thresholds.append(float('inf'))
+    low, high = 0, len(thresholds) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if count(keep(thresholds[middle])) <= max_nodes:
+            high = middle
+        else:
+            low = middle + 1
+    return keep(thresholds[low])
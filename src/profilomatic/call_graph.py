@@ -1,58 +1,138 @@
-import datetime
+import json
+from itertools import chain
+
+from .budget import coalesce_threshold
+from .clock import to_timedelta
+from .serialize import time_formatter, instruction_encoder, root_fields, \
+    state_seconds
+from .thread_state import STATE_COUNT
+
+# Nodes with more current children than this get a hash index on them
+CHILD_INDEX_THRESHOLD = 8
+
 
 class _CallGraphNode(object):
     __slots__ = [
         "instruction_pointer",
         "time",
         "self_time",
+        "cpu_time",
+        "self_cpu_time",
+        "state_times",
         "min_monotonic",
         "max_monotonic",
         "archived_children",
         "current_children",
-        "message"
+        "child_index",
+        "message",
+        "coalesced"
     ]
 
 
     def __init__(self,
                  instruction_pointer,
                  time,
-                 self_time,
+                 cpu_time,
                  min_monotonic,
                  max_monotonic):
         self.instruction_pointer = instruction_pointer
         self.time = time
-        self.self_time = self_time
+        self.self_time = 0
+        self.cpu_time = cpu_time
+        self.self_cpu_time = 0
+        self.state_times = None  # Time in each thread state, once there is some
         self.min_monotonic = min_monotonic
         self.max_monotonic = max_monotonic
         self.archived_children = []
         self.current_children = []
+        self.child_index = None
         self.message = None
+        self.coalesced = 0  # Number of nodes folded into this "other" node
 
-    def add_time(self, time, monotime):
+    def add_time(self, time, cpu_time, monotime):
         self.time += time
+        self.cpu_time += cpu_time
         if monotime < self.min_monotonic:
             self.min_monotonic = monotime
         if monotime > self.max_monotonic:
             self.max_monotonic = monotime
 
-    def _jsonize(self, wall_clock_minus_monotonic):
+    def _add_state_time(self, state, time):
+        state_times = self.state_times
+        if state_times is None:
+            state_times = self.state_times = [0] * STATE_COUNT
+        state_times[state] += time
+
+    def _current_child(self, instruction_pointer, time, cpu_time, monotime):
+        child_index = self.child_index
+        if child_index is not None:
+            child = child_index.get(instruction_pointer)
+            if child is not None:
+                child.add_time(time, cpu_time, monotime)
+                return child
+        else:
+            for child in self.current_children:
+                if child.instruction_pointer == instruction_pointer:
+                    child.add_time(time, cpu_time, monotime)
+                    return child
+        child = _CallGraphNode(instruction_pointer, time, cpu_time, monotime, monotime)
+        self.current_children.append(child)
+        if child_index is not None:
+            child_index[instruction_pointer] = child
+        elif len(self.current_children) > CHILD_INDEX_THRESHOLD:
+            self.child_index = dict(
+                (node.instruction_pointer, node)
+                for node in self.current_children)
+        return child
+
+    def _archive_children(self):
+        self.archived_children.extend(self.current_children)
+        self.current_children = []
+        self.child_index = None
+
+    def _json_head(self, format_time, encode_instruction):
+        # The node's JSON, up to where its children would go
+        text = '{"time": %r, "self_time": %r, "start_time": %s, "end_time": %s' % (
+            self.time / 1e9, self.self_time / 1e9,
+            format_time(self.min_monotonic), format_time(self.max_monotonic))
+        if self.instruction_pointer is not None:
+            text += ', "instruction": ' + encode_instruction(self.instruction_pointer)
+        if self.message is not None:
+            text += ', "message": ' + json.dumps(self.message)
+        if self.cpu_time:
+            text += ', "cpu_time": %r, "self_cpu_time": %r' % (
+                self.cpu_time / 1e9, self.self_cpu_time / 1e9)
+        if self.state_times is not None:
+            text += ', "states": ' + json.dumps(state_seconds(self.state_times))
+        if self.coalesced:
+            text += ', "coalesced": %d' % self.coalesced
+        return text
+
+    def _head(self, format_time, local_ids):
+        # Everything but the node's children
         msg = {
-            'time': self.time,
-            'self_time': self.self_time,
-            'start_time': (wall_clock_minus_monotonic + datetime.timedelta(
-                seconds=self.min_monotonic)).isoformat(),
-            'end_time': (wall_clock_minus_monotonic + datetime.timedelta(
-                seconds=self.max_monotonic)).isoformat()
+            'time': self.time / 1e9,
+            'self_time': self.self_time / 1e9,
+            'start_time': format_time(self.min_monotonic),
+            'end_time': format_time(self.max_monotonic)
         }
-        if self.archived_children or self.current_children:
-            msg['children'] = [
-                node._jsonize(wall_clock_minus_monotonic)
-                for node in self.archived_children + self.current_children
-            ]
         if self.instruction_pointer is not None:
-            msg['instruction'] = self.instruction_pointer
+            if local_ids is None:
+                msg['instruction'] = self.instruction_pointer
+            else:
+                local_id = local_ids.get(self.instruction_pointer)
+                if local_id is None:
+                    local_id = local_ids[self.instruction_pointer] = len(local_ids)
+                msg['instruction'] = local_id
         if self.message is not None:
             msg['message'] = self.message
+        if self.cpu_time:
+            msg['cpu_time'] = self.cpu_time / 1e9
+            msg['self_cpu_time'] = self.self_cpu_time / 1e9
+        if self.state_times is not None:
+            msg['states'] = state_seconds(self.state_times)
+        if self.coalesced:
+            msg['coalesced'] = self.coalesced
         return msg
 
 
@@ -60,49 +140,282 @@ class CallGraphRoot(_CallGraphNode):
     __slots__ = [
         "thread",
         "task_uuid",
-        "wall_clock_minus_monotonic"
+        "wall_clock_minus_monotonic",
+        "last_path",
+        "node_count"
     ]
 
+    # Rough memory cost of a node, for enforcing byte budgets
+    bytes_per_node = 330
+
     def __init__(self, thread, task_uuid, start_time, start_monotonic):
-        _CallGraphNode.__init__(self, None, 0.0, 0.0, start_monotonic, start_monotonic)
+        _CallGraphNode.__init__(self, None, 0, 0, start_monotonic, start_monotonic)
         self.thread = thread
         self.task_uuid = task_uuid
-        self.wall_clock_minus_monotonic = (
-            start_time - datetime.timedelta(seconds=start_monotonic))
+        self.wall_clock_minus_monotonic = start_time - to_timedelta(start_monotonic)
+        self.last_path = []
+        self.node_count = 1
 
-    def ingest(self, call_stack, time, monotime, message=None):
+    def ingest(self, call_stack, time, monotime, message=None, shared_prefix=0,
+               cpu_time=0, state=None):
+        """
+        Add a sample to the call graph, taking `time` to record, at
+        monotonic time `monotime`, both in integer nanoseconds. If
+        `shared_prefix` is given, the first `shared_prefix` instructions of
+        `call_stack` must match the previous sample ingested, and their
+        nodes are reused without searching. `cpu_time` is the part of
+        `time` the thread spent on the CPU, if known, and `state` the thread
+        state it was in, from `thread_state`, if known.
+        """
         last_instruction = None
         node = self
+        path = self.last_path
 
         if message is not None:
             if len(call_stack) > 0:
                 call_stack, last_instruction = call_stack[:-1], call_stack[-1]
+            shared_prefix = 0
 
-        self.add_time(time, monotime)
-        for instruction_pointer in call_stack:
-            for child in node.current_children:
-                if child.instruction_pointer == instruction_pointer:
-                    node = child
-                    node.add_time(time, monotime)
-                    break
-            else:
-                new_node = _CallGraphNode(instruction_pointer, time, 0.0, monotime, monotime)
-                node.current_children.append(new_node)
-                node = new_node
+        self.add_time(time, cpu_time, monotime)
+        if shared_prefix > len(path):
+            shared_prefix = len(path)
+        del path[shared_prefix:]
+        for node in path:
+            node.add_time(time, cpu_time, monotime)
+        if not path:
+            node = self
+
+        for i in range(shared_prefix, len(call_stack)):
+            children = node.current_children
+            child_count = len(children)
+            node = node._current_child(call_stack[i], time, cpu_time, monotime)
+            path.append(node)
+            if len(children) != child_count:
+                self.node_count += 1
+
+        if state is not None and time:
+            self._add_state_time(state, time)
+            for node in path:
+                node._add_state_time(state, time)
 
         if message is not None:
-            node.archived_children.extend(node.current_children)
-            new_node = _CallGraphNode(last_instruction, time, 0.0, monotime, monotime)
+            # Archiving current children invalidates the remembered path
+            del path[:]
+            node._archive_children()
+            new_node = _CallGraphNode(last_instruction, time, cpu_time, monotime, monotime)
             new_node.message = message
+            if state is not None and time:
+                new_node._add_state_time(state, time)
             node.archived_children.append(new_node)
-            node.current_children = []
             node = new_node
+            self.node_count += 1
 
         # Add self time to leaf node
         node.self_time += time
+        node.self_cpu_time += cpu_time
 
-    def jsonize(self):
-        result = self._jsonize(self.wall_clock_minus_monotonic)
-        result['task_uuid'] = self.task_uuid
-        result['thread'] = self.thread
+    def jsonize(self, symbol_table=None, time_format='iso'):
+        """
+        Convert the call graph to JSON-compatible dicts. If the call graph
+        holds symbol ids, pass the symbol table they came from, and the
+        output will contain a `symbols` list, with each node's instruction
+        being an index into it. With the 'offset' time format, times are
+        in seconds since the call graph's `base_time`.
+        """
+        local_ids = {} if symbol_table is not None else None
+        format_time = time_formatter(
+            self.wall_clock_minus_monotonic, self.min_monotonic, time_format)
+        result = self._head(format_time, local_ids)
+        stack = []
+        if self.archived_children or self.current_children:
+            result['children'] = []
+            stack.append((chain(self.archived_children, self.current_children),
+                          result['children']))
+        while stack:
+            children, output = stack[-1]
+            node = next(children, None)
+            if node is None:
+                stack.pop()
+                continue
+            msg = node._head(format_time, local_ids)
+            output.append(msg)
+            if node.archived_children or node.current_children:
+                msg['children'] = []
+                stack.append((chain(node.archived_children, node.current_children),
+                              msg['children']))
+        result.update(root_fields(
+            self.task_uuid, self.thread, self.wall_clock_minus_monotonic,
+            self.min_monotonic, symbol_table, local_ids, time_format))
         return result
+
+    def walk(self):
+        """
+        Yield every node in the call graph, parents before children, as
+        (depth, instruction, time, self_time, min_monotonic, max_monotonic,
+        message, coalesced, cpu_time, self_cpu_time, state_times) tuples,
+        starting with the root at depth 0. Times are in nanoseconds, and
+        state_times is a sequence of times indexed by thread state, or None.
+        """
+        stack = [iter((self,))]
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                continue
+            yield (len(stack) - 1, node.instruction_pointer, node.time,
+                   node.self_time, node.min_monotonic, node.max_monotonic,
+                   node.message, node.coalesced, node.cpu_time,
+                   node.self_cpu_time, node.state_times)
+            if node.archived_children or node.current_children:
+                stack.append(chain(node.archived_children, node.current_children))
+
+    def write_json(self, write, symbol_table=None, time_format='iso', extra=None):
+        """
+        Write the same JSON that `jsonize` would give, piece by piece, to
+        the `write` function, without building it as dicts first. `extra`
+        holds any more fields to add to the top level.
+        """
+        local_ids = {} if symbol_table is not None else None
+        format_time = time_formatter(
+            self.wall_clock_minus_monotonic, self.min_monotonic, time_format, True)
+        encode_instruction = instruction_encoder(local_ids)
+        head = self._json_head(format_time, encode_instruction)
+        stack = []
+        if self.archived_children or self.current_children:
+            write(head + ', "children": [')
+            stack.append(chain(self.archived_children, self.current_children))
+        else:
+            write(head)
+        first = True
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                # Close the children, and the node they belong to
+                write(']}' if stack else ']')
+                first = False
+                continue
+            head = node._json_head(format_time, encode_instruction)
+            if not first:
+                head = ', ' + head
+            if node.archived_children or node.current_children:
+                write(head + ', "children": [')
+                stack.append(chain(node.archived_children, node.current_children))
+                first = True
+            else:
+                write(head + '}')
+                first = False
+        fields = root_fields(
+            self.task_uuid, self.thread, self.wall_clock_minus_monotonic,
+            self.min_monotonic, symbol_table, local_ids, time_format)
+        if extra:
+            fields.update(extra)
+        write(', ' + json.dumps(fields)[1:])
+
+    def coalesce(self, max_nodes):
+        """
+        Fold the coldest subtrees of the call graph into a single "other"
+        node per parent, holding their combined time, until the call graph
+        has no more than `max_nodes` nodes. Messages, and the nodes leading
+        to them, are never folded. Returns the number of nodes removed.
+        """
+        if self.node_count <= max_nodes:
+            return 0
+        # List nodes breadth first, so each node's children are contiguous
+        nodes = [self]
+        parents = [0]
+        child_starts = []
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            child_starts.append(len(nodes))
+            for child in node.archived_children:
+                nodes.append(child)
+                parents.append(i)
+            for child in node.current_children:
+                nodes.append(child)
+                parents.append(i)
+            i += 1
+        child_starts.append(len(nodes))
+
+        pinned = [node.message is not None for node in nodes]
+        sizes = [node.coalesced or 1 for node in nodes]
+        for i in range(len(nodes) - 1, 0, -1):
+            if pinned[i]:
+                pinned[parents[i]] = True
+            sizes[parents[i]] += sizes[i]
+        kept = coalesce_threshold(
+            [node.time for node in nodes], parents, pinned, max_nodes)
+
+        node_count = 0
+        for i, node in enumerate(nodes):
+            if not kept[i]:
+                continue
+            node_count += 1
+            start, end = child_starts[i], child_starts[i + 1]
+            if all(kept[start:end]):
+                continue
+            # Existing "other" nodes get folded into the new one
+            archived_count = len(node.archived_children)
+            archived = []
+            current = []
+            other = None
+            for j in range(start, end):
+                child = nodes[j]
+                if kept[j] and not child.coalesced:
+                    if j - start < archived_count:
+                        archived.append(child)
+                    else:
+                        current.append(child)
+                    continue
+                kept[j] = False
+                if other is None:
+                    other = _CallGraphNode(
+                        None, 0, 0, child.min_monotonic, child.max_monotonic)
+                other.add_time(child.time, child.cpu_time, child.min_monotonic)
+                other.add_time(0, 0, child.max_monotonic)
+                if child.state_times is not None:
+                    for state, time in enumerate(child.state_times):
+                        other._add_state_time(state, time)
+                other.coalesced += sizes[j]
+            other.self_time = other.time
+            other.self_cpu_time = other.cpu_time
+            archived.append(other)
+            node_count += 1
+            node.archived_children = archived
+            node.current_children = current
+            if len(current) > CHILD_INDEX_THRESHOLD:
+                node.child_index = dict(
+                    (child.instruction_pointer, child) for child in current)
+            else:
+                node.child_index = None
+
+        removed = self.node_count - node_count
+        self.node_count = node_count
+        del self.last_path[:]
+        return removed
+
+    def reset(self, monotime):
+        """
+        Drop all of the call graph's nodes, once they've been emitted as a
+        snapshot, so it only holds samples taken from `monotime` onwards.
+        """
+        self.time = 0
+        self.self_time = 0
+        self.cpu_time = 0
+        self.self_cpu_time = 0
+        self.state_times = None
+        self.min_monotonic = monotime
+        self.max_monotonic = monotime
+        self.release()
+        self.node_count = 1
+
+    def release(self):
+        """
+        Drop this call graph's nodes. The call graph must not be used
+        afterwards.
+        """
+        self.archived_children = []
+        self.current_children = []
+        self.child_index = None
+        self.last_path = []
@@ -0,0 +1,169 @@
+"""
+Integer nanosecond clocks. Call graphs store every time and timestamp as
+an integer number of nanoseconds, which keeps full resolution however long
+the process has been up, where a float of seconds slowly loses it.
+
+There are three clocks to choose from:
+
+- 'coarse': CLOCK_MONOTONIC_COARSE, on Linux. The cheapest to read, but it
+  only ticks every few milliseconds. Elsewhere, the same as 'fine'.
+- 'fine': CLOCK_MONOTONIC, which ticks every nanosecond or so.
+- 'thread_cpu': the CPU time used by the calling thread. It isn't shared
+  between threads, so it can only measure work, not timestamp samples.
+
+The C versions, from the fast_monotonic extension, are used if they've
+been built.
+
+    python -m profilomatic.clock
+
+reports each clock's resolution and read cost on this machine.
+"""
+from __future__ import print_function
+import datetime
+import sys
+import time
+
+NS_PER_SECOND = 1000000000
+
+CLOCKS = ('coarse', 'fine', 'thread_cpu')
+TIMESTAMP_CLOCKS = ('coarse', 'fine')
+
+# The time module doesn't always define this
+_LINUX_CLOCK_MONOTONIC_COARSE = 6
+
+
+def _python_clocks():
+    clocks = {}
+    if hasattr(time, 'monotonic_ns'):  # Python 3.7+
+        clocks['fine'] = time.monotonic_ns
+        clocks['thread_cpu'] = getattr(time, 'thread_time_ns', None)
+        coarse = getattr(time, 'CLOCK_MONOTONIC_COARSE', None)
+        if coarse is None and sys.platform.startswith('linux'):
+            coarse = _LINUX_CLOCK_MONOTONIC_COARSE
+        if coarse is not None:
+            clock_gettime_ns = time.clock_gettime_ns
+
+            def coarse_ns():
+                return clock_gettime_ns(coarse)
+            clocks['coarse'] = coarse_ns
+    else:
+        try:
+            from time import monotonic
+        except ImportError:  # Python 2
+            from monotonic import monotonic
+
+        def fine_ns():
+            return int(monotonic() * NS_PER_SECOND)
+        clocks['fine'] = fine_ns
+        thread_cpu = getattr(time, 'CLOCK_THREAD_CPUTIME_ID', None)
+        if thread_cpu is not None:
+            clock_gettime = time.clock_gettime
+
+            def thread_cpu_ns():
+                return int(clock_gettime(thread_cpu) * NS_PER_SECOND)
+            clocks['thread_cpu'] = thread_cpu_ns
+    clocks.setdefault('coarse', clocks['fine'])
+    return clocks
+
+
+try:
+    from .fast_monotonic import coarse_ns, fine_ns, thread_cpu_ns
+    coarse_ns()  # Check it actually works
+    _clocks = {'coarse': coarse_ns, 'fine': fine_ns, 'thread_cpu': thread_cpu_ns}
+except (ImportError, OSError):
+    _clocks = _python_clocks()
+
+
+def clock_ns(name):
+    """
+    The function that reads the named clock, in integer nanoseconds
+    """
+    if name not in CLOCKS:
+        raise ValueError('Clock must be coarse, fine or thread_cpu')
+    clock = _clocks.get(name)
+    if clock is None:
+        raise ValueError('The %s clock is not available here' % name)
+    return clock
+
+
+def thread_cpu_reader(thread):
+    """
+    A function that reads the CPU time used by another thread, given its
+    ident, in integer nanoseconds, or None if that isn't possible here
+    (it needs Python 3.7+, on a Unix that has thread CPU clocks). The
+    function raises OSError once the thread has finished.
+    """
+    try:
+        clock_id = time.pthread_getcpuclockid(thread)
+    except (AttributeError, OSError, OverflowError):
+        return None
+    clock_gettime_ns = time.clock_gettime_ns
+
+    def read():
+        return clock_gettime_ns(clock_id)
+    return read
+
+
+_fine_ns = _clocks['fine']
+
+
+def monotonic():
+    """
+    The fine clock, in float seconds, for timeouts and intervals that
+    don't end up in call graphs
+    """
+    return _fine_ns() / 1e9
+
+
+def to_nanoseconds(seconds):
+    return int(round(seconds * NS_PER_SECOND))
+
+
+def to_timedelta(nanoseconds):
+    """
+    A timedelta for a nanosecond count, rounded down to the microsecond
+    """
+    return datetime.timedelta(microseconds=nanoseconds // 1000)
+
+
+def _resolution(clock, max_ns):
+    # The smallest step seen between successive readings that differ
+    deadline = _fine_ns() + max_ns
+    smallest = None
+    for _ in range(5):
+        start = clock()
+        now = clock()
+        while now == start and _fine_ns() < deadline:
+            now = clock()
+        if now != start and (smallest is None or now - start < smallest):
+            smallest = now - start
+    return smallest
+
+
+def calibrate(reads=10000, max_ns=50000000):
+    """
+    Measure each available clock, returning a dict mapping its name to its
+    `resolution` and `read_cost`, in nanoseconds. The resolution is None if
+    the clock didn't tick within `max_ns`.
+    """
+    results = {}
+    for name in CLOCKS:
+        clock = _clocks.get(name)
+        if clock is None:
+            continue
+        start = _fine_ns()
+        for _ in range(reads):
+            clock()
+        read_cost = (_fine_ns() - start) // reads
+        results[name] = {
+            'resolution': _resolution(clock, max_ns),
+            'read_cost': read_cost
+        }
+    return results
+
+
+if __name__ == '__main__':
+    print('%-12s %16s %16s' % ('clock', 'resolution ns', 'read cost ns'))
+    for name, result in sorted(calibrate().items()):
+        print('%-12s %16s %16d' % (
+            name, result['resolution'], result['read_cost']))
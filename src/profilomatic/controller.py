@@ -0,0 +1,169 @@
+"""
+Controllers that keep the profiler's overhead within its `max_overhead`
+budget. After each sample, the profiler tells its controller how much
+wall-clock time the sample covered, how much CPU time the profiler thread
+spent on it, how much time the profiling hooks cost application threads
+over the same period, and how many tasks were being profiled. The
+controller replies with the interval to wait until the next sample, and
+how many tasks may be profiled at once.
+
+There are two controllers:
+
+- 'pi': a proportional-integral controller, working from smoothed
+  overhead measurements, that tunes the sampling interval and admission
+  separately (see PIController)
+- 'fixed': samples every `time_granularity` seconds, and admits
+  `simultaneous_tasks_profiled` tasks, whatever the overhead
+
+Anything else with the same `update` method can be plugged in, by passing
+a function that builds it, given the target overhead, time granularity
+and number of tasks to profile, as the profiler's `overhead_controller`.
+
+`simulate` runs a controller against a simple model of an application,
+so its behaviour can be tested without real load.
+"""
+import math
+
+
+class FixedController(object):
+    """
+    Samples at a fixed interval, and admits a fixed number of tasks
+    """
+    __slots__ = ['interval', 'admission']
+
+    def __init__(self, target, interval, admission):
+        self.interval = interval
+        self.admission = admission
+
+    def update(self, elapsed, profiler_cost, hook_cost, tasks):
+        return self.interval, self.admission
+
+
+class PIController(object):
+    """
+    Tunes the sampling interval and admission with two proportional-
+    integral loops, fed by exponentially smoothed overhead fractions, so
+    a single slow sample or burst of messages doesn't make it swing.
+
+    The sampling loop keeps the profiler thread's overhead within whatever
+    the hooks leave of the target (but at least `min_sampling_share` of
+    it), by stretching the interval up to `max_interval_scale` times the
+    time granularity. The admission loop keeps the total overhead at the
+    target, by scaling the number of tasks admitted between 1 and
+    `max_admission_scale` times the number asked for. Admission only grows
+    while it's what limits the tasks profiled, so a quiet spell doesn't
+    leave it wide open for the next burst, and while sampling is at full
+    granularity, so a tight budget goes on sampling finely, rather than
+    thinly over more tasks.
+
+    Both loops work on the logarithm of their output, with errors
+    relative to their budget, so the same gains suit any target.
+    """
+    __slots__ = ['target', 'granularity', 'base_admission', 'kp', 'ki',
+                 'smoothing', 'min_sampling_share', 'max_log_interval',
+                 'min_log_admission', 'max_log_admission',
+                 'profiler_overhead', 'hook_overhead', 'interval_integral',
+                 'admission_integral', 'interval', 'admission']
+
+    def __init__(self, target, interval, admission, kp=0.5, ki=0.15,
+                 smoothing=0.3, min_sampling_share=0.25,
+                 max_interval_scale=100.0, max_admission_scale=10.0):
+        self.target = target
+        self.granularity = interval
+        self.base_admission = max(admission, 1)
+        self.kp = kp
+        self.ki = ki
+        self.smoothing = smoothing
+        self.min_sampling_share = min_sampling_share
+        self.max_log_interval = math.log(max_interval_scale)
+        self.min_log_admission = -math.log(self.base_admission)
+        self.max_log_admission = math.log(max_admission_scale)
+        self.profiler_overhead = 0.0  # Smoothed fractions of elapsed time
+        self.hook_overhead = 0.0
+        self.interval_integral = 0.0
+        self.admission_integral = 0.0
+        self.interval = interval
+        self.admission = admission
+
+    def update(self, elapsed, profiler_cost, hook_cost, tasks):
+        """
+        Take a sample's measurements, in seconds, and the number of tasks
+        profiled, and return the interval to the next sample, in seconds,
+        and the number of tasks to admit
+        """
+        if elapsed <= 0 or self.target <= 0:
+            return self.interval, self.admission
+        smoothing = self.smoothing
+        self.profiler_overhead += smoothing * (
+            profiler_cost / elapsed - self.profiler_overhead)
+        self.hook_overhead += smoothing * (
+            hook_cost / elapsed - self.hook_overhead)
+
+        # Positive errors mean over budget
+        sampling_budget = max(self.target - self.hook_overhead,
+                              self.target * self.min_sampling_share)
+        error = _clamp(self.profiler_overhead / sampling_budget - 1.0, -1.0, 4.0)
+        self.interval_integral = _clamp(
+            self.interval_integral + self.ki * error, 0.0, self.max_log_interval)
+        log_interval = _clamp(self.kp * error + self.interval_integral,
+                              0.0, self.max_log_interval)
+        self.interval = self.granularity * math.exp(log_interval)
+
+        total = self.profiler_overhead + self.hook_overhead
+        error = _clamp(total / self.target - 1.0, -1.0, 4.0)
+        if error > 0 or (log_interval == 0 and tasks + 1 >= self.admission):
+            self.admission_integral = _clamp(
+                self.admission_integral - self.ki * error,
+                self.min_log_admission, self.max_log_admission)
+        log_admission = _clamp(self.admission_integral - self.kp * error,
+                               self.min_log_admission, self.max_log_admission)
+        self.admission = self.base_admission * math.exp(log_admission)
+        return self.interval, self.admission
+
+
+def _clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+_CONTROLLERS = {
+    'pi': PIController,
+    'fixed': FixedController,
+}
+
+
+def lookup_controller(controller):
+    """
+    The function that builds the named controller, or `controller` itself
+    if it's already such a function
+    """
+    if callable(controller):
+        return controller
+    try:
+        return _CONTROLLERS[controller]
+    except KeyError:
+        raise ValueError('Overhead controller must be pi or fixed')
+
+
+def simulate(controller, demand, sample_cost, hook_cost, fixed_cost=0.0):
+    """
+    Run a controller against a model application, returning a list of
+    (interval, admission, tasks, overhead) tuples, one per sample.
+
+    `demand` gives the number of tasks the application has running at each
+    sample, of which up to the controller's admission get profiled. Each
+    sample costs the profiler thread `fixed_cost`, plus `sample_cost` per
+    profiled task, and each profiled task costs its application thread
+    `hook_cost` per second. Everything is in seconds, and nothing depends
+    on the real clock, so results are repeatable.
+    """
+    interval, admission = controller.update(0.0, 0.0, 0.0, 0)
+    results = []
+    for tasks in demand:
+        tasks = min(tasks, int(admission))
+        profiler_cost = fixed_cost + tasks * sample_cost
+        hooks = tasks * hook_cost * interval
+        overhead = (profiler_cost + hooks) / interval
+        results.append((interval, admission, tasks, overhead))
+        interval, admission = controller.update(
+            interval, profiler_cost, hooks, tasks)
+    return results
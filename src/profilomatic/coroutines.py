@@ -0,0 +1,221 @@
+"""
+Profiling asyncio Tasks. Many Tasks can share one thread, so the profiler
+works in terms of "units" - either a thread (by its ident) or an asyncio
+Task - rather than threads:
+
+- Action state lives in an ActionContext, which keeps it in a context
+  variable, so each Task gets its own, where threading.local would have
+  them all share their thread's.
+- `running_task` is the Task whose actions should be profiled by Task,
+  rather than by thread, if any.
+- A TaskStackTrace samples a Task's stack. While the Task is running,
+  that's its thread's stack, from the Task's coroutine up. While it's
+  suspended, it's the chain of coroutines it's awaiting, found through
+  `cr_await`. RunningTasks says which Tasks are running, asking each
+  event loop once per sample, so only the running Task's thread stack
+  is walked.
+
+Without contextvars and `asyncio.current_task` (before Python 3.7),
+everything works by thread, as before.
+"""
+import threading
+
+try:
+    from contextvars import ContextVar
+    from asyncio import current_task
+except ImportError:
+    ContextVar = None
+    current_task = None
+
+try:
+    from ._stack_trace import symbol_cache
+except ImportError:
+    from .stack_trace import symbol_cache
+
+
+class _ActionState(object):
+    """
+    Attributes for the action in progress, set by the profiler
+    """
+
+
+class ActionContext(object):
+    """
+    Holds the state of the action in progress, if any, for the calling
+    thread or Task. `new` has to be used at the start of each top-level
+    action, as a Task's context starts out as a copy of whichever created
+    it, state and all - so a Task that starts actions of its own has to
+    make new state for them too, rather than change the state it shares.
+    """
+    __slots__ = ['var', 'local']
+
+    def __init__(self):
+        if ContextVar is not None:
+            self.var = ContextVar('profilomatic_action', default=None)
+        else:
+            self.var = None
+            self.local = threading.local()
+
+    def get(self):
+        if self.var is not None:
+            return self.var.get()
+        return getattr(self.local, 'state', None)
+
+    def new(self):
+        state = _ActionState()
+        if self.var is not None:
+            self.var.set(state)
+        else:
+            self.local.state = state
+        return state
+
+    def set(self, state):
+        if self.var is not None:
+            self.var.set(state)
+        else:
+            self.local.state = state
+
+    def clear(self):
+        self.set(None)
+
+
+def running_task():
+    """
+    The running asyncio Task, or None if there isn't one
+    """
+    if current_task is None:
+        return None
+    try:
+        return current_task()
+    except RuntimeError:  # No running event loop
+        return None
+
+
+def is_thread(unit):
+    return not hasattr(unit, 'get_stack')
+
+
+def _task_loop(task):
+    get_loop = getattr(task, 'get_loop', None)
+    if get_loop is not None:
+        return get_loop()
+    return task._loop  # Before Python 3.8
+
+
+class RunningTasks(object):
+    """
+    Which Tasks are running, for one sample. Each event loop is asked for
+    its current Task at most once.
+    """
+    __slots__ = ['tasks']
+
+    def __init__(self):
+        self.tasks = {}  # By event loop
+
+    def is_running(self, task):
+        if current_task is None:
+            return False
+        loop = _task_loop(task)
+        try:
+            running = self.tasks[loop]
+        except KeyError:
+            running = self.tasks[loop] = current_task(loop)
+        return running is task
+
+
+def outermost_frame(task):
+    """
+    The frame of a Task's own coroutine - where its stack starts, and any
+    stack captured while it's running should stop
+    """
+    frame, _ = _awaited(_coroutine(task))
+    return frame
+
+
+def _coroutine(task):
+    get_coro = getattr(task, 'get_coro', None)
+    if get_coro is not None:
+        return get_coro()
+    return getattr(task, '_coro', None)  # Before Python 3.8
+
+
+def _awaited(coro):
+    """
+    A coroutine or generator's frame, and what it's waiting on
+    """
+    frame = getattr(coro, 'cr_frame', None)
+    if frame is not None:
+        return frame, coro.cr_await
+    frame = getattr(coro, 'gi_frame', None)
+    if frame is not None:
+        return frame, coro.gi_yieldfrom
+    frame = getattr(coro, 'ag_frame', None)
+    if frame is not None:
+        return frame, coro.ag_await
+    return None, None
+
+
+class TaskStackTrace(object):
+    """
+    Samples an asyncio Task's stack, with the same interface as
+    IncrementalStackTrace, given its thread's current frame. The thread's
+    stack is only searched for the Task's coroutine if `running` is passed
+    as true - otherwise the Task is sampled from what it's awaiting. After
+    each update, `running` says whether the Task was running, and `shared`
+    holds the number of leading instructions that are known to be
+    unchanged.
+    """
+    __slots__ = ['task', 'frames', 'lasti', 'trace', 'shared', 'running']
+
+    def __init__(self, task):
+        self.task = task
+        self.frames = []  # Outermost first
+        self.lasti = -1
+        self.trace = []
+        self.shared = 0
+        self.running = False
+
+    def update(self, frame, granularity, symbol_ids=False, running=True):
+        coro = _coroutine(self.task)
+        outer, awaited = _awaited(coro)
+        frames = []
+        if not running:
+            frame = None
+        # While running, the coroutine's frame is somewhere on the thread's
+        # stack (unless it's just been suspended)
+        while frame is not None and outer is not None:
+            frames.append(frame)
+            if frame is outer:
+                frames.reverse()
+                break
+            frame = frame.f_back
+        else:
+            frames = []
+            frame = outer
+            while frame is not None:
+                frames.append(frame)
+                frame, awaited = _awaited(awaited)
+        self.running = frame is not None
+
+        old_frames = self.frames
+        lasti = frames[-1].f_lasti if frames else -1
+        shared = 0
+        for old_frame, new_frame in zip(old_frames, frames):
+            if old_frame is not new_frame:
+                break
+            shared += 1
+        if shared == len(frames) == len(old_frames) and lasti == self.lasti:
+            self.shared = shared  # Nothing has moved on
+            return self.trace
+        # The innermost frame they have in common may have moved on
+        shared = max(shared - 1, 0)
+        field = 2 if symbol_ids else 0
+        lookup = symbol_cache.lookup
+        trace = self.trace[:shared]
+        for new_frame in frames[shared:]:
+            trace.append(lookup(new_frame, granularity)[field])
+        self.frames = frames
+        self.lasti = lasti
+        self.trace = trace
+        self.shared = shared
+        return trace
@@ -1,10 +1,29 @@
 import os
 
-from posix.time cimport timespec, clock_gettime, CLOCK_MONOTONIC_COARSE
+from libc.errno cimport errno
+from posix.time cimport timespec, clock_gettime, CLOCK_MONOTONIC, \
+    CLOCK_MONOTONIC_COARSE, CLOCK_THREAD_CPUTIME_ID
+from posix.types cimport clockid_t
 
-cpdef float monotonic():
+
+cdef inline long long _read_ns(clockid_t clock) except? -1:
     cdef timespec ts
-    err = clock_gettime(CLOCK_MONOTONIC_COARSE, &ts)
-    if err:
-        raise OSError(os.strerror(err))
-    return ts.tv_sec + ts.tv_nsec / 1000000000.0
+    if clock_gettime(clock, &ts):
+        raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec * 1000000000LL + ts.tv_nsec
+
+
+cpdef long long coarse_ns() except? -1:
+    return _read_ns(CLOCK_MONOTONIC_COARSE)
+
+
+cpdef long long fine_ns() except? -1:
+    return _read_ns(CLOCK_MONOTONIC)
+
+
+cpdef long long thread_cpu_ns() except? -1:
+    return _read_ns(CLOCK_THREAD_CPUTIME_ID)
+
+
+cpdef double monotonic() except? -1:
+    return _read_ns(CLOCK_MONOTONIC_COARSE) / 1e9
@@ -0,0 +1,120 @@
+"""
+Latency histograms covering every task, profiled or not, so latency
+percentiles aren't just those of the profiled minority.
+
+Application threads only note when each task starts (in their action
+context) and, when it ends, append one small record to a shared deque -
+which is thread-safe, and drops the oldest records if the profiler thread
+falls behind. The profiler thread adds the records to a histogram per
+action type and outcome, so the histograms only ever have one writer.
+"""
+import bisect
+from collections import deque
+
+from .admission import OTHER_TYPE, UNTYPED
+
+# Upper bounds of the histogram buckets, in seconds - the same as the
+# Prometheus client's defaults, with a few more for slow tasks
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0,
+           2.5, 5.0, 7.5, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+
+class LatencyHistogram(object):
+    """
+    Counts of task latencies, by bucket, with their count and total
+    """
+    __slots__ = ['counts', 'count', 'sum']
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, latency):
+        self.counts[bisect.bisect_left(BUCKETS, latency)] += 1
+        self.count += 1
+        self.sum += latency
+
+    def cumulative_counts(self):
+        """
+        (upper bound, count of latencies up to it) for each bucket
+        """
+        total = 0
+        result = []
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        The estimated `q` quantile (0 to 1) of the latencies, interpolating
+        within buckets, or None if there aren't any
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower = 0.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            if count and seen + count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+
+class LatencyTracker(object):
+    """
+    Latency histograms by action type and outcome. At most `max_types`
+    action types get histograms of their own, and any more share them.
+    Only the profiler thread should call `drain`.
+    """
+    __slots__ = ['records', 'histograms', 'max_types', 'types']
+
+    def __init__(self, queue_size=10000, max_types=100):
+        self.records = deque(maxlen=queue_size)
+        self.histograms = {}  # (action type, outcome): LatencyHistogram
+        self.max_types = max_types
+        self.types = set()
+
+    def record(self, action_type, start, end, outcome):
+        """
+        Note a finished task, with start and end times in nanoseconds. Safe
+        to call from any thread.
+        """
+        self.records.append((action_type, start, end, outcome))
+
+    def drain(self):
+        records = self.records
+        histograms = self.histograms
+        types = self.types
+        while records:
+            action_type, start, end, outcome = records.popleft()
+            if action_type is None:
+                action_type = UNTYPED
+            if action_type not in types:
+                if len(types) >= self.max_types:
+                    action_type = OTHER_TYPE
+                types.add(action_type)
+            histogram = histograms.get((action_type, outcome))
+            if histogram is None:
+                histogram = histograms[(action_type, outcome)] = \
+                    LatencyHistogram()
+            histogram.add((end - start) / 1e9)
+
+    def quantile(self, action_type, q):
+        """
+        The estimated `q` quantile of an action type's latencies, whatever
+        their outcome, or None if there haven't been any
+        """
+        merged = LatencyHistogram()
+        for (histogram_type, outcome), histogram in self.histograms.items():
+            if histogram_type == action_type:
+                merged.count += histogram.count
+                merged.sum += histogram.sum
+                merged.counts = [a + b for a, b in
+                                 zip(merged.counts, histogram.counts)]
+        return merged.quantile(q)
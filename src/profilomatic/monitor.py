@@ -10,9 +10,11 @@ def enable_prometheus():
         SummaryMetricFamily, \
         CounterMetricFamily, \
         GaugeMetricFamily, \
+        HistogramMetricFamily, \
         Summary, \
         REGISTRY
     from . import _instance
+    from .profiler import symbol_cache
 
     class ProfilerCollector(object):
         def collect(self):
@@ -22,6 +24,17 @@ def enable_prometheus():
                 count_value=_instance.total_samples,
                 sum_value=_instance.total_overhead
             )
+            yield SummaryMetricFamily(
+                'profiler_hook_time_secs',
+                'Time application threads spent in Eliot profiler\'s hooks, each cycle',
+                count_value=_instance.total_samples,
+                sum_value=_instance.total_hook_overhead
+            )
+            yield GaugeMetricFamily(
+                'profiler_sampling_interval_secs',
+                'The interval between samples that the overhead controller has chosen',
+                value=_instance.sampling_interval
+            )
             yield SummaryMetricFamily(
                 'profiler_profiling_granularity_secs',
                 'The time granularity that Eliot profiler has been able to achieve',
@@ -48,6 +61,124 @@ def enable_prometheus():
                 'The number of tasks that the profiler thinks it can handle, whilst meeting its granularity and overhead targets',
                 value=_instance.actions_next_run
             )
+            admitted = CounterMetricFamily(
+                'profiler_action_type_admitted_total',
+                'The number of tasks of each action type that Eliot profiler has agreed to profile',
+                labels=['action_type']
+            )
+            rejected = CounterMetricFamily(
+                'profiler_action_type_rejected_total',
+                'The number of tasks of each action type that Eliot profiler has elected not to profile',
+                labels=['action_type']
+            )
+            # Application threads add strata as they go, so iterate over a
+            # copy - list() takes it without letting another thread in
+            for action_type, stratum in sorted(
+                    list(_instance.admission_control.strata.items())):
+                admitted.add_metric([action_type], stratum.admitted)
+                rejected.add_metric([action_type], stratum.rejected)
+            yield admitted
+            yield rejected
+            latency = HistogramMetricFamily(
+                'profiler_task_latency_secs',
+                'How long tasks took, by action type and outcome, whether or not Eliot profiler profiled them',
+                labels=['action_type', 'outcome']
+            )
+            # The profiler thread adds histograms as it drains records
+            for (action_type, outcome), histogram in sorted(
+                    list(_instance.latency.histograms.items())):
+                latency.add_metric(
+                    [action_type, outcome],
+                    [('+Inf' if bound == float('inf') else str(bound), count)
+                     for bound, count in histogram.cumulative_counts()],
+                    histogram.sum)
+            yield latency
+            yield CounterMetricFamily(
+                'profiler_symbol_cache_hits_total',
+                'The number of stack frames resolved from the symbol cache',
+                value=symbol_cache.hits
+            )
+            yield CounterMetricFamily(
+                'profiler_symbol_cache_misses_total',
+                'The number of stack frames that had to be resolved to instructions from scratch',
+                value=symbol_cache.misses
+            )
+            yield GaugeMetricFamily(
+                'profiler_call_graph_nodes',
+                'The number of nodes in call graphs that are still being profiled',
+                value=_instance.call_graph_nodes
+            )
+            yield GaugeMetricFamily(
+                'profiler_budget_pressure',
+                'In-flight call graph size as a fraction of the global memory budget - above 1, call graphs get coalesced',
+                value=_instance.budget_pressure
+            )
+            yield CounterMetricFamily(
+                'profiler_coalesce_events_total',
+                'The number of times a call graph has had its coldest subtrees coalesced, to keep within its memory budget',
+                value=_instance.coalesce_events
+            )
+            yield CounterMetricFamily(
+                'profiler_coalesced_nodes_total',
+                'The number of call graph nodes removed by coalescing',
+                value=_instance.coalesced_nodes
+            )
+            yield CounterMetricFamily(
+                'profiler_messages_dropped_total',
+                'The number of messages dropped because an application thread\'s message ring was full',
+                value=_instance.message_queue.dropped
+            )
+            yield GaugeMetricFamily(
+                'profiler_message_queue_high_water',
+                'The most messages that have been waiting in any application thread\'s message ring',
+                value=_instance.message_queue.high_water
+            )
+            yield CounterMetricFamily(
+                'profiler_tasks_discarded_total',
+                'The number of finished tasks whose call graphs were discarded, as they weren\'t slow enough to keep',
+                value=_instance.discarded_tasks
+            )
+            yield CounterMetricFamily(
+                'profiler_tasks_truncated_total',
+                'The number of tasks ended early, because their messages overflowed the message ring',
+                value=_instance.truncated_tasks
+            )
+            calibration = _instance.clock_calibration
+            if calibration:
+                resolution = GaugeMetricFamily(
+                    'profiler_clock_resolution_ns',
+                    'The smallest step each clock was seen to take, when the profiler started',
+                    labels=['clock']
+                )
+                read_cost = GaugeMetricFamily(
+                    'profiler_clock_read_ns',
+                    'How long each clock took to read, when the profiler started',
+                    labels=['clock']
+                )
+                for name, result in sorted(calibration.items()):
+                    if result['resolution'] is not None:
+                        resolution.add_metric([name], result['resolution'])
+                    read_cost.add_metric([name], result['read_cost'])
+                yield resolution
+                yield read_cost
+            writer = _instance.writer
+            if writer is not None:
+                yield GaugeMetricFamily(
+                    'profiler_emit_queue_depth',
+                    'The number of call graphs waiting for the writer thread',
+                    value=len(writer.queue)
+                )
+                yield CounterMetricFamily(
+                    'profiler_emit_dropped_total',
+                    'The number of call graphs dropped because the writer thread fell behind',
+                    value=writer.dropped
+                )
+                yield SummaryMetricFamily(
+                    'profiler_emit_batch_write_secs',
+                    'Time taken to write each batch of call graphs to the destinations',
+                    count_value=writer.batches,
+                    sum_value=writer.write_time
+                )
 
     REGISTRY.register(ProfilerCollector())
     enabled = True
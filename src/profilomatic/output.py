@@ -1,54 +1,420 @@
+import datetime
+import gzip
+import io
 import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+import traceback
+import zlib
+
+import six
 import six.moves.http_client as httplib
 
-from six import b
+from .clock import monotonic
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 def _ensure_file_obj(f):
-    if isinstance(f, basestring):
+    if isinstance(f, six.string_types):
         return open(f, 'w')
     else:
         return f
 
 
-def file_destination(f):
-    f = _ensure_file_obj(f)
+class _FileDestination(object):
+    """
+    Writes each call graph to a file as a line of JSON. Call graphs from
+    the profiler are serialized straight into the file, in pieces.
+    """
+    def __init__(self, f, flush):
+        self._file = f
+        self._flush = flush
+
+    def __call__(self, message):
+        self._file.write(json.dumps(message) + '\n')
+        if self._flush:
+            self._file.flush()
+
+    def write_call_graph(self, call_graph, symbol_table, time_format, fields):
+        self.write_call_graphs([(call_graph, fields)], symbol_table, time_format)
+
+    def write_call_graphs(self, batch, symbol_table, time_format):
+        write = self._file.write
+        for call_graph, fields in batch:
+            call_graph.write_json(write, symbol_table, time_format, fields)
+            write('\n')
+        if self._flush:
+            self._file.flush()
 
-    def write(message):
-        f.write(json.dumps(message) + '\n')
-        f.flush()
-    return write
+
+def file_destination(f):
+    return _FileDestination(_ensure_file_obj(f), True)
 
 
 def no_flush_destination(f):
-    f = _ensure_file_obj(f)
+    return _FileDestination(_ensure_file_obj(f), False)
+
+
+def _compress_gzip(filename):
+    with open(filename, 'rb') as source:
+        with gzip.open(filename + '.gz', 'wb') as dest:
+            shutil.copyfileobj(source, dest)
+    return filename + '.gz'
+
+
+def _compress_lzma(filename):
+    with open(filename, 'rb') as source:
+        with lzma.LZMAFile(filename + '.xz', 'wb') as dest:
+            shutil.copyfileobj(source, dest)
+    return filename + '.xz'
+
+
+_COMPRESSORS = {'gzip': _compress_gzip, 'lzma': _compress_lzma}
+_SEGMENT_SUFFIX = re.compile(r'^(\d{8}T\d{12})(?:-(\d+))?(?:\.gz|\.xz)?$')
+
+
+class RotatingFileDestination(object):
+    """
+    Writes call graphs to a file as lines of JSON, like `file_destination`,
+    but buffered, and flushed once `flush_bytes` have been written, or
+    `flush_interval` seconds have passed, rather than after every call
+    graph.
+
+    The file is rotated once it reaches `max_bytes`, or is
+    `rotate_interval` seconds old (either may be 0, to disable them).
+    Closed segments are renamed with a timestamp suffix, compressed if
+    `compress` is 'gzip' or 'lzma', and then the oldest are deleted, to
+    keep at most `backup_count` segments, taking up at most
+    `max_total_bytes` (0 for no limit).
+    """
+    def __init__(self, filename, flush_interval=1.0, flush_bytes=64 * 1024,
+                 max_bytes=0, rotate_interval=0, compress=None,
+                 backup_count=0, max_total_bytes=0):
+        if compress is not None and compress not in _COMPRESSORS:
+            raise ValueError('Compression must be gzip or lzma')
+        if compress == 'lzma' and lzma is None:
+            raise ValueError('lzma compression needs the lzma module')
+        self._filename = os.path.abspath(filename)
+        self._flush_interval = flush_interval
+        self._flush_bytes = flush_bytes
+        self._max_bytes = max_bytes
+        self._rotate_interval = rotate_interval
+        self._compress = compress
+        self._backup_count = backup_count
+        self._max_total_bytes = max_total_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._open()
+
+    def __call__(self, message):
+        self._write([json.dumps(message), '\n'])
+
+    def write_call_graph(self, call_graph, symbol_table, time_format, fields):
+        self.write_call_graphs([(call_graph, fields)], symbol_table, time_format)
+
+    def write_call_graphs(self, batch, symbol_table, time_format):
+        chunks = []
+        for call_graph, fields in batch:
+            call_graph.write_json(chunks.append, symbol_table, time_format, fields)
+            chunks.append('\n')
+        self._write(chunks)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _write(self, chunks):
+        data = ''.join(chunks)
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        with self._lock:
+            self._file.write(data)
+            self._size += len(data)
+            self._unflushed += len(data)
+            now = monotonic()
+            if (self._max_bytes and self._size >= self._max_bytes) or (
+                    self._rotate_interval
+                    and now - self._opened_at >= self._rotate_interval):
+                self._rotate()
+            elif (self._unflushed >= self._flush_bytes
+                  or now - self._flushed_at >= self._flush_interval):
+                self._flush()
+
+    def _open(self):
+        self._file = io.open(self._filename, 'a', encoding='utf-8')
+        self._size = self._file.tell()
+        self._unflushed = 0
+        self._opened_at = self._flushed_at = monotonic()
 
-    def write(message):
-        f.write(json.dumps(message) + '\n')
-    return write
+    def _flush(self):
+        self._file.flush()
+        self._unflushed = 0
+        self._flushed_at = monotonic()
+
+    def _rotate(self):
+        self._file.close()
+        suffix = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        segment = '%s.%s' % (self._filename, suffix)
+        sequence = 0
+        while any(os.path.exists(segment + extension)
+                  for extension in ('', '.gz', '.xz')):
+            sequence += 1
+            segment = '%s.%s-%d' % (self._filename, suffix, sequence)
+        os.rename(self._filename, segment)
+        self._open()
+        if self._compress:
+            try:
+                _COMPRESSORS[self._compress](segment)
+                os.remove(segment)
+            except:
+                traceback.print_exc()
+        self._apply_retention()
+
+    def segments(self):
+        """
+        The paths of the closed segments, oldest first
+        """
+        directory, basename = os.path.split(self._filename)
+        found = []
+        for name in os.listdir(directory):
+            if name.startswith(basename + '.'):
+                match = _SEGMENT_SUFFIX.match(name[len(basename) + 1:])
+                if match:
+                    found.append((match.group(1), int(match.group(2) or 0),
+                                  os.path.join(directory, name)))
+        return [path for _, _, path in sorted(found)]
+
+    def _apply_retention(self):
+        if not (self._backup_count or self._max_total_bytes):
+            return
+        segments = self.segments()
+        total = sum(os.path.getsize(segment) for segment in segments)
+        while segments and (
+                (self._backup_count and len(segments) > self._backup_count)
+                or (self._max_total_bytes and total > self._max_total_bytes)):
+            oldest = segments.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+
+class DeliveryError(IOError):
+    """
+    The collector rejected some profiler output. Server errors, and
+    requests to slow down, are worth retrying - other rejections aren't.
+    """
+    def __init__(self, status, reason):
+        super(DeliveryError, self).__init__(
+            'Collector responded %d %s' % (status, reason))
+        self.status = status
+        self.retryable = status >= 500 or status == 429
+
+
+_NETWORK_ERRORS = (EnvironmentError, httplib.HTTPException)
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
 class RestDestination(object):
-    def __init__(self, host, port=None, timeout=5, ssl_context=None):
+    """
+    POSTs call graphs to a collector. By default, each call graph is sent
+    as soon as it arrives, in a request of its own.
+
+    With a `batch_size` above 1, call graphs are buffered, and sent as a
+    JSON list once `batch_size` of them are waiting, or the oldest has
+    waited `max_delay` seconds, or `flush` is called. `compress` gzips
+    request bodies. Up to `pool_size` idle connections are kept open for
+    reuse.
+
+    Failed requests are retried up to `retries` times, after jittered
+    exponential backoff, starting from `backoff` seconds. If they still
+    fail, and there's a `spill_file`, the call graphs are appended to it
+    (as lines of JSON, up to `max_spill_bytes`), and replayed after the
+    next successful request. Otherwise, the error is raised.
+    """
+    def __init__(self, host, port=None, timeout=5, ssl_context=None,
+                 batch_size=1, max_delay=1.0, compress=False, pool_size=2,
+                 retries=2, backoff=0.1, max_backoff=5.0, spill_file=None,
+                 max_spill_bytes=100 * 1024 * 1024, path='/api/data'):
         self._host = host
         self._port = port
         self._ssl_context = ssl_context
         self._timeout = timeout
-        self._connection = None
+        self._batch_size = max(batch_size, 1)
+        self._max_delay = max_delay
+        self._compress = compress
+        self._pool_size = pool_size
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._spill_file = spill_file
+        self._max_spill_bytes = max_spill_bytes
+        self._path = path
+        self._idle_connections = []
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered_since = None
+        self._spilled = bool(spill_file) and os.path.exists(spill_file) \
+            and os.path.getsize(spill_file) > 0
+        self.sent = 0
+        self.retried = 0
+        self.spilled = 0
+        self.dropped = 0
 
     def __call__(self, data):
-        if not self._connection:
-            if self._ssl_context:
-                self._connection = httplib.HTTPSConnection(
-                    self._host, self._port or 443,
-                    timeout=self._timeout, context=self._ssl_context)
-            else:
-                self._connection = httplib.HTTPConnection(
-                    self._host, self._port or 80, timeout=self._timeout)
+        self._add([json.dumps(data)])
+
+    def write_call_graph(self, call_graph, symbol_table, time_format, fields):
+        self.write_call_graphs([(call_graph, fields)], symbol_table, time_format)
+
+    def write_call_graphs(self, batch, symbol_table, time_format):
+        documents = []
+        for call_graph, fields in batch:
+            chunks = []
+            call_graph.write_json(chunks.append, symbol_table, time_format, fields)
+            documents.append(''.join(chunks))
+        self._add(documents)
+
+    def flush(self):
+        """
+        Send any buffered call graphs now
+        """
+        with self._lock:
+            documents = self._buffer
+            self._buffer = []
+            self._buffered_since = None
+        if documents:
+            self._send(documents)
+
+    def _add(self, documents):
+        if self._batch_size == 1:
+            for document in documents:
+                self._send([document])
+            return
+        with self._lock:
+            if not self._buffer:
+                self._buffered_since = monotonic()
+            self._buffer.extend(documents)
+            ready = (len(self._buffer) >= self._batch_size
+                     or monotonic() - self._buffered_since >= self._max_delay)
+        if ready:
+            self.flush()
+
+    def _send(self, documents):
+        for start in range(0, len(documents), self._batch_size):
+            batch = documents[start:start + self._batch_size]
+            try:
+                self._post(self._encode(batch))
+            except _NETWORK_ERRORS as e:
+                if not self._spill_file or not getattr(e, 'retryable', True):
+                    raise
+                self._spill(documents[start:])
+                return
+            self.sent += len(batch)
+        if self._spilled:
+            self._replay()
+
+    def _encode(self, documents):
+        if self._batch_size == 1:
+            body, = documents
+        else:
+            body = '[' + ','.join(documents) + ']'
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        if self._compress:
+            body = _gzip(body)
+        return body
+
+    def _post(self, body):
+        headers = {'Content-Type': 'application/json'}
+        if self._compress:
+            headers['Content-Encoding'] = 'gzip'
+        attempt = 0
+        while True:
+            try:
+                self._request(body, headers)
+                return
+            except _NETWORK_ERRORS as e:
+                if attempt >= self._retries or not getattr(e, 'retryable', True):
+                    raise
+            time.sleep(random.uniform(
+                0, min(self._max_backoff, self._backoff * 2 ** attempt)))
+            attempt += 1
+            self.retried += 1
+
+    def _request(self, body, headers):
+        connection = self._acquire()
         try:
-            self._connection.request('POST', '/api/data', b(json.dumps(data)))
-            response = self._connection.getresponse()
+            connection.request('POST', self._path, body, headers)
+            response = connection.getresponse()
             response.read()
         except:
-            self._connection = None
+            connection.close()
             raise
+        self._release(connection)
+        if response.status >= 400:
+            raise DeliveryError(response.status, response.reason)
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle_connections:
+                return self._idle_connections.pop()
+        if self._ssl_context:
+            return httplib.HTTPSConnection(
+                self._host, self._port or 443,
+                timeout=self._timeout, context=self._ssl_context)
+        else:
+            return httplib.HTTPConnection(
+                self._host, self._port or 80, timeout=self._timeout)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle_connections) < self._pool_size:
+                self._idle_connections.append(connection)
+                return
+        connection.close()
+
+    def _spill(self, documents):
+        with self._lock:
+            size = os.path.getsize(self._spill_file) \
+                if os.path.exists(self._spill_file) else 0
+            with io.open(self._spill_file, 'a', encoding='utf-8') as f:
+                for document in documents:
+                    if isinstance(document, bytes):
+                        document = document.decode('utf-8')
+                    size += len(document) + 1
+                    if size > self._max_spill_bytes:
+                        self.dropped += 1
+                    else:
+                        f.write(document + u'\n')
+                        self.spilled += 1
+                        self._spilled = True
+
+    def _replay(self):
+        with self._lock:
+            if not self._spilled:
+                return
+            # Take the whole spill file - anything that fails again is
+            # spilled afresh
+            with io.open(self._spill_file, encoding='utf-8') as f:
+                documents = f.read().splitlines()
+            io.open(self._spill_file, 'w').close()
+            self._spilled = False
+        self._send(documents)
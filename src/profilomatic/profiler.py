@@ -2,23 +2,36 @@ import datetime
 import platform
 import six
 import sys
+from six.moves._thread import get_ident
 import threading
 import time
 import traceback
-from collections import deque
 
 try:
     from ._call_graph import CallGraphRoot
-    from ._stack_trace import generate_stack_trace
+    from ._stack_trace import \
+        generate_stack_trace, symbol_cache, symbol_table, IncrementalStackTrace, \
+        capture_stack, resolve_stack
 except ImportError:
     from .call_graph import CallGraphRoot
-    from .stack_trace import generate_stack_trace
+    from .stack_trace import \
+        generate_stack_trace, symbol_cache, symbol_table, IncrementalStackTrace, \
+        capture_stack, resolve_stack
+
+from .admission import Admission
+from .array_call_graph import ArrayCallGraphRoot
+from .budget import node_limit, COALESCE_TARGET
+from .clock import clock_ns, calibrate, thread_cpu_reader, to_nanoseconds, \
+    to_timedelta, TIMESTAMP_CLOCKS, CLOCKS
+from .controller import lookup_controller
+from .coroutines import ActionContext, TaskStackTrace, RunningTasks, \
+    running_task, is_thread, outermost_frame
+from .latency import LatencyTracker
+from .retention import Retention
+from .ring import MessageQueue
+from .thread_state import thread_state_classifier, STATE_NAMES, IDLE
+from .writer import AsyncWriter, OVERFLOW_POLICIES
 
-try:
-    from fast_monotonic import monotonic
-    monotonic()  # Check it actually works
-except (ImportError, OSError):
-    from monotonic import monotonic
 try:
     utc = datetime.timezone.utc
 except AttributeError:
@@ -32,6 +45,9 @@ TASK_LEVEL_FIELD = 'task_level'
 
 REMOTE_TASK_ACTION = 'profilomatic:linked_remote_task'
 
+# Instructions for the synthetic leaf nodes that hold thread states
+_STATE_LEAVES = ['<%s>' % name for name in STATE_NAMES]
+
 STARTED_STATUS = 'started'
 SUCCEEDED_STATUS = 'succeeded'
 FAILED_STATUS = 'failed'
@@ -42,50 +58,156 @@ _PROFILER_DEFAULTS = {
     'time_granularity': 0.1,  # seconds
     'code_granularity': 'line',  # line, method, or file
     'store_all_logs': False,
+    'use_symbol_table': False,  # Output instructions as indexes into a symbol list
+    'call_graph_engine': 'object',  # object, or array
+    'time_format': 'iso',  # iso, or offset (seconds since base_time)
+    # Memory budgets for in-flight call graphs - 0 means unlimited
+    'max_nodes_per_task': 0,
+    'max_bytes_per_task': 0,
+    'max_nodes': 0,
+    'max_bytes': 0,
+    # Emit what's changed in long-running tasks' call graphs this often - 0 means never
+    'snapshot_interval': 0,  # seconds
+    # Call graphs waiting for the writer thread - 0 writes them on the profiler thread
+    'emit_queue_size': 100,
+    'emit_batch_size': 10,
+    'emit_overflow': 'drop_oldest',  # drop_oldest, or block
+    # Messages waiting for the profiler thread, per application thread
+    'message_queue_size': 1000,
+    'message_overflow': 'drop',  # drop, or end_task
+    'clock': 'coarse',  # coarse, or fine - for timestamping samples and messages
+    # coarse, fine, or thread_cpu (fine where there isn't one) - for measuring overhead
+    'overhead_clock': 'thread_cpu',
+    # pi, or fixed - or a function that builds a controller, see controller.py
+    'overhead_controller': 'pi',
+    'admission': 'stratified',  # stratified, or shared - see admission.py
+    'min_action_rate': 0.1,  # Tasks a second each action type is sure to get profiled
+    'max_action_types': 100,  # Action types admitted and counted separately
+    # Which finished tasks to emit: all, threshold (slower than
+    # retention_threshold), or percentile (slower than retention_percentile
+    # of their action type)
+    'retention': 'all',
+    'retention_threshold': 1.0,  # seconds
+    'retention_percentile': 0.99,  # fraction
+    # Latency histograms for every task, profiled or not
+    'track_latency': True,  # Timed with the fine clock, whatever `clock` is
+    'latency_queue_size': 10000,  # Finished tasks waiting for the profiler thread
+    # Add each sample's thread state (running, gil, blocked or idle) as a leaf node
+    'thread_state_leaves': False,
     'source_name': platform.node()
 }
 
 
+def _lookup_call_graph_engine(engine):
+    if engine == 'object':
+        return CallGraphRoot
+    elif engine == 'array':
+        return ArrayCallGraphRoot
+    else:
+        raise ValueError('Call graph engine must be object or array')
+
+
+def _wall_clock_minus_monotonic(clock):
+    return (datetime.datetime.utcnow().replace(tzinfo=utc)
+            - to_timedelta(clock()))
+
+
 class _MessageInfo(object):
-    def __init__(self, message, next_task_uuid):
+    """
+    A message on its way to the profiler thread. Only the monotonic time
+    is recorded, in nanoseconds from `clock` - the wall clock time is
+    worked out on the profiler thread, from the profiler's
+    `wall_clock_minus_monotonic`. `unit` is the asyncio Task that the
+    message's task is profiled by, or None if it's profiled by thread.
+    """
+    __slots__ = ['message', 'next_task_uuid', 'thread', 'unit', 'monotonic',
+                 'stack']
+
+    def __init__(self, message, next_task_uuid, granularity='line',
+                 clock=clock_ns(_PROFILER_DEFAULTS['clock']), unit=None):
         self.message = message
         self.next_task_uuid = next_task_uuid
-        self.thread = threading.currentThread().ident
-        self.clock = datetime.datetime.utcnow().replace(tzinfo=utc)
-        self.monotonic = monotonic()
+        self.thread = get_ident()
+        self.unit = unit
+        self.monotonic = clock()
 
+        # The stack is captured now, rather than keeping the frame, which
+        # would keep its locals alive, and have moved on by the time the
+        # profiler thread looked at it. A Task's stack starts at its
+        # coroutine, as its samples do, not at the event loop
+        outermost = None if unit is None else outermost_frame(unit)
         _, _, tb = sys.exc_info()
         if tb is not None:
             while tb.tb_next is not None:
                 tb = tb.tb_next
-            self.frame = tb.tb_frame
+            self.stack = capture_stack(tb.tb_frame, granularity, outermost)
         else:
-            self.frame = sys._getframe()
+            self.stack = capture_stack(sys._getframe(), granularity, outermost)
 
 
 class Profiler(object):
     __slots__ = [
         'simultaneous_tasks_profiled', 'max_overhead', 'time_granularity',
-        'code_granularity', 'source_name', 'store_all_logs',
+        'code_granularity', 'source_name', 'store_all_logs', 'use_symbol_table',
+        'call_graph_engine', 'time_format', 'max_nodes_per_task', 'max_bytes_per_task',
+        'max_nodes', 'max_bytes', 'snapshot_interval', 'emit_queue_size',
+        'emit_batch_size', 'emit_overflow', 'message_queue_size',
+        'message_overflow', 'clock', 'overhead_clock', 'overhead_controller',
+        'thread_state_leaves', 'now', 'overhead_now', 'controller',
+        'sampling_interval', 'total_hook_overhead', 'admission',
+        'min_action_rate', 'max_action_types', 'admission_control',
+        'retention', 'retention_threshold', 'retention_percentile',
+        'retention_control', 'task_types', 'discarded_tasks',
+        'track_latency', 'latency_queue_size', 'latency', 'latency_now',
+        'clock_calibration',
         'actions_since_last_run', 'actions_next_run', 'message_queue',
-        'action_context', 'destinations', 'thread_tasks', 'call_graphs',
-        'thread', 'total_overhead', 'granularity_sum', 'total_samples',
-        'profiled_tasks', 'unprofiled_tasks', 'stopped']
+        'wall_clock_minus_monotonic',
+        'action_context', 'thread_context', 'destinations', 'thread_tasks', 'call_graphs',
+        'thread_stacks', 'thread_cpu', 'snapshots',
+        'thread', 'writer', 'total_overhead', 'granularity_sum', 'total_samples',
+        'profiled_tasks', 'unprofiled_tasks', 'call_graph_nodes',
+        'budget_pressure', 'coalesce_events', 'coalesced_nodes',
+        'truncated_tasks', 'stopped']
     def __init__(self, **kwargs):
         self.configure(**kwargs)
         self.actions_since_last_run = 0
         self.actions_next_run = self.simultaneous_tasks_profiled
-        self.message_queue = deque()
-        self.action_context = threading.local()
+        self.message_queue = MessageQueue(self.message_queue_size)
+        self.admission_control = Admission(
+            self.admission == 'stratified', self.min_action_rate,
+            self.max_action_types)
+        self.retention_control = Retention(max_types=self.max_action_types)
+        self._configure_retention()
+        self.latency = LatencyTracker(
+            self.latency_queue_size, self.max_action_types)
+        # The coarse clock's ticks are as long as the shortest buckets
+        self.latency_now = clock_ns('fine')
+        self.wall_clock_minus_monotonic = _wall_clock_minus_monotonic(self.now)
+        self.clock_calibration = None
+        self.action_context = ActionContext()
+        self.thread_context = threading.local()
         self.destinations = []
-        self.thread_tasks = {}
+        self.thread_tasks = {}  # By thread ident, or asyncio Task
         self.call_graphs = {}
+        self.thread_stacks = {}
+        self.thread_cpu = {}
+        self.snapshots = {}
         self.thread = None
+        self.writer = None
         self.total_overhead = 0.0
+        self.total_hook_overhead = 0.0
+        self.sampling_interval = self.time_granularity
         self.granularity_sum = 0.0
         self.total_samples = 0
         self.profiled_tasks = 0
         self.unprofiled_tasks = 0
+        self.call_graph_nodes = 0
+        self.budget_pressure = 0.0
+        self.coalesce_events = 0
+        self.coalesced_nodes = 0
+        self.truncated_tasks = 0
+        self.discarded_tasks = 0
+        self.task_types = {}
         self.stopped = False
 
     def configure(self, **kwargs):
@@ -94,6 +216,60 @@ class Profiler(object):
                 setattr(self, arg, kwargs[arg])
             elif not hasattr(self, arg):
                 setattr(self, arg, _PROFILER_DEFAULTS[arg])
+        if self.message_overflow not in ('drop', 'end_task'):
+            raise ValueError('Message overflow policy must be drop or end_task')
+        if self.admission not in ('stratified', 'shared'):
+            raise ValueError('Admission must be stratified or shared')
+        if self.retention not in ('all', 'threshold', 'percentile'):
+            raise ValueError('Retention must be all, threshold or percentile')
+        if self.emit_overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Emit overflow policy must be drop_oldest or block')
+        if self.clock not in TIMESTAMP_CLOCKS:
+            raise ValueError('Clock must be coarse or fine')
+        if self.overhead_clock not in CLOCKS:
+            raise ValueError('Overhead clock must be coarse, fine or thread_cpu')
+        self.now = clock_ns(self.clock)
+        try:
+            self.overhead_now = clock_ns(self.overhead_clock)
+        except ValueError:
+            if self.overhead_clock != 'thread_cpu':
+                raise
+            self.overhead_now = clock_ns('fine')  # No thread CPU clock here
+        # Rebuilt with every change, so it follows the targets
+        self.controller = lookup_controller(self.overhead_controller)(
+            self.max_overhead, self.time_granularity,
+            self.simultaneous_tasks_profiled)
+        message_queue = getattr(self, 'message_queue', None)
+        if message_queue is not None:
+            message_queue.capacity = self.message_queue_size
+        admission_control = getattr(self, 'admission_control', None)
+        if admission_control is not None:
+            admission_control.stratified = self.admission == 'stratified'
+            admission_control.min_rate = self.min_action_rate
+            admission_control.max_types = self.max_action_types
+        if getattr(self, 'retention_control', None) is not None:
+            self._configure_retention()
+        latency = getattr(self, 'latency', None)
+        if latency is not None:
+            latency.max_types = self.max_action_types
+        writer = getattr(self, 'writer', None)
+        if writer is not None and self.emit_queue_size:
+            with writer.condition:
+                writer.queue_size = max(self.emit_queue_size, 1)
+                writer.batch_size = max(self.emit_batch_size, 1)
+                writer.overflow = self.emit_overflow
+                # Wake anyone blocked in put, in case there's room now
+                writer.condition.notify_all()
+        # Turning the writer thread on or off is left to the profiler
+        # thread, which does all the emitting - see _switch_writer
+
+    def _configure_retention(self):
+        retention = self.retention_control
+        retention.threshold = (self.retention_threshold
+                               if self.retention == 'threshold' else None)
+        retention.percentile = (self.retention_percentile
+                                if self.retention == 'percentile' else None)
+        retention.max_types = self.max_action_types
 
     def add_destination(self, destination):
         self.destinations.append(destination)
@@ -111,105 +287,318 @@ class Profiler(object):
             self._log_message(message)
 
     def _start_message(self, message):
-        context = self.action_context
-        if not hasattr(context, 'stack'):
+        context = self.action_context.get()
+        if context is not None and context.task is not running_task():
+            context = self._fork_context(context)
+        if context is None:
+            context = self.action_context.new()
             context.stack = []
+            context.task = running_task()  # Or None, to profile by thread
+            action_type = message.get(ACTION_TYPE_FIELD)
+            now = self.now()
+            if self.track_latency:
+                context.started = (action_type, self.latency_now())
             # This is racy, but it's not a disaster
             # if a small number of extra actions are profiled
-            if self.simultaneous_tasks_profiled == 0 or (
-                    len(self.thread_tasks) + self.actions_since_last_run
-                        < self.actions_next_run):
+            stratum = self.admission_control.admit(
+                action_type,
+                len(self.thread_tasks) + self.actions_since_last_run,
+                None if self.simultaneous_tasks_profiled == 0
+                else self.actions_next_run,
+                now)
+            if stratum is not None:
                 self.actions_since_last_run += 1
                 context.logging = True
+                context.stratum = stratum
                 self.profiled_tasks += 1
+                if context.task is None:
+                    self._start_cpu_count()
             else:
                 context.logging = False
                 self.unprofiled_tasks += 1
         context.stack.append(message[TASK_UUID_FIELD])
         self._log_message(message)
 
+    def _fork_context(self, parent):
+        """
+        New action state for a Task that was started within an action, and
+        is starting an action of its own. It shares its creator's state,
+        which has to be left alone, as the creator (and any other Tasks it
+        started) carry on using it. The Task is profiled on its own, if its
+        creator was, until its actions end, and it's back to sharing.
+        """
+        context = self.action_context.new()
+        context.stack = []
+        context.task = running_task()
+        context.logging = parent.logging
+        context.parent = parent
+        if context.logging and context.task is None:
+            self._start_cpu_count()
+        return context
+
     def _end_message(self, message):
-        context = self.action_context
+        context = self.action_context.get()
         context.stack.pop()
         self._log_message(message)
         if not context.stack:  # Stack is empty, so revert to actionless state
-            del context.stack
-            del context.logging
+            stratum = getattr(context, 'stratum', None)
+            if stratum is not None:
+                self.admission_control.release(stratum)
+            if context.logging and context.task is None:
+                # Stop reading the thread's CPU clock while it's still
+                # running - once it's finished, its ident can be reused
+                self.thread_cpu.pop(get_ident(), None)
+            started = getattr(context, 'started', None)
+            if started is not None:
+                self.latency.record(started[0], started[1], self.latency_now(),
+                                    message.get(ACTION_STATUS_FIELD))
+            # Forked state goes back to the state it was forked from
+            self.action_context.set(getattr(context, 'parent', None))
 
     def _log_message(self, message):
-        context = self.action_context
+        context = self.action_context.get()
         if getattr(context, 'logging', False):
+            start = self.overhead_now()
             stack = getattr(context, 'stack', None)
             if stack:
                 task_uuid = stack[-1]
             else:
                 task_uuid = None
-            msg_info = _MessageInfo(message, task_uuid)
-            self.message_queue.append(msg_info)
+            msg_info = _MessageInfo(
+                message, task_uuid, self.code_granularity, self.now,
+                context.task)
+            ring = self.message_queue.ring()
+            if not ring.append(msg_info):
+                self._message_overflow(context, task_uuid)
+            ring.hook_cost += self.overhead_now() - start
+
+    def _message_overflow(self, context, task_uuid):
+        """
+        The thread's message ring is full, so the message has been dropped.
+        With the end_task policy, the rest of the action isn't profiled,
+        and the profiler thread ends its task once it reaches this point
+        in the ring. With the drop policy, the task carries on, unless this
+        was its last message, in which case the profiler thread has to end
+        it instead.
+        """
+        if self.message_overflow == 'end_task':
+            context.logging = False
+            self.message_queue.ring().mark(context.task)
+        elif task_uuid is None:
+            self.message_queue.ring().mark(context.task)
 
     def _ingest_messages(self):
-        try:
-            while True:
-                message = self.message_queue.popleft()
-                self._ingest_message(message)
-        except IndexError:
-            pass
+        self.message_queue.drain(self._ingest_message, self._end_truncated_task)
+
+    def _end_truncated_task(self, unit):
+        task = self.thread_tasks.get(unit)
+        if task is not None:
+            self.truncated_tasks += 1
+            self._end_task(unit, task, True)
 
     def _profile_stacks(self, time_to_record, monotime):
+        """
+        Sample each profiled unit - a thread, or an asyncio Task, whose
+        stack is sampled from its coroutines while it's suspended
+        """
         frames = sys._current_frames()
-        for thread, task in six.iteritems(self.thread_tasks):
-            try:
-                frame = frames[thread]
-                call_graph = self.call_graphs[(thread, task)]
-                call_stack = generate_stack_trace(frame, self.code_granularity, False)
-                call_graph.ingest(call_stack, time_to_record, monotime)
-            except KeyError:
-                pass  # No frame, no biggie
+        thread_stacks = self.thread_stacks
+        running_tasks = RunningTasks()
+        for unit, task in six.iteritems(self.thread_tasks):
+            call_graph = self.call_graphs.get((unit, task))
+            if call_graph is None:
+                continue
+            frame = frames.get(call_graph.thread)
+            if frame is None and is_thread(unit):
+                continue  # No frame, no biggie
+            stack_trace = thread_stacks.get(unit)
+            if stack_trace is None:
+                stack_trace = thread_stacks[unit] = (
+                    IncrementalStackTrace() if is_thread(unit)
+                    else TaskStackTrace(unit))
+            if is_thread(unit):
+                call_stack = stack_trace.update(
+                    frame, self.code_granularity, self.use_symbol_table)
+                cpu_time = self._thread_cpu_time(unit)
+                state = thread_state_classifier.classify(
+                    frame, time_to_record, cpu_time)
+            else:
+                # Only the running Task's thread stack needs walking
+                call_stack = stack_trace.update(
+                    frame, self.code_granularity, self.use_symbol_table,
+                    running_tasks.is_running(unit))
+                # The thread's CPU time is shared with its other Tasks
+                cpu_time = None
+                if stack_trace.running:
+                    state = thread_state_classifier.classify(
+                        frame, time_to_record)
+                else:
+                    state = IDLE  # Waiting for what it's awaiting
+            if self.thread_state_leaves:
+                call_stack = call_stack + [self._state_leaf(state)]
+            call_graph.ingest(call_stack, time_to_record, monotime,
+                              None, stack_trace.shared, cpu_time or 0, state)
         self.actions_since_last_run = 0
 
+    def _start_cpu_count(self):
+        """
+        Start counting the calling thread's CPU time, for a task that's
+        about to be profiled. This happens on the application thread, as a
+        thread's CPU clock can only safely be looked up while it's running.
+        """
+        thread = get_ident()
+        context = self.thread_context
+        try:
+            read = context.read_cpu
+        except AttributeError:
+            read = context.read_cpu = thread_cpu_reader(thread)
+        if read is None:
+            return
+        try:
+            self.thread_cpu[thread] = [read, read()]
+        except OSError:  # No CPU time for this task, then
+            self.thread_cpu.pop(thread, None)
+
+    def _thread_cpu_time(self, thread):
+        """
+        The CPU time a profiled thread has used since it was last sampled,
+        or None if it can't be measured
+        """
+        cpu = self.thread_cpu.get(thread)
+        if cpu is None or cpu[0] is None:
+            return None
+        try:
+            now = cpu[0]()
+        except OSError:  # The thread has finished
+            self.thread_cpu.pop(thread, None)
+            return None
+        cpu_time = now - cpu[1]
+        cpu[1] = now
+        return cpu_time
+
+    def _state_leaf(self, state):
+        leaf = _STATE_LEAVES[state]
+        if self.use_symbol_table:
+            return symbol_table.id_for(leaf)
+        return leaf
+
     def _profile_once(self, time_to_record, monotime):
         """
-        Added for testing - in use, it would be important for monotime to be generated between ingesting and profiling
+        Added for testing - in use, it would be important for monotime to be generated between ingesting and profiling.
+        Both are in nanoseconds.
         """
         self._ingest_messages()
+        self.latency.drain()
         self._profile_stacks(time_to_record, monotime)
+        self._emit_snapshots(monotime)
+        self._enforce_budgets()
+        self._release_written()
+
+    def _emit_snapshots(self, monotime):
+        """
+        Emit the part of each call graph that's built up since its last
+        snapshot, if that was long enough ago, and then drop it
+        """
+        if not self.snapshot_interval:
+            return
+        snapshots = self.snapshots
+        for key, call_graph in six.iteritems(self.call_graphs):
+            snapshot = snapshots.get(key)
+            if snapshot is None:
+                # Tasks that started before snapshots were enabled
+                snapshots[key] = [0, monotime]
+            elif monotime - snapshot[1] >= to_nanoseconds(self.snapshot_interval):
+                if call_graph.node_count > 1:
+                    # The writer thread may still be reading the emitted
+                    # call graph, so it's replaced rather than reset
+                    thread, task = key
+                    self.call_graphs[key] = self._new_call_graph(
+                        thread, task,
+                        call_graph.wall_clock_minus_monotonic
+                        + to_timedelta(monotime),
+                        monotime)
+                    self._emit(call_graph, snapshot[0], True)
+                    snapshot[0] += 1
+                snapshot[1] = monotime
+
+    def _coalesce(self, call_graph, max_nodes):
+        removed = call_graph.coalesce(max_nodes)
+        if removed:
+            self.coalesce_events += 1
+            self.coalesced_nodes += removed
+
+    def _enforce_budgets(self):
+        """
+        Shrink call graphs that are over their own budget, then shrink all
+        call graphs in proportion if together they're over the global budget
+        """
+        total_nodes = 0
+        total_bytes = 0
+        for call_graph in self.call_graphs.values():
+            limit = node_limit(self.max_nodes_per_task, self.max_bytes_per_task,
+                               call_graph.bytes_per_node)
+            if limit and call_graph.node_count > limit:
+                self._coalesce(call_graph, int(limit * COALESCE_TARGET))
+            total_nodes += call_graph.node_count
+            total_bytes += call_graph.node_count * call_graph.bytes_per_node
+
+        pressure = 0.0
+        if self.max_nodes:
+            pressure = float(total_nodes) / self.max_nodes
+        if self.max_bytes:
+            pressure = max(pressure, float(total_bytes) / self.max_bytes)
+        if pressure > 1.0:
+            total_nodes = 0
+            for call_graph in self.call_graphs.values():
+                self._coalesce(call_graph, int(
+                    call_graph.node_count * COALESCE_TARGET / pressure))
+                total_nodes += call_graph.node_count
+        self.call_graph_nodes = total_nodes
+        self.budget_pressure = pressure
 
     def _profiler_loop(self):
         wait_time = self.time_granularity
-        last_start_time = monotonic()
+        last_start_time = self.now()
+        last_hook_cost = self.message_queue.hook_cost
         while True:
             time.sleep(wait_time)
-            start_time = monotonic()
+            now = self.now
+            start_time = now()
+            overhead_start = self.overhead_now()
             time_to_record = start_time - last_start_time
+            # Follow any changes to the wall clock
+            self.wall_clock_minus_monotonic = _wall_clock_minus_monotonic(now)
             self._ingest_messages()
             if self.stopped:
                 return
-            self._profile_stacks(time_to_record, monotonic())
-            end_time = monotonic()
-            time_taken = end_time - start_time
-            # How did the time taken compare with the target
-            performance_against_target = (
-                time_taken / (self.time_granularity * self.max_overhead)
-            ) or 1.0
-            if performance_against_target <= 1:
-                # Performance was good, so maybe profile more actions
-                self.actions_next_run += (
-                    self.simultaneous_tasks_profiled
-                    * (1.0 - performance_against_target)
-                )
-                wait_time = self.time_granularity - time_taken
-            else:
-                # Performance wasn't so good, so wait longer, reducing granularity
-                self.actions_next_run = self.simultaneous_tasks_profiled
-                wait_time = time_taken / self.max_overhead - time_taken
+            self.latency.drain()
+            monotime = now()
+            self._profile_stacks(time_to_record, monotime)
+            self._emit_snapshots(monotime)
+            self._enforce_budgets()
+            self._release_written()
+            self._switch_writer()
+            time_taken = (self.overhead_now() - overhead_start) / 1e9
+            hook_cost = self.message_queue.hook_cost
+            hook_time = (hook_cost - last_hook_cost) / 1e9
+            last_hook_cost = hook_cost
+            self.sampling_interval, self.actions_next_run = self.controller.update(
+                time_to_record / 1e9, time_taken, hook_time, len(self.thread_tasks))
+            # The interval runs from the start of one sample to the next
+            wait_time = max(
+                self.sampling_interval - (now() - start_time) / 1e9, 0.0)
             last_start_time = start_time
             self.total_overhead += time_taken
-            self.granularity_sum += time_to_record
+            self.total_hook_overhead += hook_time
+            self.granularity_sum += time_to_record / 1e9
             self.total_samples += 1
 
     def start(self):
         if self.thread:
             return
+        if self.clock_calibration is None:
+            self.clock_calibration = calibrate()
+        self._switch_writer()
         self.stopped = False
         self.thread = threading.Thread(
             target=self._profiler_loop, name='Profilomatic Thread')
@@ -221,41 +610,164 @@ class Profiler(object):
             self.stopped = True
             self.thread.join()
             self.thread = None
+        if self.writer:
+            self._stop_writer()
+        else:
+            self._flush_destinations()
+
+    def _switch_writer(self):
+        """
+        Start or stop the writer thread, if emit_queue_size has been turned
+        on or off since it was last looked at
+        """
+        if self.emit_queue_size and self.writer is None:
+            writer = AsyncWriter(
+                self._write_batch, self.emit_queue_size, self.emit_batch_size,
+                self.emit_overflow, self._flush_destinations)
+            writer.start()
+            self.writer = writer
+        elif not self.emit_queue_size and self.writer is not None:
+            self._stop_writer()
+
+    def _stop_writer(self):
+        # Everything still queued is written before the writer goes
+        self.writer.stop()
+        self._release_written()
+        self.writer = None
 
 
     def current_task_uuid(self):
         try:
-            return self.action_context.stack[-1]
+            return self.action_context.get().stack[-1]
         except:
             return None
 
 
     def _ingest_message(self, message):
-        thread = message.thread
+        unit = message.unit
+        if unit is None:
+            unit = message.thread
         task = message.message[TASK_UUID_FIELD]
-        call_graph = self.call_graphs.get((thread, task))
+        call_graph = self.call_graphs.get((unit, task))
         if not call_graph:
-            call_graph = CallGraphRoot(
-                thread,
-                task,
-                message.clock,
+            call_graph = self._new_call_graph(
+                message.thread, task,
+                self.wall_clock_minus_monotonic + to_timedelta(message.monotonic),
                 message.monotonic)
-            self.call_graphs[(thread, task)] = call_graph
-        call_stack = generate_stack_trace(message.frame, self.code_granularity, True)
-        call_graph.ingest(call_stack, 0.0, message.monotonic, message.message)
+            self.call_graphs[(unit, task)] = call_graph
+            if self.retention != 'all':
+                self.task_types[(unit, task)] = \
+                    message.message.get(ACTION_TYPE_FIELD)
+            if self.snapshot_interval:
+                self.snapshots[(unit, task)] = [0, message.monotonic]
+        call_stack = resolve_stack(
+            message.stack, self.code_granularity, self.use_symbol_table)
+        call_graph.ingest(call_stack, 0, message.monotonic, message.message)
         next_task_uuid = message.next_task_uuid
         if next_task_uuid is None:
-            self._emit(call_graph)
-            del self.thread_tasks[message.thread]
-            del self.call_graphs[(thread, task)]
+            self._end_task(unit, task)
+        else:
+            if self.thread_tasks.get(unit) != next_task_uuid:
+                # Samples now go to a different call graph, so the last
+                # sample's shared prefix means nothing to it
+                self.thread_stacks.pop(unit, None)
+            self.thread_tasks[unit] = next_task_uuid
+
+    def _end_task(self, unit, task, truncated=False):
+        call_graph = self.call_graphs.pop((unit, task), None)
+        snapshot = self.snapshots.pop((unit, task), None)
+        action_type = self.task_types.pop((unit, task), None)
+        if call_graph is not None:
+            if snapshot is None or snapshot[0] == 0:
+                if self._retain(call_graph, action_type):
+                    self._emit(call_graph, truncated=truncated)
+                else:
+                    self.discarded_tasks += 1
+                    call_graph.release()
+            else:
+                self._emit(call_graph, snapshot[0], truncated=truncated)
+        self.thread_tasks.pop(unit, None)
+        # Don't keep the thread's frames alive once it's not profiled
+        self.thread_stacks.pop(unit, None)
+
+    def _retain(self, call_graph, action_type):
+        """
+        Whether a finished task's call graph is worth emitting. Only asked
+        of tasks without snapshots - the rest of those is always emitted.
+        """
+        if self.retention == 'all':
+            return True
+        root = next(call_graph.walk())
+        return self.retention_control.keep(action_type, (root[5] - root[4]) / 1e9)
+
+    def _new_call_graph(self, thread, task, clock, monotime):
+        return _lookup_call_graph_engine(self.call_graph_engine)(
+            thread, task, clock, monotime)
+
+    def _emit(self, call_graph, snapshot=None, partial=False, truncated=False):
+        """
+        Send a call graph to the destinations, through the writer thread if
+        it's running. The call graph is released once it's been written.
+        """
+        fields = {'source': self.source_name}
+        if snapshot is not None:
+            fields['snapshot'] = snapshot
+            if partial:
+                fields['partial'] = True
+        if truncated:
+            fields['truncated'] = True
+        writer = self.writer
+        if writer is not None:
+            writer.put((call_graph, fields))
         else:
-            self.thread_tasks[message.thread] = next_task_uuid
+            self._write_batch([(call_graph, fields)])
+            call_graph.release()
+
+    def _release_written(self):
+        writer = self.writer
+        if writer is not None:
+            done = writer.done
+            while done:
+                call_graph, fields = done.popleft()
+                call_graph.release()
 
-    def _emit(self, message):
-        jsonized = message.jsonize()
-        jsonized['source'] = self.source_name
+    def _flush_destinations(self):
+        for destination in self.destinations:
+            flush = getattr(destination, 'flush', None)
+            if flush is not None:
+                try:
+                    flush()
+                except:
+                    traceback.print_exc()
+
+    def _write_batch(self, batch):
+        """
+        Write (call graph, top-level fields) pairs to every destination.
+        Destinations with a `write_call_graphs` method get the whole batch
+        at once, and ones with a `write_call_graph` method have each call
+        graph serialized straight into their buffers. Other destinations
+        are called with each call graph as dicts.
+        """
+        symbols = symbol_table if self.use_symbol_table else None
+        time_format = self.time_format
+        jsonized = None
         for destination in self.destinations:
             try:
-                destination(jsonized)
+                write_call_graphs = getattr(destination, 'write_call_graphs', None)
+                write_call_graph = getattr(destination, 'write_call_graph', None)
+                if write_call_graphs is not None:
+                    write_call_graphs(batch, symbols, time_format)
+                elif write_call_graph is not None:
+                    for call_graph, fields in batch:
+                        write_call_graph(call_graph, symbols, time_format, fields)
+                else:
+                    if jsonized is None:
+                        jsonized = []
+                        for call_graph, fields in batch:
+                            result = call_graph.jsonize(symbols, time_format)
+                            result.update(fields)
+                            jsonized.append(result)
+                    for result in jsonized:
+                        destination(result)
             except:
                 traceback.print_exc()  # Can we do better?
@@ -0,0 +1,113 @@
+"""
+Deciding, once a task has finished, whether its call graph is worth
+emitting. Most tasks are fast and healthy, and nobody looks at their call
+graphs, so tail-based retention only keeps slow ones - either tasks that
+took longer than a fixed threshold, or the slowest of each action type,
+judged against a live estimate of that action type's latency percentile.
+
+The percentiles come from a QuantileSketch per action type: a histogram
+with logarithmically-sized buckets, so its estimates are within a fixed
+relative error, whatever the latencies, in a bounded amount of memory.
+Older tasks count for less and less, so the estimates follow changes in
+the application's performance.
+"""
+import math
+
+from .admission import OTHER_TYPE, UNTYPED
+
+
+class QuantileSketch(object):
+    """
+    Estimates quantiles of positive values, to within `accuracy` relative
+    error. Every `half_life` values added, the counts so far are halved.
+    """
+    __slots__ = ['log_gamma', 'min_value', 'counts', 'count', 'half_life',
+                 'until_decay']
+
+    def __init__(self, accuracy=0.02, half_life=1000, min_value=1e-6):
+        self.log_gamma = math.log((1.0 + accuracy) / (1.0 - accuracy))
+        self.min_value = min_value  # Smaller values share the lowest bucket
+        self.counts = {}
+        self.count = 0.0
+        self.half_life = half_life
+        self.until_decay = half_life
+
+    def add(self, value):
+        bucket = int(math.ceil(
+            math.log(max(value, self.min_value)) / self.log_gamma))
+        counts = self.counts
+        counts[bucket] = counts.get(bucket, 0.0) + 1.0
+        self.count += 1.0
+        self.until_decay -= 1
+        if self.until_decay <= 0:
+            self.until_decay = self.half_life
+            self.count *= 0.5
+            for bucket, count in list(counts.items()):
+                if count < 0.01:
+                    del counts[bucket]
+                else:
+                    counts[bucket] = count * 0.5
+
+    def quantile(self, q):
+        """
+        The estimated `q` quantile (0 to 1) of the values added, or None
+        if none have been
+        """
+        if not self.counts:
+            return None
+        rank = q * self.count
+        seen = 0.0
+        buckets = sorted(self.counts)
+        for bucket in buckets:
+            seen += self.counts[bucket]
+            if seen >= rank:
+                break
+        # The middle of the bucket, in relative terms
+        return 2.0 * math.exp(bucket * self.log_gamma) / (
+            1.0 + math.exp(self.log_gamma))
+
+
+class Retention(object):
+    """
+    Decides whether to keep finished tasks' call graphs. With a `threshold`,
+    in seconds, tasks at least that long are kept. With a `percentile`
+    (0 to 1), tasks at least as slow as that percentile of their action
+    type are kept, once `min_tasks` of the action type have been seen -
+    until then, everything is. At most `max_types` action types get a
+    sketch of their own, and any more share one.
+    """
+    __slots__ = ['threshold', 'percentile', 'min_tasks', 'max_types',
+                 'sketches', 'seen']
+
+    def __init__(self, threshold=None, percentile=None, min_tasks=100,
+                 max_types=100):
+        self.threshold = threshold
+        self.percentile = percentile
+        self.min_tasks = min_tasks
+        self.max_types = max_types
+        self.sketches = {}
+        self.seen = {}
+
+    def keep(self, action_type, duration):
+        """
+        Whether to keep a task of `action_type`, that took `duration`
+        seconds
+        """
+        if self.threshold is not None:
+            return duration >= self.threshold
+        if self.percentile is None:
+            return True
+        if action_type is None:
+            action_type = UNTYPED
+        sketch = self.sketches.get(action_type)
+        if sketch is None:
+            if len(self.sketches) >= self.max_types:
+                action_type = OTHER_TYPE
+                sketch = self.sketches.get(action_type)
+            if sketch is None:
+                sketch = self.sketches[action_type] = QuantileSketch()
+                self.seen[action_type] = 0
+        cutoff = sketch.quantile(self.percentile)
+        sketch.add(duration)
+        seen = self.seen[action_type] = self.seen[action_type] + 1
+        return seen <= self.min_tasks or duration >= cutoff
@@ -0,0 +1,158 @@
+"""
+A bounded queue for messages on their way from application threads to the
+profiler thread. Each application thread gets a preallocated ring of its
+own, so it only ever has one writer (that thread) and one reader (the
+profiler thread), and neither needs a lock - the GIL makes each slot and
+position update atomic.
+
+Each ring also counts the time its thread has spent in the profiling
+hooks, for the profiler's overhead controller.
+"""
+import threading
+from collections import deque
+
+
+class MessageRing(object):
+    """
+    A fixed-size single-producer, single-consumer ring. `head` and `tail`
+    count items read and written, and only ever increase.
+
+    The producer can also mark the current write position with `mark`,
+    which the consumer finds once it has read everything written before
+    it. A mark can say which unit (asyncio Task, say) it's for - otherwise
+    it's for the ring's thread.
+    """
+    __slots__ = ['slots', 'capacity', 'head', 'tail', 'marks', 'thread',
+                 'dropped', 'high_water', 'hook_cost']
+
+    def __init__(self, capacity, thread):
+        self.capacity = max(capacity, 1)
+        self.slots = [None] * self.capacity
+        self.head = 0
+        self.tail = 0
+        self.marks = deque()
+        self.thread = thread
+        self.dropped = 0
+        self.high_water = 0
+        self.hook_cost = 0  # Nanoseconds, only added to by the producer
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, item):
+        """
+        Add an item, returning False (and counting it as dropped) if the
+        ring is full. Only call from the producer thread.
+        """
+        tail = self.tail
+        used = tail - self.head
+        if used >= self.capacity:
+            self.dropped += 1
+            return False
+        self.slots[tail % self.capacity] = item
+        self.tail = tail + 1
+        if used >= self.high_water:
+            self.high_water = used + 1
+        return True
+
+    def mark(self, unit=None):
+        self.marks.append((self.tail, unit))
+
+    def popleft(self):
+        """
+        Remove and return the oldest item, or raise IndexError if there
+        isn't one. Only call from the consumer thread.
+        """
+        head = self.head
+        if head == self.tail:
+            raise IndexError('pop from an empty ring')
+        index = head % self.capacity
+        item = self.slots[index]
+        self.slots[index] = None  # Don't keep frames alive
+        self.head = head + 1
+        return item
+
+
+class MessageQueue(object):
+    """
+    A MessageRing per producer thread, each holding up to `capacity`
+    items. Changing `capacity` only affects threads that haven't yet
+    appended anything.
+    """
+    __slots__ = ['capacity', 'rings', 'local', 'lock', 'retired_dropped',
+                 'retired_high_water', 'retired_hook_cost']
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.rings = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.retired_dropped = 0
+        self.retired_high_water = 0
+        self.retired_hook_cost = 0
+
+    def ring(self):
+        """
+        The calling thread's ring
+        """
+        ring = getattr(self.local, 'ring', None)
+        if ring is None:
+            thread = threading.current_thread()
+            ring = self.local.ring = MessageRing(self.capacity, thread)
+            with self.lock:
+                self.rings = self.rings + [ring]
+        return ring
+
+    def append(self, item):
+        return self.ring().append(item)
+
+    def popleft(self):
+        for ring in self.rings:
+            if len(ring):
+                return ring.popleft()
+        raise IndexError('pop from an empty queue')
+
+    def __len__(self):
+        return sum(len(ring) for ring in self.rings)
+
+    @property
+    def dropped(self):
+        return self.retired_dropped + sum(ring.dropped for ring in self.rings)
+
+    @property
+    def high_water(self):
+        return max([self.retired_high_water]
+                   + [ring.high_water for ring in self.rings])
+
+    @property
+    def hook_cost(self):
+        return self.retired_hook_cost + sum(ring.hook_cost for ring in self.rings)
+
+    def drain(self, handle, handle_mark):
+        """
+        Pass every waiting item to `handle`, in order for each producer
+        thread. When a ring's mark is reached, `handle_mark` is called with
+        the unit it was made for, or the ident of the thread that made it. Rings belonging to threads
+        that have finished are discarded once they're empty.
+        """
+        finished = []
+        for ring in self.rings:
+            marks = ring.marks
+            while True:
+                if marks and marks[0][0] == ring.head:
+                    unit = marks.popleft()[1]
+                    handle_mark(ring.thread.ident if unit is None else unit)
+                elif len(ring):
+                    handle(ring.popleft())
+                else:
+                    break
+            if not ring.thread.is_alive() and not len(ring) and not marks:
+                finished.append(ring)
+        if finished:
+            with self.lock:
+                self.rings = [ring for ring in self.rings if ring not in finished]
+            for ring in finished:
+                self.retired_dropped += ring.dropped
+                self.retired_high_water = max(
+                    self.retired_high_water, ring.high_water)
+                self.retired_hook_cost += ring.hook_cost
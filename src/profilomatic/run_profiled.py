@@ -7,7 +7,10 @@ import runpy
 import socket
 import sys
 
-from profilomatic.output import file_destination, no_flush_destination
+from profilomatic.binary import BinaryDestination
+from profilomatic.spool import SpooledDestination
+from profilomatic.output import file_destination, no_flush_destination, \
+    RotatingFileDestination
 
 
 def percentage(s):
@@ -24,12 +27,48 @@ parser.add_argument(
     '-s', '--source-name', default=platform.node(),
     help='The name of the data source - usually hostname or app name')
 parser.add_argument(
-    '-o', '--output-file', type=argparse.FileType('w'),
+    '-o', '--output-file', type=str,
     help='A file where profiler output should be sent')
+parser.add_argument(
+    '-b', '--binary-output-file', type=argparse.FileType('wb'),
+    help='A file where profiler output should be sent, in the compact binary format'
+)
 parser.add_argument(
     '--no-flush', action='store_true',
     help='Do not flush profiling data to file after writing - can reduce overhead, but risks data loss'
 )
+parser.add_argument(
+    '--flush-interval', type=float,
+    help='Buffer output to the output file, and flush it this often, in seconds, rather than after every task'
+)
+parser.add_argument(
+    '--rotate-bytes', type=int, default=0,
+    help='Rotate the output file once it reaches this size - 0 to never rotate on size'
+)
+parser.add_argument(
+    '--rotate-interval', type=float, default=0,
+    help='Rotate the output file this often, in seconds - 0 to never rotate on time'
+)
+parser.add_argument(
+    '--compress', choices=['gzip', 'lzma'],
+    help='Compress output files once they have been rotated'
+)
+parser.add_argument(
+    '--keep-files', type=int, default=0,
+    help='How many rotated output files to keep - 0 to keep them all'
+)
+parser.add_argument(
+    '--keep-bytes', type=int, default=0,
+    help='The most disk space rotated output files may use, before the oldest are deleted - 0 for unlimited'
+)
+parser.add_argument(
+    '--spool-file', type=str,
+    help='Keep profiler output in this memory-mapped file until it has been sent, so it survives the process being killed'
+)
+parser.add_argument(
+    '--spool-size', type=int, default=16 * 1024 * 1024,
+    help='The size of the spool file, in bytes'
+)
 parser.add_argument(
     '-i', '--output-socket', type=str,
     help='A TCP address where profiler output should be sent')
@@ -53,6 +92,98 @@ parser.add_argument(
     '-l', '--all-logs', action='store_true',
     help='Store all logs in profiler call graphs, not just action start and end messages'
 )
+parser.add_argument(
+    '--symbol-table', action='store_true',
+    help='Output each call graph with a table of instructions, referring to them by index, to reduce output size'
+)
+parser.add_argument(
+    '--call-graph-engine', choices=['object', 'array'], default='object',
+    help='How in-flight call graphs are stored - as objects, or in pooled arrays that create less garbage'
+)
+parser.add_argument(
+    '--time-format', choices=['iso', 'offset'], default='iso',
+    help='Output node times as ISO 8601 timestamps, or as offsets in seconds from each call graph\'s base_time, which is faster'
+)
+parser.add_argument(
+    '--max-nodes-per-task', type=int, default=0,
+    help='The most call graph nodes a single task may use before its coldest code is coalesced - 0 for unlimited'
+)
+parser.add_argument(
+    '--max-bytes-per-task', type=int, default=0,
+    help='The most memory (approximately) a single task\'s call graph may use before its coldest code is coalesced - 0 for unlimited'
+)
+parser.add_argument(
+    '--max-nodes', type=int, default=0,
+    help='The most call graph nodes all in-flight tasks may use together - 0 for unlimited'
+)
+parser.add_argument(
+    '--max-bytes', type=int, default=0,
+    help='The most memory (approximately) all in-flight call graphs may use together - 0 for unlimited'
+)
+parser.add_argument(
+    '--snapshot-interval', type=float, default=0,
+    help='How often, in seconds, to output what has been recorded so far for long-running tasks - 0 to only output tasks when they finish'
+)
+parser.add_argument(
+    '--emit-queue-size', type=int, default=100,
+    help='How many call graphs may wait to be written by the writer thread - 0 to write them on the profiler thread'
+)
+parser.add_argument(
+    '--emit-batch-size', type=int, default=10,
+    help='The most call graphs the writer thread writes to the destinations at once'
+)
+parser.add_argument(
+    '--emit-overflow', choices=['drop_oldest', 'block'], default='drop_oldest',
+    help='What to do when the writer thread falls behind - drop the oldest waiting call graph, or make the profiler wait'
+)
+parser.add_argument(
+    '--message-queue-size', type=int, default=1000,
+    help='How many messages each application thread may have waiting for the profiler thread'
+)
+parser.add_argument(
+    '--message-overflow', choices=['drop', 'end_task'], default='drop',
+    help='What to do when an application thread has too many messages waiting - drop them, or stop profiling its task'
+)
+parser.add_argument(
+    '--clock', choices=['coarse', 'fine'], default='coarse',
+    help='The clock to timestamp samples and messages with - coarse is cheaper to read, but only ticks every few milliseconds'
+)
+parser.add_argument(
+    '--overhead-clock', choices=['coarse', 'fine', 'thread_cpu'], default='thread_cpu',
+    help='The clock to measure the profiler\'s own overhead with - thread_cpu only counts the CPU time the profiler thread uses'
+)
+parser.add_argument(
+    '--overhead-controller', choices=['pi', 'fixed'], default='pi',
+    help='How to keep overhead on target - pi tunes the sampling interval and tasks profiled, fixed leaves them alone'
+)
+parser.add_argument(
+    '--admission', choices=['stratified', 'shared'], default='stratified',
+    help='How to choose tasks to profile - share the slots between action types, or first-come-first-served'
+)
+parser.add_argument(
+    '--min-action-rate', type=float, default=0.1,
+    help='How many tasks a second of each action type to profile, however busy the profiler is'
+)
+parser.add_argument(
+    '--max-action-types', type=int, default=100,
+    help='The most action types to admit and count separately - any more share one'
+)
+parser.add_argument(
+    '--retention', choices=['all', 'threshold', 'percentile'], default='all',
+    help='Which finished tasks to output - all of them, ones slower than the retention threshold, or ones slower than the retention percentile of their action type'
+)
+parser.add_argument(
+    '--retention-threshold', type=float, default=1.0,
+    help='How long, in seconds, tasks must take to be output, with threshold retention'
+)
+parser.add_argument(
+    '--retention-percentile', type=percentage, default=0.99,
+    help='The latency percentile of their action type tasks must reach to be output, with percentile retention, expressed as a fraction or percentage'
+)
+parser.add_argument(
+    '--no-latency', action='store_false', dest='track_latency',
+    help='Do not keep latency histograms for tasks that are not profiled (or any others)'
+)
 parser.add_argument(
     '-e', '--eliot', action='store_true',
     help='Monkey patch eliot, to allow profiler to record remote task creation'
@@ -80,6 +211,11 @@ parser.add_argument(
 
 
 args = parser.parse_args()
+if (args.compress or args.keep_files or args.keep_bytes) \
+        and not (args.rotate_bytes or args.rotate_interval):
+    # Only rotated files are compressed or cleaned up
+    parser.error('--compress, --keep-files and --keep-bytes need '
+                 '--rotate-bytes or --rotate-interval')
 
 profilomatic.configure(
     source_name=args.source_name,
@@ -87,7 +223,30 @@ profilomatic.configure(
     max_overhead=args.max_overhead,
     time_granularity=args.time_granularity,
     code_granularity=args.code_granularity,
-    store_all_logs=args.all_logs
+    store_all_logs=args.all_logs,
+    use_symbol_table=args.symbol_table,
+    call_graph_engine=args.call_graph_engine,
+    time_format=args.time_format,
+    max_nodes_per_task=args.max_nodes_per_task,
+    max_bytes_per_task=args.max_bytes_per_task,
+    max_nodes=args.max_nodes,
+    max_bytes=args.max_bytes,
+    snapshot_interval=args.snapshot_interval,
+    emit_queue_size=args.emit_queue_size,
+    emit_batch_size=args.emit_batch_size,
+    emit_overflow=args.emit_overflow,
+    message_queue_size=args.message_queue_size,
+    message_overflow=args.message_overflow,
+    clock=args.clock,
+    overhead_clock=args.overhead_clock,
+    overhead_controller=args.overhead_controller,
+    admission=args.admission,
+    min_action_rate=args.min_action_rate,
+    max_action_types=args.max_action_types,
+    retention=args.retention,
+    retention_threshold=args.retention_threshold,
+    retention_percentile=args.retention_percentile,
+    track_latency=args.track_latency
 )
 
 if args.eliot:
@@ -97,28 +256,51 @@ if args.eliot:
 if args.monitor:
     profilomatic.monitor.enable_prometheus()
 
-if args.output_file:
+destinations = []
+if args.output_file and (args.flush_interval is not None or args.rotate_bytes
+                         or args.rotate_interval):
+    destinations.append(RotatingFileDestination(
+        args.output_file,
+        flush_interval=1.0 if args.flush_interval is None else args.flush_interval,
+        max_bytes=args.rotate_bytes,
+        rotate_interval=args.rotate_interval,
+        compress=args.compress,
+        backup_count=args.keep_files,
+        max_total_bytes=args.keep_bytes))
+elif args.output_file:
+    output_file = sys.stdout if args.output_file == '-' else open(args.output_file, 'w')
     if not args.no_flush:
-        profilomatic.add_destination(file_destination(args.output_file))
+        destinations.append(file_destination(output_file))
     else:
-        profilomatic.add_destination(no_flush_destination(args.output_file))
+        destinations.append(no_flush_destination(output_file))
+if args.binary_output_file:
+    destinations.append(
+        BinaryDestination(args.binary_output_file, not args.no_flush))
 if args.output_socket:
     host, port = args.output_socket.split(':')
     port = int(port)
     s = socket.socket()
     s.connect((host, port))
-    profilomatic.add_destination(file_destination(s.makefile()))
-if not (args.output_socket or args.output_file):
-    profilomatic.add_destination(file_destination(sys.stderr))
+    destinations.append(file_destination(s.makefile()))
+if not (args.output_socket or args.output_file or args.binary_output_file):
+    destinations.append(file_destination(sys.stderr))
+if args.spool_file:
+    profilomatic.add_destination(
+        SpooledDestination(args.spool_file, destinations, args.spool_size))
+else:
+    for destination in destinations:
+        profilomatic.add_destination(destination)
 
 sys.argv = [args.target] + args.target_args
 
 if args.profile_profiler:
-    from .profiler import CallGraphRoot, monotonic, generate_stack_trace
+    from .profiler import CallGraphRoot, generate_stack_trace
+    from .clock import clock_ns
     import time
     import datetime
     import threading
     profiler_thread_id = profilomatic._instance.thread.ident
+    monotonic = clock_ns('fine')
     profiler_callgraph = CallGraphRoot(
         profiler_thread_id,
         'profile',
@@ -0,0 +1,91 @@
+"""
+Helpers shared by the call graph engines, for turning call graphs into
+JSON.
+"""
+import json
+
+from .clock import to_timedelta
+from .thread_state import STATE_NAMES
+
+
+def time_formatter(wall_clock_minus_monotonic, base_monotonic, time_format,
+                   as_json=False):
+    """
+    Make a function that converts monotonic times, in nanoseconds, to
+    output timestamps, or to JSON text for them if `as_json` is set. With
+    the 'iso' format, timestamps are ISO 8601 strings, and nodes usually
+    share a lot of them, so each is only formatted once. With the 'offset'
+    format, they are seconds since `base_monotonic`.
+    """
+    if time_format == 'iso':
+        cache = {}
+        quote = json.dumps if as_json else str
+
+        def format_time(monotonic):
+            formatted = cache.get(monotonic)
+            if formatted is None:
+                formatted = cache[monotonic] = quote((
+                    wall_clock_minus_monotonic
+                    + to_timedelta(monotonic)).isoformat())
+            return formatted
+    elif time_format == 'offset':
+        if as_json:
+            def format_time(monotonic):
+                return repr((monotonic - base_monotonic) / 1e9)
+        else:
+            def format_time(monotonic):
+                return (monotonic - base_monotonic) / 1e9
+    else:
+        raise ValueError('Time format must be iso or offset')
+    return format_time
+
+
+def instruction_encoder(local_ids):
+    """
+    Make a function that gives the JSON text for an instruction. If
+    `local_ids` is given, instructions are symbol ids, that get renumbered
+    in the order they're first seen, as the keys of `local_ids`.
+    """
+    cache = {}
+
+    def encode_instruction(instruction_pointer):
+        encoded = cache.get(instruction_pointer)
+        if encoded is None:
+            if local_ids is None:
+                encoded = json.dumps(instruction_pointer)
+            else:
+                local_ids[instruction_pointer] = len(local_ids)
+                encoded = str(local_ids[instruction_pointer])
+            cache[instruction_pointer] = encoded
+        return encoded
+    return encode_instruction
+
+
+def state_seconds(state_times):
+    """
+    The time a node's samples spent in each thread state, in seconds, from
+    a sequence of times in nanoseconds, indexed by state. States with no
+    time are left out.
+    """
+    return dict(
+        (name, time / 1e9) for name, time in zip(STATE_NAMES, state_times) if time)
+
+
+def root_fields(task_uuid, thread, wall_clock_minus_monotonic, base_monotonic,
+                symbol_table, local_ids, time_format):
+    """
+    The fields that only the top level of a call graph's output has
+    """
+    fields = {}
+    if symbol_table is not None:
+        symbols = [None] * len(local_ids)
+        for symbol_id, local_id in local_ids.items():
+            symbols[local_id] = symbol_table[symbol_id]
+        fields['symbols'] = symbols
+    if time_format == 'offset':
+        fields['base_time'] = (
+            wall_clock_minus_monotonic
+            + to_timedelta(base_monotonic)).isoformat()
+    fields['task_uuid'] = task_uuid
+    fields['thread'] = thread
+    return fields
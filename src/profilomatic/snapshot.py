@@ -0,0 +1,84 @@
+"""
+Tools for working with the partial snapshots that the profiler emits for
+long-running tasks, when `snapshot_interval` is set.
+
+Each snapshot holds only the samples taken since the previous snapshot of
+the same task, and is tagged with the task's `task_uuid` and a `snapshot`
+sequence number. Every snapshot but the last also has `partial` set.
+"""
+
+
+def _resolve(node, symbols):
+    node = dict(node)
+    if symbols is not None and 'instruction' in node:
+        node['instruction'] = symbols[node['instruction']]
+    if 'children' in node:
+        node['children'] = [
+            _resolve(child, symbols) for child in node['children']]
+    return node
+
+
+def _merge_times(target, node):
+    target['time'] += node['time']
+    target['self_time'] += node['self_time']
+    if 'cpu_time' in node:
+        target['cpu_time'] = target.get('cpu_time', 0.0) + node['cpu_time']
+        target['self_cpu_time'] = (
+            target.get('self_cpu_time', 0.0) + node['self_cpu_time'])
+    if 'states' in node:
+        states = target['states'] = dict(target.get('states', {}))
+        for state, time in node['states'].items():
+            states[state] = states.get(state, 0.0) + time
+    # ISO 8601 timestamps in the same zone sort chronologically
+    target['start_time'] = min(target['start_time'], node['start_time'])
+    target['end_time'] = max(target['end_time'], node['end_time'])
+
+
+def _merge_children(target, children):
+    merged = target.setdefault('children', [])
+    for child in children:
+        match = None
+        if 'message' not in child and 'instruction' in child:
+            # Only children after the last message were still being sampled
+            # when the snapshot was taken, like in the live call graph
+            for candidate in reversed(merged):
+                if 'message' in candidate:
+                    break
+                if candidate.get('instruction') == child['instruction']:
+                    match = candidate
+                    break
+        if match is None:
+            merged.append(child)
+        else:
+            _merge_times(match, child)
+            if 'children' in child:
+                _merge_children(match, child['children'])
+
+
+def merge_snapshots(snapshots):
+    """
+    Merge the snapshots of a single task back into one call graph, as it
+    would have been emitted without snapshots. If the snapshots have
+    symbol tables, the merged call graph will have instruction strings
+    instead.
+    """
+    snapshots = sorted(snapshots, key=lambda snapshot: snapshot['snapshot'])
+    if not snapshots:
+        raise ValueError('No snapshots to merge')
+    if len(set(snapshot['task_uuid'] for snapshot in snapshots)) != 1:
+        raise ValueError('Snapshots must all come from the same task')
+    if any('base_time' in snapshot for snapshot in snapshots):
+        raise ValueError('Snapshots must use the iso time format')
+    result = None
+    for snapshot in snapshots:
+        snapshot = _resolve(snapshot, snapshot.get('symbols'))
+        snapshot.pop('symbols', None)
+        snapshot.pop('snapshot')
+        snapshot.pop('partial', None)
+        if result is None:
+            result = snapshot
+        else:
+            _merge_times(result, snapshot)
+            if 'children' in snapshot:
+                _merge_children(result, snapshot['children'])
+    return result
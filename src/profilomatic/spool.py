@@ -0,0 +1,275 @@
+"""
+A crash-safe spool for profiler output: a fixed-size ring of records in a
+memory-mapped file. Appending a record is a memory copy, with no system
+call, and since the pages belong to the file, records survive the process
+being killed. Another process, or the next one to open the spool, can
+drain the records that weren't yet shipped.
+
+The file starts with a header holding MAGIC, the ring's capacity, and the
+read (head) and write (tail) positions, as byte counts that only ever
+increase. Each record is a little-endian 32-bit length and CRC-32,
+followed by the payload. A record that won't fit before the end of the
+ring goes at the start instead, after a wrap marker (if there's room for
+one). The tail is only moved once a record has been written, so a record
+cut short by a crash is never read.
+
+A spool should only have one writer at a time.
+"""
+from __future__ import print_function
+import json
+import mmap
+import os
+import struct
+import sys
+import traceback
+import zlib
+
+from .binary import encode_call_graph, decode_record, to_call_graph, \
+    RecordCallGraph
+
+MAGIC = b'PMSPOOL1'
+
+_HEADER = struct.Struct('<8sQQQ')
+_POSITION = struct.Struct('<Q')
+_HEAD_OFFSET = 16
+_TAIL_OFFSET = 24
+_DATA_OFFSET = 64
+_RECORD = struct.Struct('<II')
+_WRAP = 0xffffffff
+
+_CALL_GRAPH = b'B'
+_JSON = b'J'
+
+
+class Spool(object):
+    """
+    A ring of records in the memory-mapped file `filename`, which is
+    created with room for `capacity` bytes of records if it doesn't exist.
+    When the ring is full, new records are dropped.
+    """
+    __slots__ = ['filename', 'capacity', 'file', 'map', 'appended', 'dropped',
+                 'corrupt']
+
+    def __init__(self, filename, capacity=16 * 1024 * 1024):
+        self.filename = filename
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            self.file = open(filename, 'r+b')
+            header = self.file.read(_HEADER.size)
+            if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+                self.file.close()
+                raise ValueError('Not a Profilomatic spool file')
+            self.capacity = _HEADER.unpack(header)[1]
+            if os.path.getsize(filename) != _DATA_OFFSET + self.capacity:
+                self.file.close()
+                raise ValueError('Spool file is the wrong size')
+        else:
+            self.file = open(filename, 'w+b')
+            self.capacity = capacity
+            self.file.write(_HEADER.pack(MAGIC, capacity, 0, 0))
+            self.file.truncate(_DATA_OFFSET + capacity)
+            self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), _DATA_OFFSET + self.capacity)
+        self.appended = 0
+        self.dropped = 0
+        self.corrupt = 0
+
+    def _position(self, offset):
+        return _POSITION.unpack_from(self.map, offset)[0]
+
+    def pending(self):
+        """
+        The number of bytes of records waiting to be drained
+        """
+        return self._position(_TAIL_OFFSET) - self._position(_HEAD_OFFSET)
+
+    def append(self, payload):
+        """
+        Add a record to the spool, returning whether there was room for it
+        """
+        needed = _RECORD.size + len(payload)
+        head = self._position(_HEAD_OFFSET)
+        tail = self._position(_TAIL_OFFSET)
+        offset = tail % self.capacity
+        to_end = self.capacity - offset
+        skip = to_end if to_end < needed else 0
+        if tail + skip + needed - head > self.capacity:
+            self.dropped += 1
+            return False
+        if skip:
+            if to_end >= _RECORD.size:
+                _RECORD.pack_into(self.map, _DATA_OFFSET + offset, _WRAP, 0)
+            offset = 0
+        start = _DATA_OFFSET + offset
+        _RECORD.pack_into(
+            self.map, start, len(payload), zlib.crc32(payload) & 0xffffffff)
+        self.map[start + _RECORD.size:start + needed] = payload
+        _POSITION.pack_into(self.map, _TAIL_OFFSET, tail + skip + needed)
+        self.appended += 1
+        return True
+
+    def records(self):
+        """
+        Iterate over the records waiting to be drained, as (payload, head)
+        pairs, where head is the read position just after the record. If
+        the spool is corrupt, the rest of it is discarded.
+        """
+        head = self._position(_HEAD_OFFSET)
+        tail = self._position(_TAIL_OFFSET)
+        while head < tail:
+            offset = head % self.capacity
+            to_end = self.capacity - offset
+            if to_end < _RECORD.size:
+                head += to_end
+                continue
+            start = _DATA_OFFSET + offset
+            length, crc = _RECORD.unpack_from(self.map, start)
+            if length == _WRAP:
+                head += to_end
+                continue
+            end = start + _RECORD.size + length
+            payload = self.map[start + _RECORD.size:end] \
+                if _RECORD.size + length <= to_end else None
+            if payload is None or head + _RECORD.size + length > tail \
+                    or zlib.crc32(payload) & 0xffffffff != crc:
+                self.corrupt += 1
+                self.consume(tail)
+                return
+            head += _RECORD.size + length
+            yield payload, head
+
+    def consume(self, head):
+        _POSITION.pack_into(self.map, _HEAD_OFFSET, head)
+
+    def drain(self, handle):
+        """
+        Pass each waiting record's payload to `handle`, removing it from
+        the spool once `handle` returns. If `handle` raises, the record
+        stays in the spool. Returns the number of records drained.
+        """
+        drained = 0
+        for payload, head in self.records():
+            handle(payload)
+            self.consume(head)
+            drained += 1
+        return drained
+
+    def sync(self):
+        """
+        Write the spool to disk, so records survive the machine crashing,
+        as well as the process
+        """
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def decode_payload(payload, time_format='iso'):
+    """
+    Turn a payload written by SpooledDestination back into a call graph
+    dict
+    """
+    kind, body = payload[:1], payload[1:]
+    if kind == _CALL_GRAPH:
+        return to_call_graph(decode_record(body), time_format)
+    elif kind == _JSON:
+        return json.loads(body.decode('utf-8'))
+    else:
+        raise ValueError('Unknown spool record type')
+
+
+class SpooledDestination(object):
+    """
+    A durable local buffer in front of other destinations. Call graphs are
+    encoded in the binary format and appended to a spool, then forwarded
+    to `destinations` whenever the spool is drained - after each write,
+    and when the profiler flushes its destinations. Destinations get call
+    graphs the same way they would from the profiler.
+
+    Records only leave the spool once every destination has taken them,
+    so if a destination fails part way through, the others may get some
+    call graphs twice. Records left by an earlier process are forwarded
+    by the first drain.
+    """
+    def __init__(self, filename, destinations=(), capacity=16 * 1024 * 1024,
+                 time_format='iso', forward_on_write=True):
+        self.spool = Spool(filename, capacity)
+        self.destinations = list(destinations)
+        self._time_format = time_format
+        self._forward_on_write = forward_on_write
+
+    def __call__(self, message):
+        self.spool.append(_JSON + json.dumps(message).encode('utf-8'))
+        if self._forward_on_write:
+            self.forward()
+
+    def write_call_graph(self, call_graph, symbol_table, time_format, fields):
+        self.write_call_graphs([(call_graph, fields)], symbol_table, time_format)
+
+    def write_call_graphs(self, batch, symbol_table, time_format):
+        for call_graph, fields in batch:
+            record = encode_call_graph(call_graph, symbol_table, fields)
+            # The spool has its own framing, so drop the record's length
+            self.spool.append(_CALL_GRAPH + record[4:])
+        if self._forward_on_write:
+            self.forward()
+
+    def forward(self):
+        """
+        Send everything in the spool to the destinations. Returns the
+        number of call graphs sent, stopping at the first failure.
+        """
+        try:
+            return self.spool.drain(self._forward_payload)
+        except:
+            traceback.print_exc()
+            return 0
+
+    def _forward_payload(self, payload):
+        """
+        Send one record on, in whatever form each destination takes, like
+        `Profiler._write_batch`. Records that were written as dicts only
+        go to destinations that take dicts.
+        """
+        kind, body = payload[:1], payload[1:]
+        if kind != _CALL_GRAPH:
+            message = decode_payload(payload, self._time_format)
+            for destination in self.destinations:
+                if callable(destination):
+                    destination(message)
+            return
+        call_graph = RecordCallGraph(decode_record(body))
+        fields = call_graph.record['fields']
+        message = None
+        for destination in self.destinations:
+            write_call_graphs = getattr(destination, 'write_call_graphs', None)
+            write_call_graph = getattr(destination, 'write_call_graph', None)
+            if write_call_graphs is not None:
+                write_call_graphs([(call_graph, fields)], None, self._time_format)
+            elif write_call_graph is not None:
+                write_call_graph(call_graph, None, self._time_format, fields)
+            else:
+                if message is None:
+                    message = call_graph.jsonize(None, self._time_format)
+                destination(message)
+
+    def flush(self):
+        self.forward()
+        for destination in self.destinations:
+            flush = getattr(destination, 'flush', None)
+            if flush is not None:
+                flush()
+
+    def close(self):
+        self.spool.close()
+
+
+if __name__ == '__main__':
+    # Drain a spool, left behind by a dead process, to stdout as lines of JSON
+    if len(sys.argv) != 2:
+        print('Usage: python -m profilomatic.spool SPOOL_FILE', file=sys.stderr)
+        sys.exit(1)
+    spool = Spool(sys.argv[1])
+    spool.drain(lambda payload: print(json.dumps(decode_payload(payload))))
+    spool.close()
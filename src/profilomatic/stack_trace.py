@@ -1,7 +1,12 @@
+from six.moves import intern
+
 gran_file = 0
 gran_method = 1
 gran_line = 2
 
+DEFAULT_SYMBOL_CACHE_SIZE = 10000
+
+
 def _lookup_granularity(granularity):
     if granularity == 'file':
         return gran_file
@@ -13,26 +18,242 @@ def _lookup_granularity(granularity):
         raise ValueError('Granularity must be file, method, or line')
 
 
-def generate_stack_trace(frame, granularity, strip_eliot_frames):
+def _is_profiler_module(module_name):
+    return (module_name == 'eliot' or module_name.startswith('eliot.')
+            or module_name == 'profilomatic' or module_name.startswith('profilomatic.'))
+
+
+class SymbolTable(object):
+    """
+    Assigns small integer ids to instruction strings, so call graphs can
+    hold ids and only resolve them to strings when they are output.
+    """
+    __slots__ = ['ids', 'symbols']
+
+    def __init__(self):
+        self.ids = {}
+        self.symbols = []
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __getitem__(self, symbol_id):
+        return self.symbols[symbol_id]
+
+    def id_for(self, instruction):
+        symbol_id = self.ids.get(instruction)
+        if symbol_id is None:
+            symbol_id = self.ids[instruction] = len(self.symbols)
+            self.symbols.append(instruction)
+        return symbol_id
+
+
+symbol_table = SymbolTable()
+
+
+class SymbolCache(object):
+    """
+    Bounded cache mapping (code object, line number, granularity) to an
+    interned instruction string, a flag saying whether the frame belongs
+    to Eliot or Profilomatic, and the instruction's id in the symbol table.
+
+    Entries live in two generations. When the current generation fills up,
+    it becomes the previous generation, and the old previous generation is
+    dropped. Hits in the previous generation are promoted, so hot code
+    survives eviction.
+    """
+    __slots__ = ['capacity', 'symbol_table', 'hits', 'misses',
+                 '_current', '_previous']
+
+    def __init__(self, capacity=DEFAULT_SYMBOL_CACHE_SIZE, symbol_table=symbol_table):
+        self.capacity = capacity
+        self.symbol_table = symbol_table
+        self.hits = 0
+        self.misses = 0
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def lookup(self, frame, granularity):
+        return self._lookup(frame, _lookup_granularity(granularity))
+
+    def _lookup(self, frame, int_granularity):
+        if int_granularity >= gran_line:
+            lineno = frame.f_lineno
+        else:
+            lineno = 0
+        return self._lookup_code(frame.f_code, lineno, frame.f_globals, int_granularity)
+
+    def _lookup_code(self, code, lineno, f_globals, int_granularity):
+        if int_granularity < gran_line:
+            lineno = 0
+        key = (code, lineno, int_granularity)
+        entry = self._current.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        entry = self._previous.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            items = [code.co_filename]
+            if int_granularity >= gran_method:
+                items.append(code.co_name)
+            if int_granularity >= gran_line:
+                items.append(str(lineno))
+            module_name = f_globals.get('__name__') or ''
+            instruction = intern(':'.join(items))
+            entry = (instruction, _is_profiler_module(module_name),
+                     self.symbol_table.id_for(instruction))
+        if len(self._current) * 2 >= self.capacity:
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = entry
+        return entry
+
+
+symbol_cache = SymbolCache()
+
+
+def generate_stack_trace(frame, granularity, strip_eliot_frames, symbol_ids=False):
     int_granularity = _lookup_granularity(granularity)
+    lookup = symbol_cache._lookup
+    field = 2 if symbol_ids else 0
     result = []
     while frame is not None:
-        items = [frame.f_code.co_filename]
-        if int_granularity >= gran_method:
-            items.append(frame.f_code.co_name)
-        if int_granularity >= gran_line:
-            items.append(str(frame.f_lineno))
-        instruction = ':'.join(items)
+        entry = lookup(frame, int_granularity)
         if strip_eliot_frames:
-            f_globals = frame.f_globals
-            module_name = f_globals['__name__']
-            if not (module_name == 'eliot' or module_name.startswith('eliot.')
-                    or module_name == 'profilomatic' or module_name.startswith('profilomatic.')):
-                result.append(instruction)
+            if not entry[1]:
+                result.append(entry[field])
                 strip_eliot_frames = False
         else:
-            result.append(instruction)
+            result.append(entry[field])
         frame = frame.f_back
 
     result.reverse()
     return result
+
+
+def capture_stack(frame, granularity='line', outermost=None):
+    """
+    Snapshot a stack, so it can be turned into a trace later without
+    keeping its frames (and their local variables) alive. Eliot and
+    Profilomatic frames at the top of the stack are skipped, as
+    `generate_stack_trace` would. The snapshot is a flat list, holding the
+    code object, line number (0 if granularity is coarser than line) and
+    module globals of each frame, innermost first. If `outermost` is on
+    the stack, the snapshot stops there.
+    """
+    lines = _lookup_granularity(granularity) >= gran_line
+    while frame is not None and _is_profiler_module(
+            frame.f_globals.get('__name__') or ''):
+        frame = frame.f_back
+    result = []
+    append = result.append
+    while frame is not None:
+        append(frame.f_code)
+        append(frame.f_lineno if lines else 0)
+        append(frame.f_globals)
+        if frame is outermost:
+            break
+        frame = frame.f_back
+    return result
+
+
+def resolve_stack(stack, granularity, symbol_ids=False):
+    """
+    Turn a snapshot from `capture_stack` into a trace, like the one
+    `generate_stack_trace` gives
+    """
+    int_granularity = _lookup_granularity(granularity)
+    lookup_code = symbol_cache._lookup_code
+    field = 2 if symbol_ids else 0
+    return [
+        lookup_code(stack[i], stack[i + 1], stack[i + 2], int_granularity)[field]
+        for i in range(len(stack) - 3, -1, -3)]
+
+
+_GENERATOR_FLAGS = 0x20 | 0x80 | 0x100 | 0x200
+
+
+class IncrementalStackTrace(object):
+    """
+    Remembers the frames and instructions from the last sample of a thread,
+    so that the next sample only needs to resolve the frames that have
+    changed. Once the walk reaches a frame that was present last time, every
+    frame above it must be unchanged, unless a generator in between has been
+    resumed from somewhere else.
+
+    After each update, `shared` holds the number of leading instructions
+    that are known to be unchanged since the previous update.
+    """
+    __slots__ = ['frames', 'trace', 'frame_index', 'generators', 'shared']
+
+    def __init__(self):
+        self.frames = []
+        self.trace = []
+        self.frame_index = {}
+        self.generators = []
+        self.shared = 0
+
+    def clear(self):
+        self.frames = []
+        self.trace = []
+        self.frame_index = {}
+        self.generators = []
+        self.shared = 0
+
+    def update(self, frame, granularity, symbol_ids=False):
+        int_granularity = _lookup_granularity(granularity)
+        lookup = symbol_cache._lookup
+        field = 2 if symbol_ids else 0
+        frames = self.frames
+        frame_index = self.frame_index
+        new_frames = []
+        new_trace = []
+        depth = None
+        while frame is not None:
+            new_frames.append(frame)
+            new_trace.append(lookup(frame, int_granularity)[field])
+            depth = frame_index.get(id(frame))
+            if depth is not None:
+                break
+            frame = frame.f_back
+
+        if depth is None:
+            depth = 0
+        else:
+            # A generator's parent frame changes if it is resumed by someone
+            # else, in which case nothing above it can be trusted
+            for index in self.generators:
+                if index > depth:
+                    break
+                parent = frames[index - 1] if index > 0 else None
+                if frames[index].f_back is not parent:
+                    self.clear()
+                    return self.update(new_frames[0], granularity, symbol_ids)
+
+        for old_frame in frames[depth:]:
+            del frame_index[id(old_frame)]
+        generators = self.generators
+        while generators and generators[-1] >= depth:
+            generators.pop()
+        new_frames.reverse()
+        new_trace.reverse()
+        del frames[depth:]
+        del self.trace[depth:]
+        for index, new_frame in enumerate(new_frames, depth):
+            frame_index[id(new_frame)] = index
+            if getattr(new_frame.f_code, 'co_flags', 0) & _GENERATOR_FLAGS:
+                generators.append(index)
+        frames.extend(new_frames)
+        self.trace.extend(new_trace)
+        self.shared = depth
+        return self.trace
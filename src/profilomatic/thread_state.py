@@ -0,0 +1,172 @@
+"""
+Classifies what a profiled thread was doing over a sample. There are four
+states:
+
+- 'running': running Python, or native code, on a CPU.
+- 'gil': in the middle of Python code, but not running, which for a
+  Python thread means it was waiting for the GIL.
+- 'blocked': in a call to native code, without using the CPU, so waiting
+  on a lock or a syscall.
+- 'idle': sleeping, or waiting for something to happen, in `time.sleep`,
+  `select`, `poll` or the like.
+
+The CPU time the thread used during the sample does most of the work.
+Where it isn't known, the call the thread is in, if any, is recognised by
+name, and anything else counts as running.
+
+Finding the call means decoding the bytecode of the thread's innermost
+frame, which needs Python 3.4+ (elsewhere, no calls are recognised). The
+result is cached per code object and instruction.
+"""
+import dis
+
+RUNNING = 0
+GIL = 1
+BLOCKED = 2
+IDLE = 3
+
+STATE_NAMES = ('running', 'gil', 'blocked', 'idle')
+STATE_COUNT = len(STATE_NAMES)
+
+# What the instruction a frame is at is doing
+_NOT_A_CALL = 0
+_CALL = 1
+_BLOCKING_CALL = 2
+_IDLE_CALL = 3
+
+BLOCKING_CALLS = frozenset([
+    'acquire', 'acquire_lock', 'wait', 'join', 'communicate', 'waitpid',
+    'wait3', 'wait4', 'flock', 'lockf', 'connect', 'connect_ex', 'recv',
+    'recv_into', 'recvfrom', 'recvfrom_into', 'recvmsg', 'send', 'sendall',
+    'sendto', 'sendmsg', 'sendfile', 'read', 'readinto', 'readline',
+    'readlines', 'write', 'flush', 'fsync', 'fdatasync', 'getaddrinfo',
+    'gethostbyname', 'gethostbyaddr'])
+IDLE_CALLS = frozenset([
+    'sleep', 'select', 'poll', 'control', 'accept', 'pause', 'sigwait',
+    'sigwaitinfo', 'sigtimedwait'])
+
+# Instructions that can come just before a call, and belong to it
+_CALL_PREFIXES = frozenset(['PRECALL', 'KW_NAMES', 'EXTENDED_ARG', 'CACHE'])
+_NAME_LOADS = frozenset([
+    'LOAD_ATTR', 'LOAD_METHOD', 'LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_FAST',
+    'LOAD_DEREF', 'LOAD_CLASSDEREF', 'LOAD_SUPER_ATTR'])
+# How far back from a call to look for its callable
+_MAX_CALL_SCAN = 50
+
+DEFAULT_CALL_CACHE_SIZE = 10000
+
+
+def _argument_slots(instruction):
+    # The number of stack entries above the callable a call consumes,
+    # or None if this isn't a call
+    name = instruction.opname
+    if name == 'CALL_FUNCTION_EX':
+        return 1 + (instruction.arg & 1)
+    if name in ('CALL_FUNCTION_KW', 'CALL_KW'):
+        return instruction.arg + 1  # Plus the tuple of keyword names
+    if name in ('CALL', 'CALL_FUNCTION', 'CALL_METHOD'):
+        return instruction.arg
+    return None
+
+
+def _callee_name(instructions, index, argument_slots):
+    """
+    Work back from the call at `index` to the instruction that loaded the
+    callable, and return the name it loaded, if any. The callable is the
+    first name loaded with at least `argument_slots` entries above it on
+    the stack.
+    """
+    above = 0
+    index -= 1
+    while index >= 0 and instructions[index].opname in _CALL_PREFIXES:
+        index -= 1
+    for i in range(index, max(index - _MAX_CALL_SCAN, -1), -1):
+        instruction = instructions[i]
+        name = instruction.opname
+        if name in _NAME_LOADS and above >= argument_slots:
+            return instruction.argval
+        try:
+            if instruction.opcode >= dis.HAVE_ARGUMENT:
+                above += dis.stack_effect(instruction.opcode, instruction.arg)
+            else:
+                above += dis.stack_effect(instruction.opcode)
+        except (ValueError, TypeError):
+            return None
+    return None
+
+
+def _decode_call(code, lasti):
+    if not hasattr(dis, 'get_instructions'):  # Python 2
+        return _NOT_A_CALL
+    try:
+        instructions = list(dis.get_instructions(code))
+    except Exception:
+        return _NOT_A_CALL
+    for index, instruction in enumerate(instructions):
+        if instruction.offset == lasti:
+            break
+    else:
+        return _NOT_A_CALL
+    argument_slots = _argument_slots(instruction)
+    if argument_slots is None:
+        return _NOT_A_CALL
+    callee = _callee_name(instructions, index, argument_slots)
+    if callee in IDLE_CALLS:
+        return _IDLE_CALL
+    elif callee in BLOCKING_CALLS:
+        return _BLOCKING_CALL
+    else:
+        return _CALL
+
+
+class ThreadStateClassifier(object):
+    """
+    Classifies samples, caching what each (code object, instruction
+    offset) pair is calling. The cache is simply emptied when it fills up.
+    """
+    __slots__ = ['capacity', '_calls']
+
+    def __init__(self, capacity=DEFAULT_CALL_CACHE_SIZE):
+        self.capacity = capacity
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def clear(self):
+        self._calls = {}
+
+    def _call_kind(self, frame):
+        code = frame.f_code
+        lasti = frame.f_lasti
+        key = (code, lasti)
+        kind = self._calls.get(key)
+        if kind is None:
+            kind = _decode_call(code, lasti)
+            if len(self._calls) >= self.capacity:
+                self._calls = {}
+            self._calls[key] = kind
+        return kind
+
+    def classify(self, frame, time, cpu_time=None):
+        """
+        The state of a thread, whose innermost frame is `frame`, that's
+        used `cpu_time` nanoseconds of CPU time over the last `time`
+        nanoseconds, or an unknown amount if `cpu_time` is None
+        """
+        if cpu_time is not None and cpu_time * 2 >= time:
+            return RUNNING
+        kind = self._call_kind(frame)
+        if kind == _IDLE_CALL:
+            return IDLE
+        elif kind == _BLOCKING_CALL:
+            return BLOCKED
+        elif cpu_time is None:
+            return RUNNING
+        elif kind == _CALL:
+            return BLOCKED
+        else:
+            return GIL
+
+
+thread_state_classifier = ThreadStateClassifier()
@@ -0,0 +1,112 @@
+"""
+A writer stage, that writes call graphs to destinations on a thread of its
+own, so slow destinations can't hold up sampling.
+"""
+import threading
+import traceback
+from collections import deque
+
+from .clock import monotonic
+
+OVERFLOW_POLICIES = ('drop_oldest', 'block')
+
+
+class AsyncWriter(object):
+    """
+    Passes items from a bounded queue to `write_batch`, in batches of up to
+    `batch_size`, on its own thread. When the queue is full, `put` either
+    drops the oldest item, or waits for room, depending on `overflow`.
+
+    Items that have been written or dropped are put on `done`, for the
+    caller to clean up on its own thread. If there's a `flush` function,
+    it's called once the writer has been idle for `flush_interval` seconds
+    after writing, and when it stops, so destinations that buffer their
+    output can send it.
+    """
+    __slots__ = [
+        'write_batch', 'queue_size', 'batch_size', 'overflow', 'queue', 'done',
+        'condition', 'thread', 'stopping', 'written', 'dropped', 'batches',
+        'write_time', 'flush', 'flush_interval', 'unflushed']
+
+    def __init__(self, write_batch, queue_size=100, batch_size=10,
+                 overflow='drop_oldest', flush=None, flush_interval=1.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Overflow policy must be drop_oldest or block')
+        self.write_batch = write_batch
+        self.queue_size = max(queue_size, 1)
+        self.batch_size = max(batch_size, 1)
+        self.overflow = overflow
+        self.queue = deque()
+        self.done = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.write_time = 0.0
+        self.flush = flush
+        self.flush_interval = flush_interval
+        self.unflushed = False
+
+    def start(self):
+        if self.thread:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(
+            target=self._writer_loop, name='Profilomatic Writer Thread')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write everything still queued, and stop the writer thread
+        """
+        if self.thread:
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            self.thread.join()
+            self.thread = None
+
+    def put(self, item):
+        with self.condition:
+            while len(self.queue) >= self.queue_size:
+                if self.overflow == 'block' and self.thread and not self.stopping:
+                    self.condition.wait()
+                else:
+                    self.done.append(self.queue.popleft())
+                    self.dropped += 1
+            self.queue.append(item)
+            self.condition.notify_all()
+
+    def _writer_loop(self):
+        while True:
+            with self.condition:
+                if not self.queue and not self.stopping:
+                    self.condition.wait(
+                        self.flush_interval if self.unflushed else None)
+                batch = [self.queue.popleft()
+                         for _ in range(min(self.batch_size, len(self.queue)))]
+                stopping = self.stopping
+                # Make room for anyone blocked in put
+                self.condition.notify_all()
+            if batch:
+                start_time = monotonic()
+                try:
+                    self.write_batch(batch)
+                except:
+                    traceback.print_exc()
+                self.write_time += monotonic() - start_time
+                self.batches += 1
+                self.written += len(batch)
+                self.done.extend(batch)
+                self.unflushed = self.flush is not None
+            elif self.unflushed:
+                self.unflushed = False
+                try:
+                    self.flush()
+                except:
+                    traceback.print_exc()
+            elif stopping:
+                return
@@ -0,0 +1,336 @@
+"""
+Tests that need async syntax, which would stop older Pythons loading the
+test modules that import them
+"""
+import asyncio
+import json
+import sys
+import unittest
+
+from profilomatic.clock import to_nanoseconds as ns
+from profilomatic.coroutines import ActionContext, RunningTasks, TaskStackTrace, \
+    running_task
+from profilomatic.profiler import Profiler
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class CoroutinesTest(unittest.TestCase):
+    def test_action_context(self):
+        context = ActionContext()
+
+        async def task(name):
+            # Tasks start out with the state of whatever made them, so the
+            # profiler makes new state for each action
+            self.assertEqual('main', context.get().name)
+            context.new().name = name
+            await asyncio.sleep(0)
+            self.assertEqual(name, context.get().name)
+            self.assertIs(asyncio.current_task(), running_task())
+
+        async def main():
+            context.new().name = 'main'
+            await asyncio.gather(task('a'), task('b'))
+            self.assertEqual('main', context.get().name)
+
+        run(main())
+        self.assertIsNone(running_task())
+
+    def test_task_stack_trace(self):
+        async def inner(event):
+            await event.wait()
+
+        async def outer(event):
+            await inner(event)
+
+        async def main():
+            event = asyncio.Event()
+            task = asyncio.ensure_future(outer(event))
+            await asyncio.sleep(0)
+            stack_trace = TaskStackTrace(task)
+            trace = stack_trace.update(None, 'method')
+            self.assertFalse(stack_trace.running)
+            self.assertEqual(
+                ['outer', 'inner', 'wait'],
+                [instruction.split(':')[-1] for instruction in trace])
+            self.assertEqual(0, stack_trace.shared)
+            self.assertIs(trace, stack_trace.update(None, 'method'))
+            self.assertEqual(3, stack_trace.shared)
+            event.set()
+            await task
+
+        run(main())
+
+    def test_running_task_stack_trace(self):
+        async def main():
+            stack_trace = TaskStackTrace(asyncio.current_task())
+            trace = stack_trace.update(sys._getframe(), 'method')
+            self.assertTrue(stack_trace.running)
+            self.assertEqual(['main'], [i.split(':')[-1] for i in trace])
+
+        run(main())
+
+    def test_running_tasks(self):
+        async def main():
+            event = asyncio.Event()
+            other = asyncio.ensure_future(event.wait())
+            await asyncio.sleep(0)
+            running_tasks = RunningTasks()
+            current = asyncio.current_task()
+            self.assertTrue(running_tasks.is_running(current))
+            self.assertFalse(running_tasks.is_running(other))
+            self.assertEqual(1, len(running_tasks.tasks))
+            # Told it isn't running, the Task's thread stack isn't searched
+            stack_trace = TaskStackTrace(current)
+            stack_trace.update(sys._getframe(), 'method', running=False)
+            self.assertFalse(stack_trace.running)
+            event.set()
+            await other
+
+        run(main())
+
+    def test_profile_tasks(self):
+        instance = Profiler(code_granularity='method')
+        output = []
+        instance.add_destination(output.append)
+
+        async def handle_a(event):
+            await event.wait()
+
+        async def handle_b(event):
+            await event.wait()
+
+        async def task(task_uuid, handle, event):
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_status': 'started'})
+            await handle(event)
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_status': 'succeeded'})
+
+        async def main():
+            event = asyncio.Event()
+            tasks = [asyncio.ensure_future(task('a', handle_a, event)),
+                     asyncio.ensure_future(task('b', handle_b, event))]
+            await asyncio.sleep(0)
+            instance._profile_once(ns(0.1), instance.now())
+            self.assertEqual(set(tasks), set(instance.thread_tasks))
+            event.set()
+            await asyncio.gather(*tasks)
+            instance._profile_once(0, instance.now())
+
+        run(main())
+        self.assertEqual({}, instance.thread_tasks)
+        graphs = dict((graph['task_uuid'], json.dumps(graph)) for graph in output)
+        self.assertEqual(['a', 'b'], sorted(graphs))
+        self.assertIn('handle_a', graphs['a'])
+        self.assertNotIn('handle_b', graphs['a'])
+        self.assertIn('handle_b', graphs['b'])
+        self.assertNotIn('handle_a', graphs['b'])
+
+
+    def test_task_messages_share_samples_root(self):
+        instance = Profiler(code_granularity='method')
+        output = []
+        instance.add_destination(output.append)
+
+        async def handle(event):
+            await event.wait()
+
+        async def task(event):
+            instance.handle_message({'task_uuid': 'a',
+                                     'action_status': 'started'})
+            await handle(event)
+            instance.handle_message({'task_uuid': 'a',
+                                     'action_status': 'succeeded'})
+
+        async def main():
+            event = asyncio.Event()
+            child = asyncio.ensure_future(task(event))
+            await asyncio.sleep(0)
+            instance._profile_once(ns(0.1), instance.now())
+            event.set()
+            await child
+            instance._profile_once(0, instance.now())
+
+        run(main())
+        graph, = output
+        # Messages are cut at the Task's coroutine, like its samples, rather
+        # than hanging from the event loop's frames
+        self.assertEqual(
+            [('task', 'started'), ('task', None), ('task', 'succeeded')],
+            [(child['instruction'].split(':')[-1],
+              child.get('message', {}).get('action_status'))
+             for child in graph['children']])
+        self.assertEqual(
+            ['handle'], [child['instruction'].split(':')[-1]
+                         for child in graph['children'][1]['children']])
+
+    def test_concurrent_child_tasks(self):
+        instance = Profiler(code_granularity='method')
+        output = []
+        instance.add_destination(output.append)
+
+        async def child(task_uuid, event):
+            # Starts out sharing the parent's state
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_status': 'started'})
+            self.assertEqual([task_uuid], instance.action_context.get().stack)
+            await event.wait()
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_status': 'succeeded'})
+            self.assertEqual(['parent'], instance.action_context.get().stack)
+
+        async def main():
+            instance.handle_message({'task_uuid': 'parent',
+                                     'action_status': 'started'})
+            event = asyncio.Event()
+            children = [asyncio.ensure_future(child('a', event)),
+                        asyncio.ensure_future(child('b', event))]
+            await asyncio.sleep(0)
+            instance._profile_once(ns(0.1), instance.now())
+            self.assertEqual(set(children + [asyncio.current_task()]),
+                             set(instance.thread_tasks))
+            event.set()
+            await asyncio.gather(*children)
+            self.assertEqual(['parent'], instance.action_context.get().stack)
+            instance.handle_message({'task_uuid': 'parent',
+                                     'action_status': 'succeeded'})
+            self.assertIsNone(instance.action_context.get())
+            instance._profile_once(0, instance.now())
+
+        run(main())
+        self.assertEqual({}, instance.thread_tasks)
+        self.assertEqual(['a', 'b', 'parent'],
+                         sorted(graph['task_uuid'] for graph in output))
+        self.assertEqual(1, instance.profiled_tasks)
+
+
+class RecordingProfiler(object):
+    def __init__(self, events):
+        self.events = events
+
+    def handle_message(self, message):
+        self.events.append(message)
+
+
+class ProfiledAsgiAppTest(unittest.TestCase):
+    def call(self, app, scope, messages=()):
+        from profilomatic.asgi import ProfiledApp
+        events = []
+        incoming = list(messages)
+
+        async def receive():
+            return incoming.pop(0)
+
+        async def send(message):
+            events.append(message)
+
+        run(ProfiledApp(app, RecordingProfiler(events))(scope, receive, send))
+        return events
+
+    def test_streaming_response(self):
+        seen = []
+
+        async def app(scope, receive, send):
+            seen.append(scope)
+            await send({'type': 'http.response.start', 'status': 200})
+            for chunk in [b'a', b'b']:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        scope = {'type': 'http', 'path': '/stream', 'root_path': '/app',
+                 'query_string': b'a=1&a=2', 'server': ('example', 80),
+                 'headers': [(b'accept', b'*/*')]}
+        events = self.call(app, scope)
+        start, end = events[0], events[-1]
+        task_uuid = start['task_uuid']
+        self.assertEqual({
+            'task_uuid': task_uuid,
+            'action_type': '/stream',
+            'action_status': 'started',
+            'query_string': {'a': ['1', '2']},
+            'host': 'example:80',
+            'script_name': '/app',
+            'path_info': '/stream'
+        }, start)
+        # The task only ends once the last chunk has been sent
+        self.assertEqual(6, len(events))
+        self.assertEqual({'task_uuid': task_uuid, 'action_type': '/stream',
+                          'action_status': 'succeeded'}, end)
+        # The app sees its task, but the server's scope isn't changed
+        self.assertIn((b'x-task-uuid', task_uuid.encode()), seen[0]['headers'])
+        self.assertEqual([(b'accept', b'*/*')], scope['headers'])
+
+    def test_unix_socket_host(self):
+        async def app(scope, receive, send):
+            pass
+
+        for server, host in [(('/run/app.sock', None), '/run/app.sock'),
+                             (('example', 8000), 'example:8000'),
+                             (None, '')]:
+            events = self.call(app, {'type': 'http', 'path': '/',
+                                     'server': server})
+            self.assertEqual(host, events[0]['host'])
+
+    def test_failure(self):
+        from profilomatic.asgi import ProfiledApp
+        events = []
+
+        async def app(scope, receive, send):
+            raise ValueError('Broken')
+
+        with self.assertRaises(ValueError):
+            run(ProfiledApp(app, RecordingProfiler(events))(
+                {'type': 'http', 'path': '/broken'}, None, None))
+        self.assertEqual(['started', 'failed'],
+                         [event['action_status'] for event in events])
+        self.assertEqual('/broken', events[1]['action_type'])
+
+    def test_websocket_lifetime(self):
+        async def app(scope, receive, send):
+            await send({'type': 'websocket.accept'})
+            while (await receive())['type'] != 'websocket.disconnect':
+                await send({'type': 'websocket.send', 'text': 'echo'})
+
+        scope = {'type': 'websocket', 'path': '/ws',
+                 'headers': [(b'host', b'example.com'),
+                             (b'x-task-uuid', b'1234')]}
+        events = self.call(app, scope, [{'type': 'websocket.receive'},
+                                        {'type': 'websocket.disconnect'}])
+        self.assertEqual(
+            ['started', None, None, 'succeeded'],
+            [event.get('action_status') for event in events])
+        self.assertEqual('1234', events[0]['task_uuid'])
+        self.assertEqual('example.com', events[0]['host'])
+
+    def test_lifespan_not_profiled(self):
+        async def app(scope, receive, send):
+            await send({'type': 'lifespan.startup.complete'})
+
+        events = self.call(app, {'type': 'lifespan'})
+        self.assertEqual([{'type': 'lifespan.startup.complete'}], events)
+
+    def test_profiled(self):
+        from profilomatic.asgi import ProfiledApp
+        instance = Profiler()
+
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200})
+
+        async def send(message):
+            pass
+
+        run(ProfiledApp(app, instance)(
+            {'type': 'http', 'path': '/', 'headers': []}, None, send))
+        messages = []
+        instance.message_queue.drain(messages.append, lambda unit: None)
+        self.assertEqual(['started', 'succeeded'],
+                         [m.message['action_status'] for m in messages])
+        self.assertIsNotNone(messages[0].unit)  # Profiled by Task
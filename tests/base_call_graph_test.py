@@ -1,18 +1,24 @@
 import datetime
+import io
+import json
+from profilomatic.binary import MAGIC, encode_call_graph, read_call_graphs
+from profilomatic.clock import to_nanoseconds as ns
+from profilomatic.snapshot import merge_snapshots
+from profilomatic.thread_state import RUNNING, GIL, BLOCKED, IDLE
 
 
 class BaseCallGraphTest(object):
     maxDiff = None
     def test_call_graph(self):
         instance = self.call_graph_class(
-            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), 1.0)
-        instance.ingest([], 1.0, 1.0, {'event': 'missing_call_graph'})
-        instance.ingest(['main', 'doIt', '_innerDoIt'], 1.0, 2.0)
-        instance.ingest(['main', 'doIt', '_innerDoSomethingElse'], 1.0, 3.0)
-        instance.ingest(['main', 'doIt', '_innerDoIt'], 1.0, 4.0)
-        instance.ingest(['main', 'doIt'], 1.0, 5.0)
-        instance.ingest(['main', 'doIt'], 0.0, 5.5, {'event': 'something'})
-        instance.ingest(['main', 'doIt', '_innerDoIt'], 1.0, 6.0)
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        instance.ingest([], ns(1.0), ns(1.0), {'event': 'missing_call_graph'})
+        instance.ingest(['main', 'doIt', '_innerDoIt'], ns(1.0), ns(2.0))
+        instance.ingest(['main', 'doIt', '_innerDoSomethingElse'], ns(1.0), ns(3.0))
+        instance.ingest(['main', 'doIt', '_innerDoIt'], ns(1.0), ns(4.0))
+        instance.ingest(['main', 'doIt'], ns(1.0), ns(5.0))
+        instance.ingest(['main', 'doIt'], ns(0.0), ns(5.5), {'event': 'something'})
+        instance.ingest(['main', 'doIt', '_innerDoIt'], ns(1.0), ns(6.0))
         jsonized = instance.jsonize()
         import json
         self.assertEqual({
@@ -92,3 +98,299 @@ class BaseCallGraphTest(object):
                 }
             ]
         }, jsonized)
+
+    def test_shared_prefix(self):
+        def build(use_shared_prefix):
+            instance = self.call_graph_class(
+                1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+            samples = [
+                (['main', 'doIt', '_innerDoIt'], 0),
+                (['main', 'doIt', '_innerDoSomethingElse'], 2),
+                (['main', 'doIt'], 2),
+                (['main', 'doIt', '_innerDoIt'], 2),
+            ]
+            for i, (stack, shared) in enumerate(samples):
+                instance.ingest(stack, ns(1.0), ns(2.0 + i), None,
+                                shared if use_shared_prefix else 0)
+            instance.ingest(['main', 'doIt'], ns(0.0), ns(6.5), {'event': 'something'})
+            instance.ingest(['main', 'doIt', '_innerDoIt'], ns(1.0), ns(7.0), None,
+                            3 if use_shared_prefix else 0)
+            return instance.jsonize()
+
+        self.assertEqual(build(False), build(True))
+
+    def test_wide_fan_out(self):
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        for repeat in range(3):
+            for i in range(50):
+                instance.ingest(['main', 'router', 'view%d' % i], ns(1.0), ns(2.0))
+        instance.ingest(['main', 'router'], ns(0.0), ns(3.0), {'event': 'routed'})
+        instance.ingest(['main', 'router', 'view7'], ns(1.0), ns(4.0))
+        jsonized = instance.jsonize()
+
+        old_router, message, new_router = jsonized['children'][0]['children']
+        self.assertEqual(
+            ['view%d' % i for i in range(50)],
+            [child['instruction'] for child in old_router['children']])
+        self.assertEqual(
+            [3.0] * 50,
+            [child['time'] for child in old_router['children']])
+        self.assertEqual({'event': 'routed'}, message['message'])
+        self.assertEqual(
+            [('view7', 1.0)],
+            [(child['instruction'], child['time'])
+             for child in new_router['children']])
+
+    def test_cpu_time(self):
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        instance.ingest(['main', 'compute'], ns(1.0), ns(2.0), None, 0, ns(0.75))
+        instance.ingest(['main', 'recv'], ns(1.0), ns(3.0), None, 0, ns(0.0))
+        instance.ingest(['main'], ns(1.0), ns(4.0), None, 0, ns(0.25))
+        instance.ingest(['main', 'recv'], ns(1.0), ns(5.0))
+        jsonized = instance.jsonize()
+
+        self.assertEqual((4.0, 1.0, 0.0), (
+            jsonized['time'], jsonized['cpu_time'], jsonized['self_cpu_time']))
+        main, = jsonized['children']
+        self.assertEqual((1.0, 0.25), (main['cpu_time'], main['self_cpu_time']))
+        compute, recv = main['children']
+        self.assertEqual((0.75, 0.75), (compute['cpu_time'], compute['self_cpu_time']))
+        self.assertEqual(2.0, recv['self_time'])
+        self.assertNotIn('cpu_time', recv)
+
+        f = io.BytesIO(MAGIC + encode_call_graph(instance))
+        self.assertEqual([jsonized], list(read_call_graphs(f)))
+
+    def test_thread_states(self):
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        instance.ingest(['main', 'compute'], ns(1.0), ns(2.0), None, 0, 0, RUNNING)
+        instance.ingest(['main', 'compute'], ns(1.0), ns(3.0), None, 2, 0, GIL)
+        instance.ingest(['main', 'recv'], ns(2.0), ns(4.0), None, 1, 0, BLOCKED)
+        instance.ingest(['main'], ns(0.0), ns(5.0), {'event': 'sleeping'})
+        instance.ingest(['main', 'sleep'], ns(3.0), ns(6.0), None, 0, 0, IDLE)
+        instance.ingest(['main', 'other'], ns(1.0), ns(7.0))
+        jsonized = instance.jsonize()
+
+        self.assertEqual(
+            {'running': 1.0, 'gil': 1.0, 'blocked': 2.0, 'idle': 3.0},
+            jsonized['states'])
+        main, message, after = jsonized['children']
+        compute, recv = main['children']
+        self.assertEqual({'running': 1.0, 'gil': 1.0}, compute['states'])
+        self.assertEqual({'blocked': 2.0}, recv['states'])
+        self.assertNotIn('states', message)
+        sleep, other = after['children']
+        self.assertEqual({'idle': 3.0}, sleep['states'])
+        self.assertNotIn('states', other)
+
+        f = io.BytesIO(MAGIC + encode_call_graph(instance))
+        self.assertEqual([jsonized], list(read_call_graphs(f)))
+        chunks = []
+        instance.write_json(chunks.append)
+        self.assertEqual(jsonized, json.loads(''.join(chunks)))
+
+        # Folded nodes keep the time of each state
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        for i in range(10):
+            instance.ingest(['main', 'view%d' % i], ns(1.0), ns(2.0 + i), None, 0, 0,
+                            BLOCKED if i % 2 else RUNNING)
+        instance.coalesce(5)
+        main, = instance.jsonize()['children']
+        self.assertEqual({'running': 5.0, 'blocked': 5.0}, main['states'])
+        other, = [child for child in main['children'] if 'coalesced' in child]
+        self.assertEqual(other['time'], sum(other['states'].values()))
+
+    def test_symbol_table(self):
+        symbols = ['main', 'doIt', '_innerDoIt', '_innerDoSomethingElse']
+
+        def build(instructions):
+            main, do_it, inner, something_else = instructions
+            instance = self.call_graph_class(
+                1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+            instance.ingest([main, do_it, inner], ns(1.0), ns(2.0))
+            instance.ingest([main, do_it, something_else], ns(1.0), ns(3.0))
+            instance.ingest([main, do_it], ns(0.0), ns(3.5), {'event': 'something'})
+            instance.ingest([main, do_it, inner], ns(1.0), ns(4.0))
+            return instance
+
+        def resolve(node, symbols):
+            node = dict(node)
+            if 'instruction' in node:
+                node['instruction'] = symbols[node['instruction']]
+            if 'children' in node:
+                node['children'] = [
+                    resolve(child, symbols) for child in node['children']]
+            return node
+
+        with_strings = build(symbols).jsonize()
+        with_ids = build([3, 2, 1, 0]).jsonize(list(reversed(symbols)))
+        self.assertEqual(
+            ['main', 'doIt', '_innerDoIt', '_innerDoSomethingElse'],
+            with_ids['symbols'])
+        self.assertEqual(0, with_ids['children'][0]['instruction'])
+        output_symbols = with_ids.pop('symbols')
+        self.assertEqual(with_strings, resolve(with_ids, output_symbols))
+
+    def test_coalesce(self):
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        instance.ingest(['main', 'router'], ns(0.0), ns(1.5), {'event': 'routed'})
+        for i in range(20):
+            for repeat in range(i + 1):
+                instance.ingest(['main', 'view%d' % i, 'render'], ns(1.0), ns(2.0 + i))
+        self.assertEqual(43, instance.node_count)
+        before = instance.jsonize()
+
+        self.assertEqual(0, instance.coalesce(43))
+        removed = instance.coalesce(20)
+        self.assertEqual(43 - removed, instance.node_count)
+        self.assertTrue(instance.node_count <= 20)
+        after = instance.jsonize()
+        self.assertEqual(before['time'], after['time'])
+
+        main, = after['children']
+        self.assertEqual(before['children'][0]['time'], main['time'])
+        router, other = main['children'][:2]
+        self.assertEqual({'event': 'routed'}, router['message'])
+        self.assertNotIn('instruction', other)
+        self.assertEqual(other['time'], other['self_time'])
+        kept = main['children'][2:]
+        self.assertEqual(
+            ['view%d' % i for i in range(20 - len(kept), 20)],
+            [child['instruction'] for child in kept])
+        self.assertEqual(2 * (20 - len(kept)), other['coalesced'])
+        self.assertEqual(sum(range(1, 21 - len(kept))), other['time'])
+        self.assertEqual('2016-01-21T09:00:01', other['start_time'])
+
+        # Samples of folded code start new nodes, and can be folded again
+        instance.ingest(['main', 'view0', 'render'], ns(1.0), ns(30.0))
+        instance.ingest(['main', 'view19', 'render'], ns(1.0), ns(30.0))
+        instance.coalesce(10)
+        main, = instance.jsonize()['children']
+        others = [child for child in main['children'] if 'coalesced' in child]
+        self.assertEqual(1, len(others))
+        self.assertEqual(main['time'], sum(
+            child['time'] for child in main['children']))
+
+    def test_snapshots(self):
+        samples = [
+            (['main', 'doIt', '_innerDoIt'], 1.0, 2.0, None),
+            (['main', 'doIt', '_innerDoSomethingElse'], 1.0, 3.0, None),
+            (['main', 'doIt'], 0.0, 3.5, {'event': 'something'}),
+            (['main', 'doIt', '_innerDoIt'], 1.0, 4.0, None),
+            (['main', 'doIt', '_innerDoIt'], 1.0, 5.0, None),
+            (['main', 'doIt'], 1.0, 6.0, None),
+            (['main', 'other'], 1.0, 7.0, None),
+        ]
+
+        whole = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        for stack, time, monotime, message in samples:
+            whole.ingest(stack, ns(time), ns(monotime), message)
+
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        snapshots = []
+        for i, (stack, time, monotime, message) in enumerate(samples):
+            instance.ingest(stack, ns(time), ns(monotime), message)
+            if i % 2 == 1:
+                snapshot = instance.jsonize()
+                snapshot['snapshot'] = len(snapshots)
+                snapshots.append(snapshot)
+                instance.reset(ns(monotime))
+                self.assertEqual(1, instance.node_count)
+                self.assertEqual({
+                    'time': 0.0, 'self_time': 0.0,
+                    'start_time': snapshot['end_time'],
+                    'end_time': snapshot['end_time'],
+                    'task_uuid': '12345', 'thread': 1
+                }, instance.jsonize())
+        snapshot = instance.jsonize()
+        snapshot['snapshot'] = len(snapshots)
+        snapshots.append(snapshot)
+        self.assertEqual(whole.jsonize(), merge_snapshots(reversed(snapshots)))
+
+    def test_write_json(self):
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        instance.ingest([2, 1, 0], ns(1.0), ns(2.0))
+        instance.ingest([2, 1, 3], ns(1.0), ns(3.0))
+        instance.ingest([2, 1], ns(0.0), ns(3.5), {'event': 'something'})
+        instance.ingest([2, 1, 0], ns(1.0), ns(4.0))
+        symbols = ['_innerDoIt', 'doIt', 'main', '_innerDoSomethingElse']
+        for symbol_table in [None, symbols]:
+            for time_format in ['iso', 'offset']:
+                chunks = []
+                instance.write_json(chunks.append, symbol_table, time_format,
+                                    {'source': 'localhost'})
+                expected = instance.jsonize(symbol_table, time_format)
+                expected['source'] = 'localhost'
+                self.assertEqual(expected, json.loads(''.join(chunks)))
+
+        offsets = instance.jsonize(time_format='offset')
+        self.assertEqual('2016-01-21T09:00:00', offsets['base_time'])
+        self.assertEqual((0.0, 3.0), (offsets['start_time'], offsets['end_time']))
+        do_it = offsets['children'][0]['children'][0]
+        self.assertEqual((1.0, 2.0), (do_it['start_time'], do_it['end_time']))
+        self.assertRaises(ValueError, instance.jsonize, None, 'epoch')
+
+    def test_deep_stack(self):
+        instance = self.call_graph_class(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        instance.ingest(['frame%d' % i for i in range(5000)], ns(1.0), ns(2.0))
+        depth = 0
+        node = instance.jsonize()
+        while 'children' in node:
+            node, = node['children']
+            depth += 1
+        self.assertEqual(5000, depth)
+        self.assertEqual('frame4999', node['instruction'])
+
+        # Too deep to parse back in, but it should be well formed
+        chunks = []
+        instance.write_json(chunks.append)
+        written = ''.join(chunks)
+        self.assertEqual(5000, written.count('"children": ['))
+        self.assertEqual(4999, written.count(']}'))
+        self.assertTrue(written.endswith('"thread": 1}'))
+
+    def test_binary_round_trip(self):
+        def build(main, do_it, inner, something_else):
+            instance = self.call_graph_class(
+                1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+            instance.ingest([main], ns(0.0), ns(1.0), {'event': 'started'})
+            instance.ingest([main, do_it, inner], ns(1.0), ns(2.0))
+            instance.ingest([main, do_it, something_else], ns(0.5), ns(2.25))
+            instance.ingest([main, do_it], ns(0.0), ns(3.5), {'event': 'something'})
+            instance.ingest([main, do_it, inner], ns(1.0), ns(4.0))
+            return instance
+
+        with_strings = build('main', 'doIt', '_innerDoIt', '_innerDoSomethingElse')
+        with_ids = build(2, 1, 0, 3)
+        symbols = ['_innerDoIt', 'doIt', 'main', '_innerDoSomethingElse']
+        f = io.BytesIO(
+            MAGIC
+            + encode_call_graph(with_strings, None, {'source': 'localhost'})
+            + MAGIC  # Appended to by another writer
+            + encode_call_graph(with_ids, symbols))
+
+        expected = with_strings.jsonize()
+        first, second = read_call_graphs(f)
+        self.assertEqual('localhost', first.pop('source'))
+        self.assertEqual(expected, first)
+        self.assertEqual(expected, second)
+
+        f.seek(0)
+        offsets = list(read_call_graphs(f, time_format='offset'))
+        self.assertEqual(with_strings.jsonize(time_format='offset'), offsets[1])
+        f.seek(0)
+        raw = next(read_call_graphs(f, raw=True))
+        self.assertEqual(['main', 'doIt', '_innerDoIt', '_innerDoSomethingElse'],
+                         raw['strings'])
+        self.assertEqual([0, 1, 1, 2, 3, 3, 2, 2, 3], raw['depth'])
+        self.assertEqual(2500000000, raw['time'][0])
+        self.assertEqual(datetime.datetime(2016, 1, 21, 9, 0, 0), raw['start_time'])
@@ -1,4 +1,6 @@
+import gc
 import sys
+import weakref
 from six import exec_
 
 
@@ -98,3 +100,132 @@ class BaseStackTraceTest(object):
             ],
             trace[-4:]
         )
+
+    def test_capture_stack(self):
+        for granularity in ['line', 'method', 'file']:
+            stack = self.capture_fn(test_frame, granularity)
+            self.assertEqual(
+                self.stack_trace_fn(test_frame, granularity, True),
+                self.resolve_fn(stack, granularity))
+            self.assertEqual(
+                self.stack_trace_fn(test_frame, granularity, True, True),
+                self.resolve_fn(stack, granularity, True))
+        # A stack captured at line granularity can be resolved more coarsely
+        self.assertEqual(
+            self.stack_trace_fn(test_frame, 'method', True),
+            self.resolve_fn(self.capture_fn(test_frame, 'line'), 'method'))
+
+    def test_capture_stack_outermost(self):
+        def outer():
+            return inner(sys._getframe())
+
+        def inner(outermost):
+            return self.capture_fn(sys._getframe(), 'method', outermost)
+
+        trace = self.resolve_fn(outer(), 'method')
+        self.assertEqual(['outer', 'inner'],
+                         [instruction.split(':')[-1] for instruction in trace])
+
+    def test_capture_stack_releases_frames(self):
+        class Local(object):
+            pass
+
+        def log_message():
+            local = Local()
+            return weakref.ref(local), self.capture_fn(sys._getframe(), 'line')
+
+        local_ref, stack = log_message()
+        gc.collect()
+        self.assertIsNone(local_ref())
+        trace = self.resolve_fn(stack, 'method')
+        self.assertTrue(trace[-1].endswith(':log_message'))
+
+    def test_symbol_cache_hits(self):
+        self.symbol_cache.clear()
+        hits, misses = self.symbol_cache.hits, self.symbol_cache.misses
+        first = self.stack_trace_fn(test_frame, 'line', False)
+        self.assertEqual(misses + len(first), self.symbol_cache.misses)
+        second = self.stack_trace_fn(test_frame, 'line', False)
+        self.assertEqual(first, second)
+        self.assertEqual(hits + len(second), self.symbol_cache.hits)
+        for a, b in zip(first, second):
+            self.assertTrue(a is b)
+
+    def test_symbol_cache_granularity(self):
+        self.symbol_cache.clear()
+        mylogger_frame = test_frame.f_back.f_back.f_back.f_back
+        method_entry = self.symbol_cache.lookup(mylogger_frame, 'method')
+        self.assertEqual(("mylogger.py:dostuff", False), method_entry[:2])
+        line_entry = self.symbol_cache.lookup(test_frame, 'line')
+        self.assertEqual(("eliot.py:log:16", True), line_entry[:2])
+        symbol_table = self.symbol_cache.symbol_table
+        self.assertEqual("mylogger.py:dostuff", symbol_table[method_entry[2]])
+        self.assertEqual("eliot.py:log:16", symbol_table[line_entry[2]])
+
+    def test_symbol_ids(self):
+        trace = self.stack_trace_fn(test_frame, 'method', False)
+        ids = self.stack_trace_fn(test_frame, 'method', False, True)
+        symbol_table = self.symbol_cache.symbol_table
+        self.assertEqual(trace, [symbol_table[i] for i in ids])
+        stripped = self.stack_trace_fn(test_frame, 'method', True, True)
+        self.assertEqual(ids[:len(stripped)], stripped)
+
+    def test_symbol_cache_eviction(self):
+        cache = self.symbol_cache
+        capacity = cache.capacity
+        try:
+            cache.capacity = 4
+            cache.clear()
+            for i in range(5):
+                trace = self.stack_trace_fn(test_frame, 'line', False)
+                self.assertTrue(len(cache) <= 4)
+            self.assertEqual("mylogger.py:dostuff:10", trace[-5])
+        finally:
+            cache.capacity = capacity
+            cache.clear()
+
+    def test_incremental_stack_trace(self):
+        incremental = self.incremental_class()
+        first = list(incremental.update(test_frame, 'line'))
+        self.assertEqual(self.stack_trace_fn(test_frame, 'line', False), first)
+        self.assertEqual(0, incremental.shared)
+
+        second = list(incremental.update(test_frame, 'line'))
+        self.assertEqual(first, second)
+        self.assertEqual(len(first) - 1, incremental.shared)
+
+        parent = list(incremental.update(test_frame.f_back, 'line'))
+        self.assertEqual(first[:-1], parent)
+        self.assertEqual(len(first) - 2, incremental.shared)
+
+        current_frame = sys._getframe()
+        current = list(incremental.update(current_frame, 'method'))
+        self.assertEqual(
+            self.stack_trace_fn(current_frame, 'method', False), current)
+        self.assertEqual(0, incremental.shared)
+
+    def test_incremental_stack_trace_resumed_generator(self):
+        incremental = self.incremental_class()
+
+        def sampling_generator():
+            while True:
+                trace = list(incremental.update(sys._getframe(), 'method'))
+                shared = incremental.shared
+                incremental.update(sys._getframe(), 'method')
+                yield trace, shared, incremental.shared
+
+        def resume_from_a(generator):
+            return next(generator)
+
+        def resume_from_b(generator):
+            return next(generator)
+
+        generator = sampling_generator()
+        trace, first_shared, second_shared = resume_from_a(generator)
+        self.assertTrue(trace[-2].endswith(':resume_from_a'))
+        self.assertEqual(0, first_shared)
+        self.assertEqual(len(trace) - 1, second_shared)
+        trace, first_shared, second_shared = resume_from_b(generator)
+        self.assertTrue(trace[-2].endswith(':resume_from_b'))
+        self.assertEqual(0, first_shared)
+        self.assertEqual(len(trace) - 1, second_shared)
@@ -0,0 +1,46 @@
+import unittest
+
+from profilomatic.admission import Admission, OTHER_TYPE, UNTYPED
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_fair_share(self):
+        admission = Admission(min_rate=0.0)
+        cheap = [admission.admit('/cheap', i, 4, 0) for i in range(4)]
+        self.assertEqual(4, len([s for s in cheap if s is not None]))
+        for stratum in cheap[:2]:
+            admission.release(stratum)
+        slow = admission.admit('/slow', 2, 4, 0)
+        self.assertIsNotNone(slow)
+        # There's a free slot, but /cheap already has its half
+        self.assertIsNone(admission.admit('/cheap', 3, 4, 0))
+        self.assertIsNotNone(admission.admit('/slow', 3, 4, 0))
+        self.assertEqual(2, admission.active)
+        self.assertEqual(2, admission.strata['/slow'].in_flight)
+
+    def test_min_rate(self):
+        admission = Admission(min_rate=1.0)
+        # No free slots, but each action type gets one a second
+        self.assertIsNotNone(admission.admit('/slow', 4, 4, 0))
+        self.assertIsNone(admission.admit('/slow', 4, 4, 500000000))
+        self.assertIsNotNone(admission.admit('/slow', 4, 4, 1000000000))
+        self.assertIsNone(admission.admit('/slow', 4, 4, 1000000001))
+        self.assertEqual(2, admission.strata['/slow'].admitted)
+        self.assertEqual(2, admission.strata['/slow'].rejected)
+
+    def test_shared(self):
+        admission = Admission(stratified=False)
+        self.assertIsNotNone(admission.admit('/cheap', 3, 4, 0))
+        self.assertIsNone(admission.admit('/slow', 4, 4, 0))
+        self.assertIsNotNone(admission.admit('/slow', 4, None, 0))
+        # No capacity at all isn't the same as no limit
+        self.assertIsNone(admission.admit('/slow', 0, 0, 0))
+        self.assertEqual((1, 2), (admission.strata['/slow'].admitted,
+                                  admission.strata['/slow'].rejected))
+
+    def test_max_types(self):
+        admission = Admission(max_types=2)
+        for action_type in [None, '/a', '/b', '/c']:
+            admission.admit(action_type, 0, None, 0)
+        self.assertEqual({UNTYPED, OTHER_TYPE, '/a'}, set(admission.strata))
+        self.assertEqual(2, admission.strata[OTHER_TYPE].admitted)
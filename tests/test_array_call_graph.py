@@ -0,0 +1,57 @@
+import datetime
+import unittest
+from .base_call_graph_test import BaseCallGraphTest
+from profilomatic.array_call_graph import ArrayCallGraphRoot, NodePool
+from profilomatic.clock import to_nanoseconds as ns
+
+
+class ArrayCallGraphTest(BaseCallGraphTest, unittest.TestCase):
+    def call_graph_class(self, *args):
+        return ArrayCallGraphRoot(*args, pool=self.pool)
+
+    def setUp(self):
+        self.pool = NodePool()
+
+    def build_graph(self, task_uuid):
+        instance = ArrayCallGraphRoot(
+            1, task_uuid, datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0),
+            pool=self.pool)
+        instance.ingest(['main', 'doIt', '_innerDoIt'], ns(1.0), ns(2.0))
+        instance.ingest(['main', 'doIt'], ns(0.0), ns(2.5), {'event': 'something'})
+        instance.ingest(['main', 'doIt', '_innerDoSomethingElse'], ns(1.0), ns(3.0))
+        return instance
+
+    def test_nodes_recycled(self):
+        first = self.build_graph('1')
+        expected = first.jsonize()
+        self.assertEqual(self.pool.nodes_in_use, len(self.pool))
+        allocated = len(self.pool)
+
+        first.release()
+        self.assertEqual(0, self.pool.nodes_in_use)
+        self.assertEqual({}, self.pool.messages)
+        self.assertEqual({}, self.pool.child_index)
+
+        # Instructions no node uses any more are forgotten
+        self.assertEqual({}, self.pool.instruction_ids)
+        self.assertEqual([None] * 4, self.pool.instructions)
+
+        second = self.build_graph('1')
+        self.assertEqual(allocated, len(self.pool))
+        self.assertEqual(4, len(self.pool.instructions))
+        self.assertEqual(expected, second.jsonize())
+
+    def test_graphs_share_pool(self):
+        first = self.build_graph('1')
+        second = self.build_graph('2')
+        first_json = first.jsonize()
+        first.release()
+        third = self.build_graph('3')
+        self.assertEqual(len(self.pool), self.pool.nodes_in_use)
+        second_json = second.jsonize()
+        third_json = third.jsonize()
+        self.assertEqual('2', second_json.pop('task_uuid'))
+        self.assertEqual('3', third_json.pop('task_uuid'))
+        first_json.pop('task_uuid')
+        self.assertEqual(first_json, second_json)
+        self.assertEqual(first_json, third_json)
@@ -0,0 +1,42 @@
+import datetime
+import io
+import unittest
+
+from profilomatic.binary import \
+    MAGIC, BinaryDestination, encode_call_graph, read_call_graphs
+from profilomatic.call_graph import CallGraphRoot
+from profilomatic.clock import to_nanoseconds as ns
+from profilomatic.profiler import utc
+
+
+class BinaryFormatTest(unittest.TestCase):
+    def build(self, task_uuid, start_time):
+        call_graph = CallGraphRoot(1, task_uuid, start_time, ns(100.0))
+        call_graph.ingest([u'main', u'f\xfcnf'], ns(0.1), ns(100.1))
+        call_graph.ingest([u'main'], ns(0.0), ns(100.2), {'event': u'\u2713'})
+        return call_graph
+
+    def test_destination(self):
+        f = io.BytesIO()
+        instance = BinaryDestination(f)
+        first = self.build('1', datetime.datetime(2016, 1, 21, 9, 0, 0, tzinfo=utc))
+        second = self.build('2', datetime.datetime(2016, 1, 21, 9, 0, 0))
+        instance.write_call_graph(first, None, 'iso', {'source': 'localhost'})
+        instance.write_call_graph(second, None, 'iso', {'source': 'localhost'})
+
+        expected = [first.jsonize(), second.jsonize()]
+        for jsonized in expected:
+            jsonized['source'] = 'localhost'
+        self.assertEqual(
+            '2016-01-21T09:00:00.200000+00:00', expected[0]['end_time'])
+        f.seek(0)
+        self.assertEqual(expected, list(read_call_graphs(f)))
+
+    def test_truncated_stream(self):
+        record = encode_call_graph(
+            self.build('1', datetime.datetime(2016, 1, 21, 9, 0, 0)))
+        f = io.BytesIO(MAGIC + record + record[:-1])
+        self.assertEqual(['1'], [
+            call_graph['task_uuid'] for call_graph in read_call_graphs(f)])
+        self.assertRaises(
+            ValueError, list, read_call_graphs(io.BytesIO(b'{"time": 1.0}')))
@@ -0,0 +1,51 @@
+import datetime
+import threading
+import time
+import unittest
+
+from profilomatic.clock import \
+    CLOCKS, calibrate, clock_ns, monotonic, thread_cpu_reader, to_nanoseconds, \
+    to_timedelta
+
+
+class ClockTest(unittest.TestCase):
+    def test_clocks(self):
+        for name in ['coarse', 'fine']:
+            clock = clock_ns(name)
+            start = clock()
+            self.assertTrue(isinstance(start, int) or type(start).__name__ == 'long')
+            time.sleep(0.25)
+            self.assertAlmostEqual(clock() - start, 250000000, delta=100000000)
+        self.assertRaises(ValueError, clock_ns, 'sundial')
+
+    def test_thread_cpu_reader(self):
+        read = thread_cpu_reader(threading.current_thread().ident)
+        if read is None:
+            self.skipTest('No thread CPU clocks on this platform')
+        start = read()
+        time.sleep(0.25)
+        self.assertTrue(read() - start < 100000000)
+        deadline = time.time() + 0.25
+        while time.time() < deadline:
+            pass
+        self.assertTrue(read() - start > 100000000)
+
+    def test_monotonic(self):
+        start = monotonic()
+        time.sleep(0.25)
+        self.assertAlmostEqual(monotonic() - start, 0.25, delta=0.1)
+
+    def test_conversions(self):
+        self.assertEqual(1500000000, to_nanoseconds(1.5))
+        self.assertEqual(100000000, to_nanoseconds(0.1))
+        self.assertEqual(datetime.timedelta(seconds=1, microseconds=2),
+                         to_timedelta(1000002999))
+
+    def test_calibrate(self):
+        results = calibrate(reads=100)
+        self.assertTrue('coarse' in results)
+        self.assertTrue('fine' in results)
+        for name, result in results.items():
+            self.assertTrue(name in CLOCKS)
+            self.assertTrue(result['read_cost'] >= 0)
+        self.assertTrue(results['fine']['resolution'] > 0)
@@ -0,0 +1,54 @@
+import unittest
+
+from profilomatic.controller import \
+    PIController, FixedController, lookup_controller, simulate
+
+
+class ControllerTest(unittest.TestCase):
+    def test_converges_on_target(self):
+        # Ten busy tasks would cost 10% - far more than the 2% target
+        controller = PIController(0.02, 0.01, 10)
+        results = simulate(controller, [10] * 300, 0.0001, 0.001)
+        for interval, admission, tasks, overhead in results[-50:]:
+            self.assertAlmostEqual(0.02, overhead, delta=0.002)
+        self.assertTrue(results[-1][0] > 0.01)
+        self.assertTrue(results[-1][2] < 10)
+
+    def test_light_load(self):
+        controller = PIController(0.02, 0.01, 10)
+        results = simulate(controller, [2] * 300, 0.00001, 0.0001)
+        for interval, admission, tasks, overhead in results[-50:]:
+            self.assertEqual(0.01, interval)
+            self.assertEqual(2, tasks)
+            self.assertTrue(overhead < 0.02)
+            # Not profiling every task isn't a reason to admit more
+            self.assertTrue(admission <= 20)
+
+    def test_cheap_tasks_admitted(self):
+        controller = PIController(0.02, 0.01, 10)
+        results = simulate(controller, [200] * 300, 0.000001, 0.00005)
+        interval, admission, tasks, overhead = results[-1]
+        self.assertEqual(0.01, interval)
+        self.assertEqual(100, tasks)
+
+    def test_bursts(self):
+        controller = PIController(0.02, 0.01, 10)
+        demand = ([2] * 50 + [50] * 50) * 4
+        results = simulate(controller, demand, 0.0001, 0.001)
+        for interval, admission, tasks, overhead in results:
+            self.assertTrue(0.01 <= interval <= 1.0)
+            self.assertTrue(1 <= admission <= 100)
+        for interval, admission, tasks, overhead in results[-20:]:
+            self.assertAlmostEqual(0.02, overhead, delta=0.005)
+
+    def test_fixed(self):
+        controller = FixedController(0.02, 0.01, 10)
+        results = simulate(controller, [20] * 10, 0.001, 0.001)
+        self.assertEqual([(0.01, 10, 10, 1.01)] * 10,
+                         [r[:3] + (round(r[3], 6),) for r in results])
+
+    def test_lookup(self):
+        self.assertIs(PIController, lookup_controller('pi'))
+        self.assertIs(FixedController, lookup_controller('fixed'))
+        self.assertIs(FixedController, lookup_controller(FixedController))
+        self.assertRaises(ValueError, lookup_controller, 'bang-bang')
@@ -0,0 +1,4 @@
+import sys
+
+if sys.version_info >= (3, 7):  # Tasks are only profiled on Python 3.7+
+    from tests.asyncio_cases import CoroutinesTest
@@ -1,5 +1,6 @@
 try:
-    from profilomatic.fast_monotonic import monotonic
+    from profilomatic.fast_monotonic import \
+        monotonic, coarse_ns, fine_ns, thread_cpu_ns
     from unittest import TestCase
     from time import sleep
 
@@ -10,5 +11,15 @@ try:
             end = monotonic()
             self.assertAlmostEqual(end - start, 0.75, delta=0.2)
 
+        def test_nanosecond_clocks(self):
+            for clock in [coarse_ns, fine_ns]:
+                start = clock()
+                sleep(0.25)
+                self.assertAlmostEqual(
+                    clock() - start, 250000000, delta=100000000)
+            start = thread_cpu_ns()
+            sleep(0.25)
+            self.assertTrue(thread_cpu_ns() - start < 100000000)
+
 except (ImportError, OSError):
     pass
@@ -0,0 +1,34 @@
+import unittest
+
+from profilomatic.latency import LatencyHistogram, LatencyTracker
+
+
+class LatencyTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.quantile(0.5))
+        for latency in [0.001, 0.2, 0.3, 0.4, 1000.0]:
+            histogram.add(latency)
+        self.assertEqual(5, histogram.count)
+        self.assertAlmostEqual(1000.901, histogram.sum)
+        counts = dict(histogram.cumulative_counts())
+        self.assertEqual(1, counts[0.005])
+        self.assertEqual(4, counts[0.5])
+        self.assertEqual(5, counts[float('inf')])
+        self.assertAlmostEqual(0.25, histogram.quantile(0.4))
+        self.assertEqual(300.0, histogram.quantile(1.0))
+
+    def test_tracker(self):
+        tracker = LatencyTracker(queue_size=3, max_types=1)
+        tracker.record('/a', 0, 100000000, 'succeeded')
+        tracker.record('/a', 0, 200000000, 'failed')
+        tracker.record('/b', 0, 300000000, 'succeeded')
+        tracker.record(None, 0, 400000000, 'succeeded')
+        tracker.drain()
+        # The oldest record was dropped, and /b and untyped tasks share
+        self.assertEqual(
+            [('/a', 'failed'), ('<other>', 'succeeded')],
+            sorted(tracker.histograms))
+        self.assertEqual(2, tracker.histograms[('<other>', 'succeeded')].count)
+        self.assertAlmostEqual(0.175, tracker.quantile('/a', 0.5))
+        self.assertIsNone(tracker.quantile('/b', 0.5))
@@ -1,9 +1,20 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+import six
 import threading
 import wsgiref.simple_server
 
-from profilomatic.output import RestDestination
+from profilomatic.call_graph import CallGraphRoot
+from profilomatic.clock import to_nanoseconds as ns
+from profilomatic.output import RestDestination, DeliveryError, \
+    RotatingFileDestination, file_destination
 
 class MockWSGIApp(object):
     def __init__(self):
@@ -12,7 +23,7 @@ class MockWSGIApp(object):
         environ['wsgi.input'] = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
         self.requests.append(environ)
         start_response('200 OK', [('Content-Type', 'application/json')])
-        return ['{"status": "OK"}']
+        return [b'{"status": "OK"}']
 
 class RestDestinationTest(unittest.TestCase):
     def setUp(self):
@@ -24,8 +35,212 @@ class RestDestinationTest(unittest.TestCase):
     def tearDown(self):
         self.httpd.shutdown()
         self.thread.join()
+        self.httpd.server_close()
 
     def test_rest_output(self):
         instance = RestDestination('127.0.0.1', 6483)
         instance({"hello": "world"})
-        self.assertEqual(self.mock_app.requests[0]['wsgi.input'], '{"hello": "world"}')
+        self.assertEqual(self.mock_app.requests[0]['wsgi.input'], b'{"hello": "world"}')
+        self.assertEqual('application/json', self.mock_app.requests[0]['CONTENT_TYPE'])
+        self.assertEqual(1, instance.sent)
+
+
+class MockCollector(object):
+    def __init__(self):
+        self.bodies = []
+        self.statuses = []
+
+    def __call__(self, environ, start_response):
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            body = gzip.GzipFile(fileobj=six.BytesIO(body)).read()
+        status = self.statuses.pop(0) if self.statuses else '200 OK'
+        if status == '200 OK':
+            self.bodies.append(json.loads(body.decode('utf-8')))
+        start_response(status, [('Content-Type', 'application/json')])
+        return [b'{}']
+
+
+class BatchingRestDestinationTest(unittest.TestCase):
+    def setUp(self):
+        self.collector = MockCollector()
+        self.httpd = wsgiref.simple_server.make_server('127.0.0.1', 0, self.collector)
+        self.port = self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.tempdir = tempfile.mkdtemp()
+        self.spill_file = os.path.join(self.tempdir, 'spill.jsonl')
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+        shutil.rmtree(self.tempdir)
+
+    def test_batches(self):
+        instance = RestDestination('127.0.0.1', self.port, batch_size=3,
+                                   max_delay=60, compress=True)
+        for i in range(4):
+            instance({'task_uuid': str(i)})
+        self.assertEqual([[{'task_uuid': '0'}, {'task_uuid': '1'}, {'task_uuid': '2'}]],
+                         self.collector.bodies)
+        instance.flush()
+        self.assertEqual([{'task_uuid': '3'}], self.collector.bodies[1])
+        self.assertEqual(4, instance.sent)
+
+    def test_write_call_graphs(self):
+        call_graph = CallGraphRoot(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        call_graph.ingest(['main', u'd\u00f6It'], ns(1.0), ns(2.0))
+        expected = call_graph.jsonize()
+        expected['source'] = 'localhost'
+        instance = RestDestination('127.0.0.1', self.port, batch_size=2)
+        instance.write_call_graphs(
+            [(call_graph, {'source': 'localhost'})] * 2, None, 'iso')
+        self.assertEqual([[expected, expected]], self.collector.bodies)
+
+    def test_retries(self):
+        self.collector.statuses = ['503 Service Unavailable', '429 Too Many Requests']
+        instance = RestDestination('127.0.0.1', self.port, retries=2, backoff=0.001)
+        instance({'hello': 'world'})
+        self.assertEqual([{'hello': 'world'}], self.collector.bodies)
+        self.assertEqual(2, instance.retried)
+
+    def test_retry_compressed_batch(self):
+        self.collector.statuses = ['503 Service Unavailable']
+        instance = RestDestination('127.0.0.1', self.port, batch_size=2,
+                                   max_delay=60, compress=True, retries=1,
+                                   backoff=0.001)
+        instance({'task_uuid': '1'})
+        self.assertEqual([], self.collector.bodies)
+        instance({'task_uuid': '2'})
+        # The whole gzipped batch is sent again
+        self.assertEqual([[{'task_uuid': '1'}, {'task_uuid': '2'}]],
+                         self.collector.bodies)
+        self.assertEqual(1, instance.retried)
+        self.assertEqual(2, instance.sent)
+
+    def test_rejected(self):
+        self.collector.statuses = ['400 Bad Request']
+        instance = RestDestination('127.0.0.1', self.port, retries=2, backoff=0.001,
+                                   spill_file=self.spill_file)
+        self.assertRaises(DeliveryError, instance, {'hello': 'world'})
+        self.assertEqual(0, instance.retried)
+        self.assertFalse(os.path.exists(self.spill_file))
+
+    def test_spill_and_replay(self):
+        self.collector.statuses = ['500 Internal Server Error'] * 2
+        instance = RestDestination('127.0.0.1', self.port, retries=1, backoff=0.001,
+                                   spill_file=self.spill_file)
+        instance({'task_uuid': '1'})
+        self.assertEqual([], self.collector.bodies)
+        self.assertEqual(1, instance.spilled)
+
+        instance({'task_uuid': '2'})
+        self.assertEqual([{'task_uuid': '2'}, {'task_uuid': '1'}], self.collector.bodies)
+        self.assertEqual(0, os.path.getsize(self.spill_file))
+
+    def test_replay_on_startup(self):
+        with open(self.spill_file, 'w') as f:
+            f.write('{"task_uuid": "1"}\n')
+        instance = RestDestination('127.0.0.1', self.port, spill_file=self.spill_file)
+        instance({'task_uuid': '2'})
+        self.assertEqual([{'task_uuid': '2'}, {'task_uuid': '1'}], self.collector.bodies)
+
+    def test_spill_limit(self):
+        self.collector.statuses = ['500 Internal Server Error'] * 3
+        instance = RestDestination('127.0.0.1', self.port, retries=0,
+                                   spill_file=self.spill_file, max_spill_bytes=30)
+        for i in range(3):
+            instance({'task_uuid': str(i)})
+        self.assertEqual(1, instance.spilled)
+        self.assertEqual(2, instance.dropped)
+
+
+class FileDestinationTest(unittest.TestCase):
+    def test_file_output(self):
+        call_graph = CallGraphRoot(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        call_graph.ingest(['main', 'doIt'], ns(1.0), ns(2.0))
+        expected = call_graph.jsonize()
+        expected['source'] = 'localhost'
+
+        f = six.StringIO()
+        instance = file_destination(f)
+        instance(expected)
+        instance.write_call_graph(call_graph, None, 'iso', {'source': 'localhost'})
+        lines = f.getvalue().splitlines()
+        self.assertEqual([expected, expected], [json.loads(line) for line in lines])
+
+
+class RotatingFileDestinationTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'profile.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read_lines(self, filename):
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f.read().splitlines()]
+
+    def test_buffering(self):
+        instance = RotatingFileDestination(
+            self.filename, flush_interval=60, flush_bytes=100)
+        for i in range(5):
+            instance({'task_uuid': str(i)})
+        self.assertEqual([], self.read_lines(self.filename))
+        instance({'task_uuid': '5'})  # Takes it over flush_bytes
+        self.assertEqual(6, len(self.read_lines(self.filename)))
+        instance({'task_uuid': '6'})
+        instance.flush()
+        self.assertEqual([{'task_uuid': str(i)} for i in range(7)],
+                         self.read_lines(self.filename))
+        instance.close()
+
+    def test_write_call_graphs(self):
+        call_graph = CallGraphRoot(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        call_graph.ingest(['main', u'd\u00f6It'], ns(1.0), ns(2.0))
+        expected = call_graph.jsonize()
+        expected['source'] = 'localhost'
+        instance = RotatingFileDestination(self.filename)
+        instance.write_call_graphs(
+            [(call_graph, {'source': 'localhost'})] * 2, None, 'iso')
+        instance.close()
+        self.assertEqual([expected, expected], self.read_lines(self.filename))
+
+    def test_rotation_and_retention(self):
+        instance = RotatingFileDestination(
+            self.filename, max_bytes=40, compress='gzip', backup_count=2)
+        for i in range(10):
+            instance({'task_uuid': str(i)})
+        instance.close()
+        segments = instance.segments()
+        self.assertEqual(2, len(segments))
+        self.assertTrue(all(segment.endswith('.gz') for segment in segments))
+        self.assertEqual(
+            [[{'task_uuid': '3'}, {'task_uuid': '4'}, {'task_uuid': '5'}],
+             [{'task_uuid': '6'}, {'task_uuid': '7'}, {'task_uuid': '8'}]],
+            [self.read_lines(segment) for segment in segments])
+        self.assertEqual([{'task_uuid': '9'}], self.read_lines(self.filename))
+
+    def test_total_size_retention(self):
+        instance = RotatingFileDestination(
+            self.filename, max_bytes=40, max_total_bytes=120)
+        for i in range(10):
+            instance({'task_uuid': str(i)})
+        instance.close()
+        self.assertEqual(2, len(instance.segments()))
+
+    def test_time_rotation(self):
+        instance = RotatingFileDestination(self.filename, rotate_interval=0.01)
+        instance({'task_uuid': '1'})
+        time.sleep(0.02)
+        instance({'task_uuid': '2'})
+        instance.close()
+        segment, = instance.segments()
+        self.assertEqual([{'task_uuid': '1'}, {'task_uuid': '2'}],
+                         self.read_lines(segment))
@@ -3,8 +3,15 @@ import unittest
 from mock import patch
 import datetime
 import collections
+import threading
+import time
+from profilomatic.clock import clock_ns, to_nanoseconds as ns, to_timedelta
 from profilomatic.profiler import Profiler, _MessageInfo
-from profilomatic.stack_trace import generate_stack_trace
+from profilomatic.snapshot import merge_snapshots
+from profilomatic.thread_state import IDLE
+from profilomatic.writer import AsyncWriter
+from profilomatic.stack_trace import \
+    IncrementalStackTrace, capture_stack, resolve_stack, symbol_table
 
 
 def drain_queue(q):
@@ -17,7 +24,7 @@ def drain_queue(q):
 
 
 MockFrame = collections.namedtuple('MockFrame',
-                                   'f_code f_globals f_lineno f_back')
+                                   'f_code f_globals f_lineno f_lasti f_back')
 MockCode = collections.namedtuple('MockCode', 'co_filename co_name')
 
 
@@ -27,11 +34,15 @@ def mock_frame(*frames):
         module, method, line = frame.split(':')
         filename = module.replace('.', '/') + '.py'
         result = MockFrame(
-            MockCode(filename, method), {'__name__': module}, int(line),
+            MockCode(filename, method), {'__name__': module}, int(line), 0,
             result)
     return result
 
 
+def mock_stack(*frames):
+    return capture_stack(mock_frame(*frames), 'line')
+
+
 def raise_nested_exception():
     def inner_raise_exception():
         raise Exception()
@@ -75,6 +86,121 @@ class ProfilomaticTest(unittest.TestCase):
         self.assertEqual('2', messages[4].next_task_uuid)
         self.assertEqual(None, messages[5].next_task_uuid)
 
+    def test_stratified_admission(self):
+        instance = Profiler(simultaneous_tasks_profiled=2, max_action_types=3)
+        threads = []
+        stop = threading.Event()
+
+        def task(task_uuid, action_type, started):
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_type': action_type,
+                                     'action_status': 'started'})
+            started.set()
+            stop.wait()
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_type': action_type,
+                                     'action_status': 'succeeded'})
+
+        for i, action_type in enumerate(['/cheap'] * 4 + ['/rare', '/new', '/newer']):
+            started = threading.Event()
+            thread = threading.Thread(
+                target=task, args=(str(i), action_type, started))
+            thread.start()
+            started.wait()
+            threads.append(thread)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        strata = instance.admission_control.strata
+        # Only two slots, but each action type gets one of its own
+        self.assertEqual((2, 2), (strata['/cheap'].admitted, strata['/cheap'].rejected))
+        self.assertEqual((1, 0), (strata['/rare'].admitted, strata['/rare'].rejected))
+        self.assertEqual((1, 0), (strata['/new'].admitted, strata['/new'].rejected))
+        self.assertEqual((1, 0), (strata['<other>'].admitted, strata['<other>'].rejected))
+        self.assertEqual(0, instance.admission_control.active)
+        self.assertEqual(5, instance.profiled_tasks)
+        self.assertRaises(ValueError, instance.configure, admission='lottery')
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    def test_retention(self):
+        instance = Profiler(retention='threshold', retention_threshold=0.5)
+        messages = []
+        instance.add_destination(messages.append)
+
+        def task(task_uuid, start, end):
+            for status, monotonic, next_task_uuid in [
+                    ('started', start, task_uuid), ('succeeded', end, None)]:
+                msg = _MessageInfo({'action_status': status,
+                                    'action_type': 'app:hello',
+                                    'task_uuid': task_uuid}, next_task_uuid)
+                msg.stack = mock_stack('__main__:main:1')
+                msg.monotonic = ns(monotonic)
+                msg.thread = 12345
+                instance.message_queue.append(msg)
+
+        task('slow', 0.0, 1.0)
+        task('fast', 1.0, 1.1)
+        instance._ingest_messages()
+        self.assertEqual(['slow'], [m['task_uuid'] for m in messages])
+        self.assertEqual(1, instance.discarded_tasks)
+        self.assertEqual({}, instance.task_types)
+
+        instance.configure(retention='percentile', retention_percentile=0.5)
+        self.assertEqual(0.5, instance.retention_control.percentile)
+        self.assertIsNone(instance.retention_control.threshold)
+        self.assertRaises(ValueError, instance.configure, retention='some')
+
+    def test_latency(self):
+        instance = Profiler(simultaneous_tasks_profiled=1)
+        for task_uuid, status in [('1', 'succeeded'), ('2', 'failed')]:
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_type': 'app:hello',
+                                     'action_status': 'started'})
+            instance.handle_message({'task_uuid': task_uuid + 'a',
+                                     'action_type': 'app:nested',
+                                     'action_status': 'started'})
+            instance.handle_message({'task_uuid': task_uuid + 'a',
+                                     'action_status': 'succeeded'})
+            instance.handle_message({'task_uuid': task_uuid,
+                                     'action_status': status})
+        instance._profile_once(0, instance.now())
+        # The second task wasn't profiled, but its latency still counts
+        self.assertEqual(1, instance.unprofiled_tasks)
+        histograms = instance.latency.histograms
+        self.assertEqual([('app:hello', 'failed'), ('app:hello', 'succeeded')],
+                         sorted(histograms))
+        # Nested tasks aren't counted separately
+        self.assertEqual(1, histograms[('app:hello', 'failed')].count)
+        # Coarse clock ticks would swamp the shortest buckets
+        self.assertEqual('coarse', instance.clock)
+        self.assertIs(clock_ns('fine'), instance.latency_now)
+
+        instance.configure(track_latency=False)
+        instance.handle_message({'task_uuid': '3', 'action_status': 'started'})
+        instance.handle_message({'task_uuid': '3', 'action_status': 'failed'})
+        self.assertEqual(0, len(instance.latency.records))
+
+    def test_thread_cpu_count(self):
+        def read():
+            return 100
+
+        def read_finished():
+            raise OSError(22, 'Invalid argument')
+
+        ident = threading.current_thread().ident
+        for read_cpu, counted in [(read, True), (read_finished, False)]:
+            with patch('profilomatic.profiler.thread_cpu_reader',
+                       lambda thread: read_cpu):
+                instance = Profiler(simultaneous_tasks_profiled=1)
+                instance.handle_message(
+                    {'task_uuid': '1', 'action_status': 'started'})
+                self.assertEqual(counted, ident in instance.thread_cpu)
+                # Evicted when the task ends, while its thread's still running
+                instance.handle_message(
+                    {'task_uuid': '1', 'action_status': 'succeeded'})
+                self.assertNotIn(ident, instance.thread_cpu)
+                self.assertIsNone(instance._thread_cpu_time(ident))
+
     def test_dont_handle_message_outside_action(self):
         instance = Profiler(store_all_logs=True)
         instance.handle_message({'task_uuid': '99', 'msg': 'outside'})
@@ -97,10 +223,11 @@ class ProfilomaticTest(unittest.TestCase):
         self.assertEqual('started', messages[0].message['action_status'])
         self.assertEqual('failed', messages[1].message['action_status'])
 
-    @patch('profilomatic.profiler.generate_stack_trace', generate_stack_trace
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack
            )  # Use pure Python one, to allow use of mock stack frames
     def test_ingest_message(self):
         instance = Profiler(source_name='localhost', code_granularity='method')
+        instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
         messages = []
         instance.add_destination(messages.append)
 
@@ -111,11 +238,10 @@ class ProfilomaticTest(unittest.TestCase):
                 'msg': 'Hi'
             },
             next_task_uuid='1')
-        msg1.frame = mock_frame('__main__:main:1', 'business.app:__init__:5',
+        msg1.stack = mock_stack('__main__:main:1', 'business.app:__init__:5',
                                 'eliot._action:startAction:100',
                                 'profilomatic:emit:101')
-        msg1.monotonic = 0.0
-        msg1.clock = datetime.datetime(1988, 1, 1, 9, 0, 0)
+        msg1.monotonic = ns(0.0)
         msg1.thread = 12345
         instance._ingest_message(msg1)
 
@@ -126,13 +252,10 @@ class ProfilomaticTest(unittest.TestCase):
                 'msg': 'World'
             },
             next_task_uuid=None)
-        msg2.frame = mock_frame('__main__:main:1', 'business.app:__init__:5',
+        msg2.stack = mock_stack('__main__:main:1', 'business.app:__init__:5',
                                 'eliot._action:endAction:100',
                                 'profilomatic:emit:101')
-        msg2.monotonic = 1.0
-        msg2.clock = datetime.datetime(
-            1987, 1, 1, 9, 0,
-            0)  # Clock skew should be ignored, after first message
+        msg2.monotonic = ns(1.0)
         msg2.thread = 12345
         instance._ingest_message(msg2)
 
@@ -184,12 +307,14 @@ class ProfilomaticTest(unittest.TestCase):
         ], messages)
 
     @patch('sys._current_frames', mock_current_frames)
-    @patch('profilomatic.profiler.generate_stack_trace', generate_stack_trace
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack
            )  # Use pure Python one, to allow use of mock stack frames
+    @patch('profilomatic.profiler.IncrementalStackTrace', IncrementalStackTrace)
     def test_profiling_cycle(self):
         # import pudb
         # pu.db
         instance = Profiler(source_name='test_source', code_granularity='method')
+        instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
         messages = []
         instance.add_destination(messages.append)
 
@@ -200,15 +325,14 @@ class ProfilomaticTest(unittest.TestCase):
                 'msg': 'Hi'
             },
             next_task_uuid='1')
-        msg1.frame = mock_frame('__main__:main:1', 'business.app:__init__:5',
+        msg1.stack = mock_stack('__main__:main:1', 'business.app:__init__:5',
                                 'eliot._action:startAction:100',
                                 'profilomatic:emit:101')
-        msg1.monotonic = 0.0
-        msg1.clock = datetime.datetime(1988, 1, 1, 9, 0, 0)
+        msg1.monotonic = ns(0.0)
         msg1.thread = 12345
         instance.message_queue.append(msg1)
 
-        instance._profile_once(0.25, 0.5)
+        instance._profile_once(ns(0.25), ns(0.5))
 
         msg2 = _MessageInfo(
             message={
@@ -217,17 +341,14 @@ class ProfilomaticTest(unittest.TestCase):
                 'msg': 'World'
             },
             next_task_uuid=None)
-        msg2.frame = mock_frame('__main__:main:1', 'business.app:__init__:5',
+        msg2.stack = mock_stack('__main__:main:1', 'business.app:__init__:5',
                                 'eliot._action:endAction:100',
                                 'profilomatic:emit:101')
-        msg2.monotonic = 1.0
-        msg2.clock = datetime.datetime(
-            1987, 1, 1, 9, 0,
-            0)  # Clock skew should be ignored, after first message
+        msg2.monotonic = ns(1.0)
         msg2.thread = 12345
         instance.message_queue.append(msg2)
 
-        instance._profile_once(0.25, 1.5)
+        instance._profile_once(ns(0.25), ns(1.5))
 
         self.assertEqual([{
             "thread": 12345,
@@ -237,6 +358,7 @@ class ProfilomaticTest(unittest.TestCase):
             "self_time": 0.0,
             "end_time": "1988-01-01T09:00:01",
             "time": 0.25,
+            "states": {"running": 0.25},
             "children": [
                 {
                     "start_time": "1988-01-01T09:00:00",
@@ -244,6 +366,7 @@ class ProfilomaticTest(unittest.TestCase):
                     "self_time": 0.0,
                     "end_time": "1988-01-01T09:00:01",
                     "time": 0.25,
+                    "states": {"running": 0.25},
                     "children": [
                         {
                             "start_time": "1988-01-01T09:00:00",
@@ -263,13 +386,15 @@ class ProfilomaticTest(unittest.TestCase):
                             "self_time": 0.0,
                             "end_time": "1988-01-01T09:00:00.500000",
                             "time": 0.25,
+                            "states": {"running": 0.25},
                             "children": [
                                 {
                                     "start_time": "1988-01-01T09:00:00.500000",
                                     "self_time": 0.25,
                                     "instruction": "business/backend.py:doStuff",
                                     "end_time": "1988-01-01T09:00:00.500000",
-                                    "time": 0.25
+                                    "time": 0.25,
+                                    "states": {"running": 0.25}
                                 }
                             ]
                         },
@@ -290,11 +415,302 @@ class ProfilomaticTest(unittest.TestCase):
             ]
         }], messages)
 
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    @patch('profilomatic.profiler.symbol_table', symbol_table)
+    def test_symbol_table_output(self):
+        instance = Profiler(source_name='localhost', code_granularity='method',
+                            use_symbol_table=True)
+        instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
+        messages = []
+        instance.add_destination(messages.append)
+        for status, monotonic, next_task_uuid in [
+                ('started', 0.0, '1'), ('succeeded', 1.0, None)]:
+            msg = _MessageInfo(
+                message={'action_status': status, 'task_uuid': '1'},
+                next_task_uuid=next_task_uuid)
+            msg.stack = mock_stack('__main__:main:1', 'business.app:__init__:5',
+                                   'profilomatic:emit:101')
+            msg.monotonic = ns(monotonic)
+            msg.thread = 12345
+            instance._ingest_message(msg)
+
+        [output] = messages
+        self.assertEqual(
+            ['__main__.py:main', 'business/app.py:__init__'], output['symbols'])
+        main = output['children'][0]
+        self.assertEqual(0, main['instruction'])
+        self.assertEqual(
+            [1, 1], [child['instruction'] for child in main['children']])
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    def test_array_engine(self):
+        outputs = []
+        for engine in ['object', 'array']:
+            instance = Profiler(source_name='localhost', code_granularity='method',
+                                call_graph_engine=engine)
+            instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
+            messages = []
+            instance.add_destination(messages.append)
+            for status, monotonic, next_task_uuid in [
+                    ('started', 0.0, '1'), ('succeeded', 1.0, None)]:
+                msg = _MessageInfo(
+                    message={'action_status': status, 'task_uuid': '1'},
+                    next_task_uuid=next_task_uuid)
+                msg.stack = mock_stack('__main__:main:1', 'business.app:__init__:5',
+                                       'profilomatic:emit:101')
+                msg.monotonic = ns(monotonic)
+                msg.thread = 12345
+                instance._ingest_message(msg)
+            outputs.append(messages)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertRaises(
+            ValueError, Profiler(call_graph_engine='linked')._ingest_message, msg)
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    @patch('profilomatic.profiler.IncrementalStackTrace', IncrementalStackTrace)
+    def test_memory_budget(self):
+        instance = Profiler(source_name='localhost', code_granularity='method',
+                            max_nodes_per_task=8)
+        instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
+        messages = []
+        instance.add_destination(messages.append)
+        msg = _MessageInfo(
+            message={'action_status': 'started', 'task_uuid': '1'},
+            next_task_uuid='1')
+        msg.stack = mock_stack('__main__:main:1', 'profilomatic:emit:101')
+        msg.monotonic = ns(0.0)
+        msg.thread = 12345
+        instance.message_queue.append(msg)
+        for i in range(10):
+            frames = {12345: mock_frame('__main__:main:1', 'business.app:view%d:5' % i)}
+            with patch('sys._current_frames', return_value=frames):
+                instance._profile_once(ns(i), ns(i))
+        self.assertEqual(2, instance.coalesce_events)
+        self.assertEqual(0.0, instance.budget_pressure)
+        self.assertTrue(instance.call_graph_nodes <= 8)
+        self.assertEqual(13 - instance.call_graph_nodes, instance.coalesced_nodes)
+
+        instance.configure(max_nodes_per_task=0, max_nodes=4)
+        instance._enforce_budgets()
+        self.assertEqual(3, instance.coalesce_events)
+        self.assertTrue(instance.budget_pressure > 1.0)
+        self.assertTrue(instance.call_graph_nodes <= 4)
+        call_graph = instance.call_graphs[(12345, '1')]
+        self.assertEqual(45.0, call_graph.jsonize()['time'])
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    @patch('profilomatic.profiler.IncrementalStackTrace', IncrementalStackTrace)
+    def test_thread_state_leaves(self):
+        instance = Profiler(source_name='localhost', code_granularity='method',
+                            thread_state_leaves=True)
+        instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
+        messages = []
+        instance.add_destination(messages.append)
+        msg = _MessageInfo(
+            message={'action_status': 'started', 'task_uuid': '1'},
+            next_task_uuid='1')
+        msg.stack = mock_stack('__main__:main:1', 'profilomatic:emit:101')
+        msg.monotonic = ns(0.0)
+        msg.thread = 12345
+        instance.message_queue.append(msg)
+        # Mock frames can't be decoded, and have no CPU clock, so are running
+        with patch('sys._current_frames', mock_current_frames):
+            instance._profile_once(ns(0.25), ns(0.5))
+            with patch('profilomatic.profiler.thread_state_classifier') as classifier:
+                classifier.classify.return_value = IDLE
+                instance._profile_once(ns(0.25), ns(1.0))
+            instance._profile_once(ns(0.25), ns(1.5))
+
+        call_graph = instance.call_graphs[(12345, '1')].jsonize()
+        self.assertEqual({'running': 0.5, 'idle': 0.25}, call_graph['states'])
+        node = call_graph['children'][1]
+        while len(node.get('children', [])) == 1:
+            node = node['children'][0]
+        self.assertEqual('business/backend.py:doStuff', node['instruction'])
+        self.assertEqual(
+            [('<running>', 0.5, {'running': 0.5}), ('<idle>', 0.25, {'idle': 0.25})],
+            [(child['instruction'], child['time'], child['states'])
+             for child in node['children']])
+        self.assertEqual(0.0, node['self_time'])
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    @patch('profilomatic.profiler.IncrementalStackTrace', IncrementalStackTrace)
+    def test_snapshots(self):
+        def run(snapshot_interval):
+            instance = Profiler(source_name='localhost', code_granularity='method',
+                                snapshot_interval=snapshot_interval)
+            instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
+            messages = []
+            instance.add_destination(messages.append)
+            for status, monotonic, next_task_uuid in [
+                    ('started', 0.0, '1'), ('succeeded', 10.0, None)]:
+                msg = _MessageInfo(
+                    message={'action_status': status, 'task_uuid': '1'},
+                    next_task_uuid=next_task_uuid)
+                msg.stack = mock_stack('__main__:main:1', 'profilomatic:emit:101')
+                msg.monotonic = ns(monotonic)
+                msg.thread = 12345
+                instance.message_queue.append(msg)
+                for i in range(1, 10) if status == 'started' else []:
+                    frames = {12345: mock_frame(
+                        '__main__:main:1', 'business.app:view%d:5' % (i % 4))}
+                    with patch('sys._current_frames', return_value=frames):
+                        instance._profile_once(ns(1.0), ns(i))
+            instance._profile_once(ns(0.0), ns(10.0))
+            return messages
+
+        whole, = run(0)
+        snapshots = run(3.0)
+        self.assertEqual([0, 1, 2, 3], [s['snapshot'] for s in snapshots])
+        self.assertEqual([True] * 3, [s.get('partial') for s in snapshots[:3]])
+        self.assertNotIn('partial', snapshots[3])
+        self.assertEqual(3.0, snapshots[1]['time'])
+        self.assertEqual(whole, merge_snapshots(snapshots))
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    @patch('profilomatic.profiler.IncrementalStackTrace', IncrementalStackTrace)
+    def test_slow_destination(self):
+        instance = Profiler(source_name='localhost', code_granularity='method',
+                            call_graph_engine='array')
+        instance.wall_clock_minus_monotonic = datetime.datetime(1988, 1, 1, 9, 0, 0)
+        writing = threading.Event()
+        release = threading.Event()
+        messages = []
+
+        def slow_destination(message):
+            writing.set()
+            release.wait()
+            messages.append(message)
+
+        instance.add_destination(slow_destination)
+        instance.writer = AsyncWriter(instance._write_batch, 2, 10)
+        instance.writer.start()
+        for task in ['1', '2', '3', '4']:
+            for status, next_task_uuid in [('started', task), ('succeeded', None)]:
+                msg = _MessageInfo(
+                    message={'action_status': status, 'task_uuid': task},
+                    next_task_uuid=next_task_uuid)
+                msg.stack = mock_stack('__main__:main:1', 'profilomatic:emit:101')
+                msg.monotonic = ns(0.0)
+                msg.thread = 12345
+                instance.message_queue.append(msg)
+            # The profiler thread carries on, whilst the writer is stuck
+            instance._profile_once(ns(0.0), ns(1.0))
+            writing.wait()
+        self.assertEqual(1, instance.writer.dropped)
+        release.set()
+        instance.writer.stop()
+        instance._release_written()
+        self.assertEqual(['1', '3', '4'], [m['task_uuid'] for m in messages])
+        self.assertEqual(0, len(instance.writer.done))
+
+    def test_reconfigure_writer(self):
+        instance = Profiler(source_name='localhost', time_granularity=0.001,
+                            emit_queue_size=0)
+        instance.start()
+        try:
+            self.assertIsNone(instance.writer)
+            instance.configure(emit_queue_size=5)
+            for _ in range(1000):
+                if instance.writer is not None:
+                    break
+                time.sleep(0.001)
+            writer = instance.writer
+            self.assertEqual(5, writer.queue_size)
+            instance.configure(emit_batch_size=3, emit_overflow='block')
+            self.assertEqual(3, writer.batch_size)
+            self.assertEqual('block', writer.overflow)
+            instance.configure(emit_queue_size=0)
+            for _ in range(1000):
+                if instance.writer is None:
+                    break
+                time.sleep(0.001)
+            self.assertIsNone(instance.writer)
+            self.assertIsNone(writer.thread)
+        finally:
+            instance.stop()
+        self.assertRaises(ValueError, instance.configure, emit_overflow='wait')
+
+    @patch('profilomatic.profiler.resolve_stack', resolve_stack)
+    @patch('profilomatic.profiler.IncrementalStackTrace', IncrementalStackTrace)
+    def test_message_overflow(self):
+        def run(message_overflow):
+            instance = Profiler(source_name='localhost', store_all_logs=True,
+                                message_queue_size=3,
+                                message_overflow=message_overflow)
+            messages = []
+            instance.add_destination(messages.append)
+            for task in ['1', '2']:
+                instance.handle_message({'task_uuid': task, 'action_status': 'started'})
+                for i in range(4 if task == '1' else 1):
+                    instance.handle_message({'task_uuid': task, 'message': i})
+                instance.handle_message({'task_uuid': task, 'action_status': 'succeeded'})
+                instance._profile_once(ns(0.0), ns(1.0))
+            return instance, messages
+
+        def count_messages(node):
+            return ('message' in node) + sum(
+                count_messages(child) for child in node.get('children', []))
+
+        for message_overflow, dropped in [('drop', 3), ('end_task', 1)]:
+            instance, messages = run(message_overflow)
+            self.assertEqual(dropped, instance.message_queue.dropped)
+            self.assertEqual(1, instance.truncated_tasks)
+            self.assertEqual(3, instance.message_queue.high_water)
+            self.assertEqual(['1', '2'], [m['task_uuid'] for m in messages])
+            self.assertEqual([True, None], [m.get('truncated') for m in messages])
+            self.assertEqual([3, 3], [count_messages(m) for m in messages])
+            self.assertEqual({}, instance.thread_tasks)
+            self.assertEqual({}, instance.call_graphs)
+
     def test_messageinfo_exc_info(self):
         try:
             raise_nested_exception()
         except:
             instance = _MessageInfo(None, None)
-        trace = generate_stack_trace(instance.frame, 'method', False)
+        trace = resolve_stack(instance.stack, 'method')
         self.assertTrue(trace[-1].endswith('inner_raise_exception'))
         self.assertTrue(trace[-2].endswith('raise_nested_exception'))
+
+    def test_messageinfo_wall_clock(self):
+        instance = Profiler(code_granularity='method')
+        messages = []
+        instance.add_destination(messages.append)
+        instance.handle_message({'task_uuid': '1', 'action_status': 'started'})
+        instance.handle_message({'task_uuid': '1', 'action_status': 'succeeded'})
+        msg = instance.message_queue.popleft()
+        self.assertFalse(hasattr(msg, '__dict__'))
+        self.assertEqual(threading.current_thread().ident, msg.thread)
+        instance._ingest_message(msg)
+        instance._ingest_messages()
+        start_time = messages[0]['start_time']
+        self.assertEqual(
+            (instance.wall_clock_minus_monotonic
+             + to_timedelta(msg.monotonic)).isoformat(),
+            start_time)
+
+    def test_clock(self):
+        instance = Profiler(clock='fine')
+        instance.handle_message({'task_uuid': '1', 'action_status': 'started'})
+        msg = instance.message_queue.popleft()
+        self.assertTrue(abs(instance.now() - msg.monotonic) < ns(1.0))
+        self.assertRaises(ValueError, instance.configure, clock='thread_cpu')
+        self.assertRaises(ValueError, Profiler, overhead_clock='sundial')
+
+    def test_overhead_controller(self):
+        instance = Profiler(overhead_controller='fixed', time_granularity=0.5,
+                            simultaneous_tasks_profiled=3)
+        self.assertEqual((0.5, 3), instance.controller.update(1.0, 1.0, 1.0, 3))
+        controllers = []
+
+        def build(target, interval, admission):
+            controllers.append((target, interval, admission))
+            return instance.controller
+
+        instance.configure(overhead_controller=build, max_overhead=0.05)
+        self.assertEqual([(0.05, 0.5, 3)], controllers)
+        self.assertRaises(ValueError, instance.configure,
+                          overhead_controller='bang-bang')
+        # Hooks are timed on the thread that logs
+        instance.handle_message({'task_uuid': '1', 'action_status': 'started'})
+        self.assertTrue(instance.message_queue.hook_cost > 0)
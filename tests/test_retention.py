@@ -0,0 +1,46 @@
+import random
+import unittest
+
+from profilomatic.retention import QuantileSketch, Retention
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def test_accuracy(self):
+        sketch = QuantileSketch(accuracy=0.02, half_life=100000)
+        rng = random.Random(1)
+        values = [rng.lognormvariate(-3, 1) for _ in range(10000)]
+        for value in values:
+            sketch.add(value)
+        values.sort()
+        for q in [0.1, 0.5, 0.9, 0.99]:
+            exact = values[int(q * len(values)) - 1]
+            self.assertAlmostEqual(exact, sketch.quantile(q), delta=exact * 0.03)
+
+    def test_follows_changes(self):
+        sketch = QuantileSketch(half_life=100)
+        self.assertIsNone(sketch.quantile(0.5))
+        for _ in range(1000):
+            sketch.add(1.0)
+        for _ in range(1000):
+            sketch.add(0.01)
+        self.assertAlmostEqual(0.01, sketch.quantile(0.99), delta=0.001)
+        self.assertTrue(len(sketch.counts) <= 2)
+
+
+class RetentionTest(unittest.TestCase):
+    def test_threshold(self):
+        retention = Retention(threshold=0.5)
+        self.assertTrue(retention.keep('/slow', 0.5))
+        self.assertFalse(retention.keep('/slow', 0.4))
+        self.assertTrue(Retention().keep('/fast', 0.0))
+
+    def test_percentile(self):
+        retention = Retention(percentile=0.95, min_tasks=10, max_types=1)
+        # Everything is kept until there's enough to go on
+        self.assertEqual(
+            [True] * 10, [retention.keep('/a', 0.01 * i) for i in range(10)])
+        kept = [i for i in range(100) if retention.keep('/a', i % 10 * 0.01)]
+        self.assertEqual(set([9]), set(i % 10 for i in kept))
+        # One action type is all that's allowed
+        self.assertTrue(retention.keep('/b', 0.0))
+        self.assertEqual(['/a', '<other>'], sorted(retention.sketches))
@@ -0,0 +1,71 @@
+import threading
+import unittest
+
+from profilomatic.ring import MessageRing, MessageQueue
+
+
+class MessageRingTest(unittest.TestCase):
+    def test_wrap_around(self):
+        ring = MessageRing(3, threading.current_thread())
+        output = []
+        for i in range(10):
+            self.assertTrue(ring.append(i))
+            if i % 2:
+                output.append(ring.popleft())
+                output.append(ring.popleft())
+        self.assertEqual(list(range(10)), output)
+        self.assertRaises(IndexError, ring.popleft)
+        self.assertEqual(2, ring.high_water)
+
+    def test_full(self):
+        ring = MessageRing(2, threading.current_thread())
+        self.assertTrue(ring.append(0))
+        self.assertTrue(ring.append(1))
+        self.assertFalse(ring.append(2))
+        self.assertEqual(1, ring.dropped)
+        self.assertEqual(0, ring.popleft())
+        self.assertTrue(ring.append(3))
+        self.assertEqual([1, 3], [ring.popleft(), ring.popleft()])
+
+
+class MessageQueueTest(unittest.TestCase):
+    def test_threads(self):
+        queue = MessageQueue(2)
+
+        def produce(name):
+            for i in range(3):
+                queue.append((name, i))
+            queue.ring().mark()
+            queue.ring().hook_cost += 5
+
+        threads = [threading.Thread(target=produce, args=(name,))
+                   for name in ['a', 'b']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, queue.dropped)
+        self.assertEqual(2, queue.high_water)
+        self.assertEqual(10, queue.hook_cost)
+
+        handled = []
+        marks = []
+        queue.drain(handled.append, marks.append)
+        self.assertEqual(
+            [('a', 0), ('a', 1), ('b', 0), ('b', 1)], sorted(handled))
+        self.assertEqual(sorted(thread.ident for thread in threads), sorted(marks))
+        # Rings of finished threads are discarded, but their counts are kept
+        self.assertEqual([], queue.rings)
+        self.assertEqual(2, queue.dropped)
+        self.assertEqual(2, queue.high_water)
+        self.assertEqual(10, queue.hook_cost)
+
+    def test_marks_in_order(self):
+        queue = MessageQueue(10)
+        events = []
+        queue.append(0)
+        queue.ring().mark()
+        queue.append(1)
+        queue.drain(events.append, lambda thread: events.append('mark'))
+        self.assertEqual([0, 'mark', 1], events)
+        self.assertRaises(IndexError, queue.popleft)
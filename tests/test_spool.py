@@ -0,0 +1,162 @@
+import datetime
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from profilomatic.binary import BinaryDestination, read_call_graphs
+from profilomatic.call_graph import CallGraphRoot
+from profilomatic.clock import to_nanoseconds as ns
+from profilomatic.spool import Spool, SpooledDestination
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'profile.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def drain(self, spool):
+        payloads = []
+        spool.drain(payloads.append)
+        return payloads
+
+    def test_round_trip(self):
+        spool = Spool(self.filename, 1024)
+        self.assertTrue(spool.append(b'hello'))
+        self.assertTrue(spool.append(b'world'))
+        spool.close()
+
+        spool = Spool(self.filename)
+        self.assertEqual(1024, spool.capacity)
+        self.assertEqual([b'hello', b'world'], self.drain(spool))
+        self.assertEqual([], self.drain(spool))
+        self.assertEqual(0, spool.pending())
+        spool.close()
+
+    def test_wrap_around(self):
+        spool = Spool(self.filename, 64)
+        written = []
+        for i in range(20):
+            payload = str(i).encode('ascii') * (i % 7 + 1)
+            self.assertTrue(spool.append(payload))
+            written.append(payload)
+            if i % 3 == 2:
+                self.assertEqual(written, self.drain(spool))
+                written = []
+        self.assertEqual(written, self.drain(spool))
+        spool.close()
+
+    def test_full(self):
+        spool = Spool(self.filename, 32)
+        self.assertTrue(spool.append(b'x' * 8))
+        self.assertTrue(spool.append(b'x' * 8))
+        self.assertFalse(spool.append(b'x'))
+        self.assertFalse(spool.append(b'x' * 100))
+        self.assertEqual(2, spool.dropped)
+        self.assertEqual(2, len(self.drain(spool)))
+        self.assertTrue(spool.append(b'x'))
+        spool.close()
+
+    def test_handler_failure(self):
+        spool = Spool(self.filename, 1024)
+        spool.append(b'hello')
+
+        def fail(payload):
+            raise IOError('Destination unavailable')
+
+        self.assertRaises(IOError, spool.drain, fail)
+        self.assertEqual([b'hello'], self.drain(spool))
+        spool.close()
+
+    def test_corruption(self):
+        spool = Spool(self.filename, 1024)
+        spool.append(b'hello')
+        spool.map[72:73] = b'j'
+        self.assertEqual([], self.drain(spool))
+        self.assertEqual(1, spool.corrupt)
+        self.assertEqual(0, spool.pending())
+        spool.close()
+
+    def test_not_a_spool(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'Not a spool' * 10)
+        self.assertRaises(ValueError, Spool, self.filename)
+
+    def test_survives_crash(self):
+        script = (
+            'import os\n'
+            'from profilomatic.spool import Spool\n'
+            'spool = Spool(%r, 1024)\n'
+            'spool.append(b"hello")\n'
+            'os._exit(1)\n' % self.filename)
+        environ = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.call([sys.executable, '-c', script], env=environ)
+        spool = Spool(self.filename)
+        self.assertEqual([b'hello'], self.drain(spool))
+        spool.close()
+
+
+class SpooledDestinationTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'profile.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_forwarding(self):
+        call_graph = CallGraphRoot(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        call_graph.ingest(['main', u'd\u00f6It'], ns(1.0), ns(2.0))
+        expected = call_graph.jsonize()
+        expected['source'] = 'localhost'
+
+        failing = [True]
+        received = []
+
+        def destination(message):
+            if failing[0]:
+                raise IOError('Destination unavailable')
+            received.append(message)
+
+        instance = SpooledDestination(self.filename, [destination])
+        instance.write_call_graph(call_graph, None, 'iso', {'source': 'localhost'})
+        instance({'task_uuid': '2'})
+        self.assertEqual([], received)
+        instance.close()
+
+        # Records left by the last process are forwarded by the next
+        failing[0] = False
+        instance = SpooledDestination(self.filename, [destination])
+        instance.flush()
+        self.assertEqual([expected, {'task_uuid': '2'}], received)
+        self.assertEqual(0, instance.spool.pending())
+        instance.close()
+
+    def test_forwarding_to_binary_destination(self):
+        call_graph = CallGraphRoot(
+            1, '12345', datetime.datetime(2016, 1, 21, 9, 0, 0), ns(1.0))
+        call_graph.ingest(['main', u'd\u00f6It'], ns(1.0), ns(2.0),
+                          {'action_status': 'started'})
+        call_graph.ingest(['main', 'other'], ns(2.0), ns(3.5))
+        expected = call_graph.jsonize()
+        expected['source'] = 'localhost'
+
+        output = io.BytesIO()
+        received = []
+        instance = SpooledDestination(
+            self.filename, [BinaryDestination(output), received.append])
+        instance.write_call_graphs(
+            [(call_graph, {'source': 'localhost'})] * 2, None, 'iso')
+        self.assertEqual(0, instance.spool.pending())
+        instance.close()
+
+        output.seek(0)
+        self.assertEqual([expected] * 2, list(read_call_graphs(output)))
+        self.assertEqual([expected] * 2, received)
@@ -2,9 +2,15 @@ import unittest
 from .base_stack_trace_test import BaseStackTraceTest
 
 try:
-    from profilomatic._stack_trace import generate_stack_trace
+    from profilomatic._stack_trace import \
+        generate_stack_trace, symbol_cache, IncrementalStackTrace, \
+        capture_stack, resolve_stack
 
     class CStackTraceTest(BaseStackTraceTest, unittest.TestCase):
         stack_trace_fn = generate_stack_trace.__call__
+        symbol_cache = symbol_cache
+        incremental_class = IncrementalStackTrace
+        capture_fn = capture_stack.__call__
+        resolve_fn = resolve_stack.__call__
 except ImportError:
     pass
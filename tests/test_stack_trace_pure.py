@@ -1,7 +1,13 @@
 import unittest
 from .base_stack_trace_test import BaseStackTraceTest
-from profilomatic.stack_trace import generate_stack_trace
+from profilomatic.stack_trace import \
+    generate_stack_trace, symbol_cache, IncrementalStackTrace, \
+    capture_stack, resolve_stack
 
 
 class PureStackTraceTest(BaseStackTraceTest, unittest.TestCase):
     stack_trace_fn = generate_stack_trace.__call__
+    symbol_cache = symbol_cache
+    incremental_class = IncrementalStackTrace
+    capture_fn = capture_stack.__call__
+    resolve_fn = resolve_stack.__call__
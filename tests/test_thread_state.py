@@ -0,0 +1,69 @@
+import sys
+import threading
+import time
+import unittest
+
+from profilomatic.thread_state import \
+    ThreadStateClassifier, RUNNING, GIL, BLOCKED, IDLE
+
+
+def sleep_for(event):
+    while not event.is_set():
+        time.sleep(0.01)
+
+
+def wait_for(lock, event):
+    lock.acquire()
+
+
+def spin(event):
+    while not event.is_set():
+        pass
+
+
+class ThreadStateTest(unittest.TestCase):
+    def setUp(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.lock.acquire()
+        self.threads = []
+
+    def tearDown(self):
+        self.event.set()
+        self.lock.release()
+        for thread in self.threads:
+            thread.join()
+
+    def frame_of(self, target, *args):
+        thread = threading.Thread(target=target, args=args + (self.event,))
+        thread.start()
+        self.threads.append(thread)
+        time.sleep(0.1)
+        return sys._current_frames()[thread.ident]
+
+    @unittest.skipIf(sys.version_info < (3, 4), 'Calls are only recognised on Python 3.4+')
+    def test_classify(self):
+        classifier = ThreadStateClassifier()
+        sleeping = self.frame_of(sleep_for)
+        waiting = self.frame_of(wait_for, self.lock)
+        spinning = self.frame_of(spin)
+
+        self.assertEqual(IDLE, classifier.classify(sleeping, 100))
+        self.assertEqual(IDLE, classifier.classify(sleeping, 100, 0))
+        self.assertEqual(BLOCKED, classifier.classify(waiting, 100))
+        self.assertEqual(BLOCKED, classifier.classify(waiting, 100, 0))
+        self.assertEqual(RUNNING, classifier.classify(spinning, 100))
+        self.assertEqual(RUNNING, classifier.classify(spinning, 100, 90))
+        # Not running, in the middle of Python code
+        self.assertEqual(GIL, classifier.classify(spinning, 100, 10))
+        # Whatever it's in the middle of, a thread on the CPU is running
+        self.assertEqual(RUNNING, classifier.classify(waiting, 100, 50))
+        self.assertTrue(len(classifier) > 0)
+
+    def test_cache_size(self):
+        classifier = ThreadStateClassifier(capacity=2)
+        frame = sys._getframe()
+        for _ in range(5):
+            classifier.classify(frame, 100)
+            frame = frame.f_back or sys._getframe()
+        self.assertTrue(len(classifier) <= 2)
@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+from profilomatic.writer import AsyncWriter
+
+
+class AsyncWriterTest(unittest.TestCase):
+    def test_batches(self):
+        batches = []
+        writer = AsyncWriter(batches.append, queue_size=10, batch_size=3)
+        for i in range(7):
+            writer.put(i)
+        writer.start()
+        writer.stop()
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], batches)
+        self.assertEqual(7, writer.written)
+        self.assertEqual(3, writer.batches)
+        self.assertEqual(list(range(7)), list(writer.done))
+
+    def test_drop_oldest(self):
+        batches = []
+        writer = AsyncWriter(batches.append, queue_size=3, batch_size=10)
+        for i in range(5):
+            writer.put(i)
+        self.assertEqual(2, writer.dropped)
+        self.assertEqual([0, 1], list(writer.done))
+        writer.start()
+        writer.stop()
+        self.assertEqual([[2, 3, 4]], batches)
+
+    def test_block(self):
+        release = threading.Event()
+        batches = []
+
+        def write_batch(batch):
+            release.wait()
+            batches.append(batch)
+
+        writer = AsyncWriter(write_batch, queue_size=1, batch_size=1,
+                             overflow='block')
+        writer.start()
+        writer.put(0)  # Taken by the writer thread, which then waits
+        writer.put(1)  # Fills the queue
+        putter = threading.Thread(target=writer.put, args=(2,))
+        putter.start()
+        putter.join(0.1)
+        self.assertTrue(putter.is_alive())
+        release.set()
+        putter.join()
+        writer.stop()
+        self.assertEqual([[0], [1], [2]], batches)
+        self.assertEqual(0, writer.dropped)
+
+    def test_write_errors(self):
+        def write_batch(batch):
+            raise Exception('Destination unavailable')
+
+        writer = AsyncWriter(write_batch)
+        writer.start()
+        writer.put(0)
+        writer.stop()
+        self.assertEqual([0], list(writer.done))
+
+    def test_bad_overflow_policy(self):
+        self.assertRaises(ValueError, AsyncWriter, list.append, overflow='drop_newest')
+
+    def test_flush(self):
+        flushed = threading.Event()
+        writer = AsyncWriter(list, flush=flushed.set, flush_interval=0.01)
+        writer.start()
+        writer.put(0)
+        self.assertTrue(flushed.wait(5))
+        flushed.clear()
+        writer.put(1)
+        writer.stop()
+        self.assertTrue(flushed.is_set())